@@ -3,19 +3,24 @@ import sys
 if sys.version_info < (3, 3):
 	raise RuntimeError('At least Python 3.3 is required')
 
-import struct
+import struct, zlib, mmap
 from datetime import datetime, timedelta
 from pytz import utc
 import filestuff, worker, common
 import fcntl, os.path, stat, os, itertools
-from os import fstat, mkdir, fchmod, chmod, utime, remove
+from os import fstat, mkdir, fchmod, chmod, utime, remove, rmdir
 from os.path import join as path_join, isdir, isfile, normpath, dirname, relpath
+from stat import S_ISDIR
 from traceback import print_exc
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
 from queue import Queue, Empty
-import logging
+import logging, sqlite3, weakref
 from threading import Lock
+from time import time, monotonic, sleep
 from shutil import copyfileobj
+from tempfile import TemporaryFile, mkstemp
+from io import BytesIO
+from hashlib import sha1
 
 
 LOGGER = logging.getLogger(__name__)
@@ -31,24 +36,88 @@ def timestamps_equivalent(t1, t2, tolerance = 0.001):
 		tolerance = abs(tolerance.total_seconds())
 	return abs((t1 - t2).total_seconds()) <= tolerance
 
+ContentType = namedtuple('ContentType', ['encoding', 'mime'])
+
 class EntryHeader(object):
-	__slots__ = 'size', 'cached', 'timestamp', 'checksum'
-	MAGIC = b'\xCA\xCE01'
-	struct_fmt = '!I?QIH'
-	minsize = len(MAGIC) + len(struct.pack(struct_fmt, 0, False, 0, 0, 0))
-	def __init__(self, size, cached, timestamp, checksum):
-		if size > 0xFFFFFFFF:
+	"""
+		Describes the original an entry was rendered from.  Version 3 headers
+		also record where the payload starts, how long it is and, once the
+		entry has been sealed, the processor's encoding and MIME type.  They
+		are read with a single read of PREFETCH bytes unless the checksum is
+		unusually long.  The fingerprint identifies the processor that
+		rendered the entry.  Entries with a reference have no payload of
+		their own; it is kept in the object store under that key.  The
+		original's modification time is kept in nanoseconds, as stored.
+	"""
+	__slots__ = 'size', 'cached', 'timestamp_ns', 'checksum', 'stat', 'content', 'payload_length', 'header_length', 'version', 'fingerprint', 'reference'
+	VERSION = 3
+	MAGIC = b'\xCA\xCE03'
+	MAGICS = {
+		b'\xCA\xCE01' : 1,
+		b'\xCA\xCE02' : 2,
+		MAGIC : VERSION,
+	}
+	LEGACY_MAGIC = b'\xCA\xCE01'
+	legacy_fmt = '!I?QIH'
+	struct_fmt = '!IQ?qQHB'
+	stat_fmt = '!QqqQQ'
+	length_fmt = '!B'
+	SEALED, HAS_CONTENT, HAS_FINGERPRINT, HAS_REFERENCE = 0x1, 0x2, 0x4, 0x8
+	PREFETCH = 512
+	legacy_minsize = len(LEGACY_MAGIC) + struct.calcsize(legacy_fmt)
+	minsize = len(MAGIC) + struct.calcsize(struct_fmt) + struct.calcsize(stat_fmt)
+	def __init__(self, size, cached, timestamp, checksum, stat = None, content = None, payload_length = None, header_length = None, version = VERSION, fingerprint = None, reference = None):
+		if size > 0xFFFFFFFFFFFFFFFF:
 			raise ValueError('Size is too large')
 		if len(checksum) > 0xFFFF:
 			raise ValueError('Checksum is too long')
-		self.size, self.cached, self.timestamp, self.checksum = size, bool(cached), timestamp, checksum
+		if fingerprint is not None and len(fingerprint) > 0xFF:
+			raise ValueError('Fingerprint is too long')
+		if reference is not None and len(reference) > 0xFF:
+			raise ValueError('Reference is too long')
+		self.fingerprint, self.reference = fingerprint, reference
+		if not isinstance(timestamp, int):
+			timestamp = self.datetime2ns(timestamp)
+		self.size, self.cached, self.timestamp_ns, self.checksum = size, bool(cached), timestamp, checksum
+		self.stat = filestuff.Stat(*stat) if stat is not None else None
+		self.content = ContentType(*content) if content is not None else None
+		self.payload_length, self.header_length, self.version = payload_length, header_length, version
+	def replace(self, **changes):
+		"Returns a copy in the current version with some of the fields changed."
+		fields = {attr : getattr(self, attr) for attr in ['size', 'cached', 'checksum', 'stat', 'content', 'payload_length', 'header_length', 'fingerprint', 'reference']}
+		fields['timestamp'] = self.timestamp_ns
+		fields.update(changes)
+		return EntryHeader(**fields)
+	@property
+	def timestamp(self):
+		return self.ns2datetime(self.timestamp_ns, utc)
+	@property
+	def legacy(self):
+		return self.version < self.VERSION
+	@property
+	def sealed(self):
+		return self.payload_length is not None
 	def __eq__(self, other):
-		if not all((hasattr(other, attr) for attr in ['size', 'cached', 'timestamp', 'checksum'])):
+		if not all((hasattr(other, attr) for attr in ['size', 'cached', 'timestamp_ns', 'checksum'])):
 			return False
 		elif not all([self.cached, other.cached]):
 			return False
 		else:
-			return self.size == other.size and self.timestamp == other.timestamp and self.checksum == other.checksum
+			return self.same_source(other)
+	def same_source(self, other):
+		"Like ==, but ignores whether either header was cached."
+		return self.size == other.size and self.same_timestamp(other) and self.checksum == other.checksum
+	def same_timestamp(self, other):
+		"""
+			Headers written before nanoseconds were kept only have microseconds,
+			rounded from a float, so those match anything less than one away.
+		"""
+		if self.timestamp_ns % 1000 and other.timestamp_ns % 1000:
+			return self.timestamp_ns == other.timestamp_ns
+		return abs(self.timestamp_ns - other.timestamp_ns) < 1000
+	def stat_matches(self, stat):
+		"Legacy headers carry no stat information and never match."
+		return self.stat is not None and self.stat == stat
 	@staticmethod
 	def datetime2fp(dt):
 		seconds = int(dt.timestamp())
@@ -58,28 +127,832 @@ class EntryHeader(object):
 	@staticmethod
 	def fp2datetime(s, ms, tzinfo):
 		return datetime.utcfromtimestamp(s).replace(microsecond = ms, tzinfo = tzinfo)
+	@classmethod
+	def datetime2ns(cls, dt):
+		seconds, microseconds = cls.datetime2fp(dt)
+		return seconds * 1000000000 + microseconds * 1000
+	@classmethod
+	def ns2datetime(cls, ns, tzinfo):
+		seconds, ns = divmod(ns, 1000000000)
+		return cls.fp2datetime(seconds, ns // 1000, tzinfo)
+	@classmethod
+	def encode_content(cls, content):
+		if content is None:
+			return b''
+		encoding = content.encoding.encode('ascii') if content.encoding is not None else b''
+		mime = content.mime.encode('ascii')
+		if len(encoding) > 0xFF or len(mime) > 0xFF:
+			raise ValueError('Content type is too long')
+		return struct.pack(cls.length_fmt, len(encoding)) + encoding + struct.pack(cls.length_fmt, len(mime)) + mime
+	def encode_fingerprint(self):
+		if self.fingerprint is None:
+			return b''
+		return struct.pack(self.length_fmt, len(self.fingerprint)) + self.fingerprint
+	def encode_reference(self):
+		if self.reference is None:
+			return b''
+		reference = self.reference.encode('ascii')
+		return struct.pack(self.length_fmt, len(reference)) + reference
+	def __len__(self):
+		"Length of the header without any padding"
+		return self.minsize + len(self.checksum) + len(self.encode_content(self.content)) + len(self.encode_fingerprint()) \
+				+ len(self.encode_reference())
 	def write(self, stream):
-		seconds, microseconds = self.datetime2fp(self.timestamp)
+		"Writes the header, padded out to header_length if that is set."
+		content = self.encode_content(self.content)
+		length = max(len(self), self.header_length or 0)
+		flags = (self.SEALED if self.sealed else 0) | (self.HAS_CONTENT if self.content is not None else 0) \
+				| (self.HAS_FINGERPRINT if self.fingerprint is not None else 0) \
+				| (self.HAS_REFERENCE if self.reference is not None else 0)
 		count = stream.write(self.MAGIC)
-		count += stream.write(struct.pack(self.struct_fmt, self.size, self.cached, seconds, microseconds, len(self.checksum)))
+		count += stream.write(struct.pack(self.struct_fmt, length, self.size, self.cached, self.timestamp_ns, \
+				self.payload_length or 0, len(self.checksum), flags))
+		# An all-zero block stands for "no stat information".
+		count += stream.write(struct.pack(self.stat_fmt, *(self.stat if self.stat is not None else (0, 0, 0, 0, 0))))
 		count += stream.write(self.checksum)
+		count += stream.write(content)
+		count += stream.write(self.encode_fingerprint())
+		count += stream.write(self.encode_reference())
+		if count < length:
+			count += stream.write(bytes(length - count))
 		return count
 	@classmethod
 	def read(cls, stream):
-		buff = stream.read(cls.minsize)
-		if buff[:len(cls.MAGIC)] != cls.MAGIC:
+		"Reads a header of any version, leaving stream at the start of the payload."
+		start = stream.tell()
+		data = stream.read(cls.PREFETCH)
+		try:
+			version = cls.MAGICS[data[:len(cls.MAGIC)]]
+		except KeyError:
 			raise ValueError('This is not a recognized format')
+		offset = len(cls.MAGIC)
+		content = payload_length = header_length = stat = fingerprint = reference = None
 		try:
-			size, cached, seconds, microseconds, cksum_len = struct.unpack(cls.struct_fmt, buff[len(cls.MAGIC):])
+			if version < 3:
+				size, cached, seconds, microseconds, cksum_len = struct.unpack_from(cls.legacy_fmt, data, offset)
+				offset += struct.calcsize(cls.legacy_fmt)
+				timestamp = seconds * 1000000000 + microseconds * 1000
+			else:
+				header_length, size, cached, timestamp, payload_length, cksum_len, flags = struct.unpack_from(cls.struct_fmt, data, offset)
+				offset += struct.calcsize(cls.struct_fmt)
+				if not flags & cls.SEALED:
+					payload_length = None
+			if version >= 2:
+				stat = struct.unpack_from(cls.stat_fmt, data, offset)
+				offset += struct.calcsize(cls.stat_fmt)
+				if not any(stat):
+					stat = None
 		except struct.error:
 			raise IOError
-		timestamp = cls.fp2datetime(seconds, microseconds, utc)
-		checksum = None
-		if cksum_len > 0:
-			checksum = stream.read(cksum_len)
+		needed = max(offset + cksum_len, header_length or 0)
+		if len(data) < needed:
+			data += stream.read(needed - len(data))
+		checksum = data[offset:offset + cksum_len]
 		if len(checksum) < cksum_len:
 			raise ValueError('Invalid checksum length')
-		return cls(size, cached, timestamp, checksum)
+		offset += cksum_len
+		if version >= 3 and flags & cls.HAS_CONTENT:
+			try:
+				fields = []
+				for i in range(2):
+					length, = struct.unpack_from(cls.length_fmt, data, offset)
+					offset += struct.calcsize(cls.length_fmt)
+					fields.append(data[offset:offset + length].decode('ascii'))
+					offset += length
+			except (struct.error, UnicodeDecodeError):
+				raise IOError
+			content = ContentType(fields[0] or None, fields[1])
+		if version >= 3 and flags & cls.HAS_FINGERPRINT:
+			try:
+				length, = struct.unpack_from(cls.length_fmt, data, offset)
+			except struct.error:
+				raise IOError
+			offset += struct.calcsize(cls.length_fmt)
+			fingerprint = data[offset:offset + length]
+			if len(fingerprint) < length:
+				raise IOError
+			offset += length
+		if version >= 3 and flags & cls.HAS_REFERENCE:
+			try:
+				length, = struct.unpack_from(cls.length_fmt, data, offset)
+				offset += struct.calcsize(cls.length_fmt)
+				reference = data[offset:offset + length].decode('ascii')
+			except (struct.error, UnicodeDecodeError):
+				raise IOError
+			if len(reference) < length:
+				raise IOError
+			offset += length
+		if header_length is not None:
+			if header_length < offset or len(data) < header_length:
+				raise IOError
+			offset = header_length
+		stream.seek(start + offset)
+		return cls(size, cached, timestamp, checksum, stat, content, payload_length, header_length, version, fingerprint, reference)
+
+
+IndexRecord = namedtuple('IndexRecord', ['header', 'content_header', 'header_length', 'payload_offset', 'payload_length', 'source_stat', 'entry_id'])
+
+class HeaderIndex(object):
+	"Bounded LRU mapping of relative paths to the parsed state of their entries"
+	__slots__ = '__records', '__size', '__lock',
+	def __init__(self, size):
+		size = int(size)
+		if size < 1:
+			raise ValueError('Invalid index size: %d' % size)
+		self.__size = size
+		self.__records = OrderedDict()
+		self.__lock = Lock()
+	def __len__(self):
+		with self.__lock:
+			return len(self.__records)
+	def get(self, key):
+		with self.__lock:
+			try:
+				record = self.__records.pop(key)
+			except KeyError:
+				return None
+			self.__records[key] = record
+			return record
+	def put(self, key, record):
+		with self.__lock:
+			self.__records.pop(key, None)
+			self.__records[key] = record
+			while len(self.__records) > self.__size:
+				self.__records.popitem(last = False)
+	def discard(self, key):
+		with self.__lock:
+			self.__records.pop(key, None)
+	def clear(self):
+		with self.__lock:
+			self.__records.clear()
+
+
+class AccessIndex(object):
+	"""
+		Persistent, access-ordered record of the entries in a cache and their
+		sizes, so that scrubs can evict the least recently used entries
+		without walking the whole tree.  Accesses are batched in memory and
+		written in bulk.
+	"""
+	FLUSH_THRESHOLD = 64
+	__slots__ = '__connection', '__lock', '__pending',
+	def __init__(self, path):
+		self.__lock = Lock()
+		self.__pending = {}
+		self.__connection = sqlite3.connect(path, timeout = 60, check_same_thread = False)
+		common.fix_perms(path)
+		with self.__connection:
+			self.__connection.execute('CREATE TABLE IF NOT EXISTS Entries(path TEXT PRIMARY KEY, accessed REAL NOT NULL, size INTEGER NOT NULL DEFAULT 0)')
+			columns = {row[1] for row in self.__connection.execute('PRAGMA table_info(Entries)')}
+			if 'size' not in columns:
+				# Written before sizes were tracked; the next full scrub fills them in.
+				self.__connection.execute('ALTER TABLE Entries ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+			self.__connection.execute('CREATE INDEX IF NOT EXISTS EntriesByAccess ON Entries(accessed)')
+	def close(self):
+		with self.__lock:
+			if self.__connection is not None:
+				self.__flush()
+				self.__connection.close()
+				self.__connection = None
+	def __del__(self):
+		self.close()
+	def __flush(self):
+		if self.__pending:
+			with self.__connection:
+				for path, (accessed, size) in self.__pending.items():
+					if size is not None:
+						self.__connection.execute('INSERT OR REPLACE INTO Entries(path, accessed, size) VALUES(?, ?, ?)', (path, accessed, size))
+					elif not self.__connection.execute('UPDATE Entries SET accessed = ? WHERE path = ?', (accessed, path)).rowcount:
+						self.__connection.execute('INSERT OR IGNORE INTO Entries(path, accessed) VALUES(?, ?)', (path, accessed))
+			self.__pending.clear()
+	def flush(self):
+		with self.__lock:
+			self.__flush()
+	def touch(self, path, size = None, accessed = None):
+		"Records an access, and the entry's size if it is known to have changed"
+		if accessed is None:
+			accessed = time()
+		with self.__lock:
+			if size is None:
+				size = self.__pending.get(path, (None, None))[1]
+			self.__pending[path] = (accessed, size)
+			if len(self.__pending) >= self.FLUSH_THRESHOLD:
+				self.__flush()
+	def discard(self, path):
+		with self.__lock:
+			self.__pending.pop(path, None)
+			with self.__connection:
+				self.__connection.execute('DELETE FROM Entries WHERE path = ?', (path,))
+	def __len__(self):
+		with self.__lock:
+			self.__flush()
+			return self.__connection.execute('SELECT COUNT(*) FROM Entries').fetchone()[0]
+	@property
+	def total_size(self):
+		with self.__lock:
+			self.__flush()
+			return self.__connection.execute('SELECT COALESCE(SUM(size), 0) FROM Entries').fetchone()[0]
+	def oldest(self, count = None, size = None):
+		"""
+			(path, size) pairs of the least recently used entries, oldest
+			first, stopping once count entries or size bytes are covered.
+		"""
+		with self.__lock:
+			self.__flush()
+			result, total = [], 0
+			for path, entry_size in self.__connection.execute('SELECT path, size FROM Entries ORDER BY accessed'):
+				if (count is None or len(result) >= count) and (size is None or total >= size):
+					break
+				result.append((path, entry_size))
+				total += entry_size
+			return result
+	def older_than(self, cutoff):
+		with self.__lock:
+			self.__flush()
+			return self.__connection.execute('SELECT path, size FROM Entries WHERE accessed < ?', (cutoff,)).fetchall()
+	def ensure(self, entries):
+		"""
+			Adds (path, accessed, size) tuples for entries that are not
+			indexed yet, and corrects the sizes of those that are.
+		"""
+		with self.__lock:
+			self.__flush()
+			with self.__connection:
+				for path, accessed, size in entries:
+					if not self.__connection.execute('UPDATE Entries SET size = ? WHERE path = ?', (size, path)).rowcount:
+						self.__connection.execute('INSERT INTO Entries(path, accessed, size) VALUES(?, ?, ?)', (path, accessed, size))
+	def discard_unseen(self, seen, before):
+		"Drops entries last used before a scrub started that the scrub did not find"
+		with self.__lock:
+			self.__flush()
+			with self.__connection:
+				missing = [(path,) for path, in self.__connection.execute('SELECT path FROM Entries WHERE accessed < ?', (before,)) \
+						if path not in seen]
+				self.__connection.executemany('DELETE FROM Entries WHERE path = ?', missing)
+			return len(missing)
+	def reset(self, entries):
+		"Replaces the contents of the index with (path, accessed, size) tuples"
+		with self.__lock:
+			self.__pending.clear()
+			with self.__connection:
+				self.__connection.execute('DELETE FROM Entries')
+				self.__connection.executemany('INSERT OR REPLACE INTO Entries(path, accessed, size) VALUES(?, ?, ?)', entries)
+
+
+class MissingIndex(object):
+	"""
+		Bounded LRU of relative paths whose originals do not exist.  Each
+		one is kept with the nearest parent directory that does exist and
+		that directory's modification time, which changes as soon as anything
+		on the way to the path is created.
+	"""
+	__slots__ = '__records', '__size', '__lock',
+	def __init__(self, size):
+		size = int(size)
+		if size < 1:
+			raise ValueError('Invalid missing index size: %d' % size)
+		self.__size = size
+		self.__records = OrderedDict()
+		self.__lock = Lock()
+	def __len__(self):
+		with self.__lock:
+			return len(self.__records)
+	@staticmethod
+	def nearest_parent(source_root, path):
+		"""
+			Returns the nearest existing directory above path, as a path
+			relative to source_root, and its modification time.
+		"""
+		parent = path
+		while parent:
+			parent = dirname(parent)
+			try:
+				info = os.stat(path_join(source_root, parent))
+			except OSError:
+				continue
+			if S_ISDIR(info.st_mode):
+				return parent, info.st_mtime_ns
+		raise ValueError('No parent of %s exists' % path)
+	def add(self, path, parent, mtime_ns):
+		with self.__lock:
+			self.__records.pop(path, None)
+			self.__records[path] = (parent, mtime_ns)
+			while len(self.__records) > self.__size:
+				self.__records.popitem(last = False)
+	def missing(self, source_root, path):
+		"Whether path is still known to be missing"
+		with self.__lock:
+			record = self.__records.get(path, None)
+		if record is None:
+			return False
+		parent, mtime_ns = record
+		try:
+			if os.stat(path_join(source_root, parent)).st_mtime_ns == mtime_ns:
+				with self.__lock:
+					if path in self.__records:
+						self.__records.move_to_end(path)
+				return True
+		except OSError:
+			pass
+		self.discard(path)
+		return False
+	def discard(self, path):
+		with self.__lock:
+			self.__records.pop(path, None)
+	def clear(self):
+		with self.__lock:
+			self.__records.clear()
+
+
+class SourceState(object):
+	"""
+		Remembers the checksums of originals along with their stat, so that
+		every cache of the same source root checksums an original only once
+		each time it changes.  Use shared() to get the instance for a root.
+		With a memo, checksums also survive restarts and are shared with
+		other processes.
+	"""
+	__slots__ = '__checksums', '__size', '__lock', '__checksum_function', '__memo', '__flights', '__hits', '__misses', '__weakref__',
+	DEFAULT_SIZE = 4096
+	instances = weakref.WeakValueDictionary()
+	ilock = Lock()
+	def __init__(self, checksum_function, size = DEFAULT_SIZE, memo = None):
+		size = int(size)
+		if size < 1:
+			raise ValueError('Invalid source state size: %d' % size)
+		self.__checksum_function = checksum_function
+		self.__memo = filestuff.ChecksumMemo(memo) if memo is not None else None
+		self.__size = size
+		self.__checksums = OrderedDict()
+		self.__lock = Lock()
+		self.__flights = worker.SingleFlight()
+		self.__hits = 0
+		self.__misses = 0
+	@classmethod
+	def shared(cls, source_root, checksum_function, memo = None):
+		key = (normpath(source_root), checksum_function, memo)
+		with cls.ilock:
+			state = cls.instances.get(key, None)
+			if state is None:
+				state = cls(checksum_function, memo = memo)
+				cls.instances[key] = state
+			return state
+	def __len__(self):
+		with self.__lock:
+			return len(self.__checksums)
+	@property
+	def hits(self):
+		return self.__hits
+	@property
+	def misses(self):
+		return self.__misses
+	@property
+	def memo(self):
+		return self.__memo
+	def __compute(self, path, original, source_stat):
+		checksum = original.checksum(self.__checksum_function, self.__memo)
+		with self.__lock:
+			self.__misses += 1
+			self.__checksums.pop(path, None)
+			self.__checksums[path] = (source_stat, checksum)
+			while len(self.__checksums) > self.__size:
+				self.__checksums.popitem(last = False)
+		return checksum
+	def checksum(self, path, original, source_stat):
+		"Returns the checksum of an open original, computing it only if its stat has changed."
+		with self.__lock:
+			known = self.__checksums.get(path, None)
+			if known is not None and known[0] == source_stat:
+				self.__checksums.move_to_end(path)
+				self.__hits += 1
+				return known[1]
+		# Caches checking the same original at once wait for one checksum.
+		return self.__flights((path, source_stat), self.__compute, path, original, source_stat)
+	def discard(self, path):
+		with self.__lock:
+			self.__checksums.pop(path, None)
+
+
+class ObjectStore(object):
+	"""
+		Rendered entries kept by what they were rendered from, so that paths
+		whose originals have the same contents and are rendered by the same
+		processor share one file.  Objects are published by hard-linking a
+		finished render and are never changed in place.
+	"""
+	__slots__ = '__root',
+	TEMPORARY_SUFFIX = '.tmp'
+	def __init__(self, root):
+		self.__root = root
+		if not isdir(root):
+			mkdir(root)
+		common.fix_dir_perms(root)
+	@property
+	def root(self):
+		return self.__root
+	@staticmethod
+	def key(header):
+		"Objects are keyed by the original's checksum and the processor's fingerprint."
+		hasher = sha1()
+		hasher.update(header.checksum)
+		hasher.update(b'\0')
+		hasher.update(header.fingerprint or b'')
+		return hasher.hexdigest()
+	def path(self, key):
+		return path_join(self.__root, key[:2], key)
+	def open(self, key):
+		return open(self.path(key), 'rb')
+	def __contains__(self, key):
+		return isfile(self.path(key))
+	def size(self, key):
+		try:
+			return os.stat(self.path(key)).st_size
+		except OSError:
+			return 0
+	def touch(self, key):
+		"Keeps an object that just gained a reference from being collected."
+		try:
+			utime(self.path(key))
+			return True
+		except OSError:
+			return False
+	def publish(self, fname, key, replace = False):
+		"""
+			Links a finished render into the store.  An object that is already
+			there is kept unless replace is set.  Returns the number of bytes
+			added.
+		"""
+		path = self.path(key)
+		try:
+			mkdir(dirname(path))
+		except OSError:
+			pass
+		previous = self.size(key)
+		if not replace:
+			try:
+				os.link(fname, path)
+			except FileExistsError:
+				return 0
+			return os.stat(path).st_size
+		fd, temporary = mkstemp(prefix = '.%s.' % key, suffix = self.TEMPORARY_SUFFIX, dir = dirname(path))
+		os.close(fd)
+		remove(temporary)
+		try:
+			os.link(fname, temporary)
+			os.rename(temporary, path)
+		except OSError:
+			try:
+				remove(temporary)
+			except OSError:
+				pass
+			raise
+		return os.stat(path).st_size - previous
+	def collect(self, referenced, before):
+		"""
+			Removes objects that are not in referenced and have not been
+			touched since before (a timestamp), along with abandoned temporary
+			files.  Returns the number of objects and bytes removed.
+		"""
+		count = size = 0
+		for path, dnames, fnames in os.walk(self.__root, topdown = False):
+			for fname in fnames:
+				if not fname.startswith('.') and fname in referenced:
+					continue
+				full_path = path_join(path, fname)
+				try:
+					info = os.stat(full_path)
+					if info.st_mtime >= before:
+						continue
+					remove(full_path)
+				except OSError:
+					continue
+				if not fname.startswith('.'):
+					LOGGER.debug('Collecting unreferenced object %s' % fname)
+					count += 1
+					size += info.st_size
+			if normpath(path) != normpath(self.__root):
+				try:
+					rmdir(path)
+				except OSError:
+					pass
+		return count, size
+
+
+MemoryRecord = namedtuple('MemoryRecord', ['header', 'content_header', 'payload', 'source_stat', 'entry_id', 'variants'])
+
+
+class MemoryTier(object):
+	"""
+		Bounded LRU of whole payloads, so the most popular pages can be served
+		without touching the disk cache.  Records are validated by the cache
+		against the stat of the source and of the entry file.
+	"""
+	__slots__ = '__records', '__lock', '__max_bytes', '__max_entry_bytes', '__bytes', '__hits', '__misses',
+	def __init__(self, max_bytes, max_entry_bytes = None):
+		max_bytes = int(max_bytes)
+		if max_bytes < 1:
+			raise ValueError('Invalid memory tier size: %d' % max_bytes)
+		self.__max_bytes = max_bytes
+		# Keep a few huge pages from flushing everything else.
+		self.__max_entry_bytes = max_entry_bytes if max_entry_bytes is not None else max(max_bytes // 8, 1)
+		self.__records = OrderedDict()
+		self.__lock = Lock()
+		self.__bytes = 0
+		self.__hits = 0
+		self.__misses = 0
+	@property
+	def max_entry_bytes(self):
+		return self.__max_entry_bytes
+	@staticmethod
+	def record_size(record):
+		return len(record.payload) + sum((len(data) for data in record.variants.values()))
+	def __len__(self):
+		with self.__lock:
+			return len(self.__records)
+	@property
+	def bytes(self):
+		with self.__lock:
+			return self.__bytes
+	def get(self, key):
+		with self.__lock:
+			try:
+				record = self.__records.pop(key)
+			except KeyError:
+				return None
+			self.__records[key] = record
+			return record
+	def __make_room(self, size):
+		while self.__records and self.__bytes + size > self.__max_bytes:
+			key, record = self.__records.popitem(last = False)
+			self.__bytes -= self.record_size(record)
+	def put(self, key, record):
+		size = self.record_size(record)
+		if size > self.__max_entry_bytes:
+			return False
+		with self.__lock:
+			previous = self.__records.pop(key, None)
+			if previous is not None:
+				self.__bytes -= self.record_size(previous)
+			self.__make_room(size)
+			self.__records[key] = record
+			self.__bytes += size
+			return True
+	def add_variant(self, key, record, encoding, data):
+		with self.__lock:
+			if self.__records.get(key, None) is not record or encoding in record.variants:
+				return False
+			if self.record_size(record) + len(data) > self.__max_entry_bytes:
+				return False
+			# Keep the record itself out of the way while making room.
+			del self.__records[key]
+			self.__make_room(len(data))
+			record.variants[encoding] = data
+			self.__records[key] = record
+			self.__bytes += len(data)
+			return True
+	def discard(self, key):
+		with self.__lock:
+			record = self.__records.pop(key, None)
+			if record is not None:
+				self.__bytes -= self.record_size(record)
+	def clear(self):
+		with self.__lock:
+			self.__records.clear()
+			self.__bytes = 0
+	def hit(self):
+		with self.__lock:
+			self.__hits += 1
+	def miss(self):
+		with self.__lock:
+			self.__misses += 1
+	@property
+	def hit_ratio(self):
+		with self.__lock:
+			lookups = self.__hits + self.__misses
+			return (self.__hits / lookups) if lookups else 0.0
+	def __str__(self):
+		with self.__lock:
+			lookups = self.__hits + self.__misses
+			return '%d of %d lookups hit (%.1f%%), %d entries in %d bytes' % (self.__hits, lookups, \
+					(100.0 * self.__hits / lookups if lookups else 0.0), len(self.__records), self.__bytes)
+
+
+class MemoryEntry(object):
+	"An entry served from the memory tier, which reads like an Entry"
+	__slots__ = 'record', 'payload', 'name', '__stream',
+	stale_since = None
+	def __init__(self, name, record, payload):
+		self.name = name
+		self.record = record
+		self.payload = payload
+		self.__stream = BytesIO(payload)
+	@property
+	def header(self):
+		return self.record.header
+	@property
+	def content_header(self):
+		return self.record.content_header
+	@property
+	def payload_length(self):
+		return len(self.payload)
+	def read(self, length = None):
+		return self.__stream.read(length)
+	def close(self):
+		pass
+
+
+class CacheStatistics(object):
+	"Hit, miss and eviction counters, in entries and in bytes"
+	Snapshot = namedtuple('Snapshot', ['hits', 'hit_bytes', 'misses', 'miss_bytes', 'evictions', 'evicted_bytes'])
+	__slots__ = '__lock', '__counts',
+	def __init__(self):
+		self.__lock = Lock()
+		self.__counts = [0] * len(self.Snapshot._fields)
+	def __add(self, index, size):
+		with self.__lock:
+			self.__counts[index] += 1
+			self.__counts[index + 1] += size
+	def hit(self, size):
+		self.__add(0, size)
+	def miss(self, size):
+		self.__add(2, size)
+	def evict(self, size):
+		self.__add(4, size)
+	def snapshot(self):
+		with self.__lock:
+			return self.Snapshot(*self.__counts)
+	def drain(self):
+		"Returns the counters and resets them"
+		with self.__lock:
+			snapshot = self.Snapshot(*self.__counts)
+			self.__counts = [0] * len(self.Snapshot._fields)
+			return snapshot
+	def __str__(self):
+		return '%d hits (%d bytes), %d misses (%d bytes), %d evictions (%d bytes)' % self.snapshot()
+
+
+class SharedStatistics(object):
+	"""
+		Entry and byte totals and cache statistics in a small memory-mapped
+		file in the cache root, so every process using the cache shares
+		them.  Updates take an flock on the file for as long as it takes to
+		add to the counters; hits and misses are batched in a
+		CacheStatistics first.
+	"""
+	MAGIC = b'WSSTAT01'
+	fields = ('entries', 'bytes') + CacheStatistics.Snapshot._fields
+	struct_fmt = '=' + 'q' * len(fields)
+	size = len(MAGIC) + struct.calcsize(struct_fmt)
+	FLUSH_THRESHOLD = 64
+	__slots__ = '__file', '__map', '__lock', '__pending', '__pending_count', '__fresh',
+	def __init__(self, path):
+		self.__lock = Lock()
+		self.__pending = CacheStatistics()
+		self.__pending_count = 0
+		self.__file = open(path, 'a+b')
+		try:
+			common.fix_perms(self.__file)
+			fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX)
+			try:
+				self.__file.seek(0)
+				self.__fresh = self.__file.read(len(self.MAGIC)) != self.MAGIC
+				if self.__fresh:
+					self.__file.truncate(0)
+					self.__file.write(self.MAGIC + bytes(self.size - len(self.MAGIC)))
+					self.__file.flush()
+				self.__map = mmap.mmap(self.__file.fileno(), self.size)
+			finally:
+				fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+		except:
+			self.__file.close()
+			raise
+	@property
+	def fresh(self):
+		"Whether the file was created, or found to be unusable, when it was opened"
+		return self.__fresh
+	def close(self):
+		with self.__lock:
+			if self.__map is None:
+				return
+		self.flush()
+		with self.__lock:
+			self.__map.close()
+			self.__map = None
+			self.__file.close()
+	def __read(self):
+		return list(struct.unpack_from(self.struct_fmt, self.__map, len(self.MAGIC)))
+	def __update(self, function):
+		"""
+			Calls function with the counters and writes back what it returns,
+			excluding other threads and other processes meanwhile.
+		"""
+		with self.__lock:
+			if self.__map is None:
+				raise RuntimeError('Statistics have been closed')
+			fcntl.flock(self.__file.fileno(), fcntl.LOCK_EX)
+			try:
+				struct.pack_into(self.struct_fmt, self.__map, len(self.MAGIC), *function(self.__read()))
+			finally:
+				fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+	def __counters(self):
+		with self.__lock:
+			if self.__map is None:
+				raise RuntimeError('Statistics have been closed')
+			fcntl.flock(self.__file.fileno(), fcntl.LOCK_SH)
+			try:
+				return self.__read()
+			finally:
+				fcntl.flock(self.__file.fileno(), fcntl.LOCK_UN)
+	def flush(self):
+		"Adds the batched hits and misses to the shared counters"
+		deltas = self.__pending.drain()
+		with self.__lock:
+			self.__pending_count = 0
+		if any(deltas):
+			self.__update(lambda counters: counters[:2] + [c + d for c, d in zip(counters[2:], deltas)])
+	def __add(self, method, size):
+		method(size)
+		with self.__lock:
+			self.__pending_count += 1
+			full = self.__pending_count >= self.FLUSH_THRESHOLD
+		if full:
+			self.flush()
+	def hit(self, size):
+		self.__add(self.__pending.hit, size)
+	def miss(self, size):
+		self.__add(self.__pending.miss, size)
+	def evict(self, size):
+		self.__pending.evict(size)
+		self.flush()
+	def adjust(self, entries = 0, size = 0):
+		"Adds to the entry and byte totals"
+		def adjust(counters):
+			counters[0] += entries
+			counters[1] += size
+			return counters
+		self.__update(adjust)
+	def set_totals(self, entries, size = None):
+		"Replaces the entry total, and the byte total unless size is None"
+		def set_totals(counters):
+			counters[0] = entries
+			if size is not None:
+				counters[1] = size
+			return counters
+		self.__update(set_totals)
+	@property
+	def entries(self):
+		return self.__counters()[0]
+	@property
+	def bytes(self):
+		return self.__counters()[1]
+	def snapshot(self):
+		self.flush()
+		return CacheStatistics.Snapshot(*self.__counters()[2:])
+	def __str__(self):
+		self.flush()
+		return ('%d entries (%d bytes); %d hits (%d bytes), %d misses (%d bytes), %d evictions (%d bytes)') % tuple(self.__counters())
+
+
+class ScrubCursor(object):
+	"The last directory an incremental scrub finished, kept so it can resume after a restart"
+	__slots__ = '__path',
+	def __init__(self, path):
+		self.__path = path
+	def load(self):
+		try:
+			with open(self.__path, 'r', encoding = 'utf8') as f:
+				return f.read().rstrip('\n') or None
+		except IOError:
+			return None
+	def save(self, directory):
+		fd, temporary = mkstemp(prefix = os.path.basename(self.__path) + '.', dir = dirname(self.__path))
+		try:
+			with os.fdopen(fd, 'w', encoding = 'utf8') as f:
+				common.fix_perms(f)
+				f.write(directory + '\n')
+			os.rename(temporary, self.__path)
+		except:
+			remove(temporary)
+			raise
+	def clear(self):
+		try:
+			remove(self.__path)
+		except OSError:
+			pass
+
+
+class ScrubPass(object):
+	"State of an incremental scrub between time slices"
+	__slots__ = 'walk', 'directory', 'files', 'started', 'seen', 'complete', 'found', 'references',
+	def __init__(self, walk, complete):
+		self.walk = walk
+		self.directory = None
+		self.files = deque()
+		self.started = time()
+		self.seen = set()
+		self.complete = complete
+		self.found = []
+		self.references = set()
 
 
 class EntryWrapper(object):
@@ -99,26 +972,87 @@ class EntryWrapper(object):
 
 
 class Entry(object):
-	__slots__ = '__handle', '__header', '__payload_start', '__active'
-	def __init__(self, handle):
+	"""
+		Entries are locked with flock() rather than lockf(), because flock()
+		locks belong to the open file instead of the process, so they also
+		keep threads of the same process apart.  Readers share the lock and
+		writers hold it exclusively.  Given an object store, entries that
+		refer to an object read their payload from it, while the lock stays
+		on the entry itself.
+	"""
+	__slots__ = '__handle', '__header', '__payload_start', '__active', '__content_header', '__payload_offset', '__exclusive', '__stale_since', '__path_handle', '__objects'
+	def __init__(self, handle, record = None, exclusive = True, objects = None):
+		self.__handle = self.__path_handle = handle
+		self.__objects = objects
+		self.__exclusive = bool(exclusive)
+		self.__stale_since = None
+		fcntl.flock(self.__path_handle.fileno(), fcntl.LOCK_EX if self.__exclusive else fcntl.LOCK_SH)
+		self.__load(record)
+	def __release_object(self):
+		if self.__handle is not self.__path_handle:
+			self.__handle.close()
+			self.__handle = self.__path_handle
+	def __open_object(self):
+		"Follows the header's reference to the object that holds the payload."
+		reference = self.__header.reference
+		try:
+			handle = self.__objects.open(reference)
+		except IOError:
+			LOGGER.debug('Object %s is missing' % reference)
+			self.__active, self.__header = False, None
+			return
+		try:
+			header = EntryHeader.read(handle)
+		except (ValueError, IOError):
+			header = None
+		if header is None or header.checksum != self.__header.checksum or header.fingerprint != self.__header.fingerprint:
+			LOGGER.warning('Object %s does not match its reference' % reference)
+			handle.close()
+			self.__active, self.__header = False, None
+			return
 		self.__handle = handle
-		fcntl.lockf(self.__handle, fcntl.LOCK_EX)
+		self.__header = self.__header.replace(content = header.content, payload_length = header.payload_length, \
+				header_length = header.header_length)
+		self.__payload_start = self.__payload_offset = handle.tell()
+		if header.content is not None:
+			self.__content_header = header.content
+	def __load(self, record = None):
+		self.__content_header = None
+		self.__release_object()
 
 		info = fstat(self.__handle.fileno())
-		self.__active = (info.st_size >= EntryHeader.minsize)
+		if record is not None and info.st_size == record.payload_offset + record.payload_length:
+			# Trust the index instead of parsing the headers again.
+			self.__active = True
+			self.__header, self.__content_header = record.header, record.content_header
+			self.__payload_start, self.__payload_offset = record.header_length, record.payload_offset
+			self.__handle.seek(self.__payload_offset)
+			return
+		self.__active = (info.st_size >= EntryHeader.legacy_minsize)
 
+		self.__handle.seek(0)
 		try:
 			self.__header = EntryHeader.read(self.__handle) if self.__active else None
-		except ValueError:
+		except (ValueError, IOError):
 			self.__active = False
 			self.__header = None
 		self.__payload_start = self.__handle.tell() if self.__active else None
+		self.__payload_offset = self.__payload_start
+		if self.__header is not None and self.__header.content is not None:
+			# Sealed with the processor's header already parsed
+			self.__content_header = self.__header.content
+		if self.__header is not None and self.__header.reference is not None and self.__objects is not None:
+			self.__open_object()
+	@property
+	def exclusive(self):
+		return self.__exclusive
 	def close(self):
-		if self.__handle is not None:
-			utime(self.__handle.fileno())
-			fcntl.lockf(self.__handle, fcntl.LOCK_EX)
-			self.__handle.close()
-			self.__handle = None
+		if self.__path_handle is not None:
+			self.__release_object()
+			utime(self.__path_handle.fileno())
+			fcntl.flock(self.__path_handle.fileno(), fcntl.LOCK_UN)
+			self.__path_handle.close()
+			self.__handle = self.__path_handle = None
 	def __call__(self, outf):
 		copyfileobj(self, outf)
 	def __del__(self):
@@ -134,31 +1068,130 @@ class Entry(object):
 		"Marks the file for truncation and recreation"
 		if not isinstance(header, EntryHeader):
 			raise ValueError('Invalid EntryHeader')
-		self.__header = header
+		self.__release_object()
+		self.__header = header.replace(payload_length = None, header_length = None)
 		self.__handle.seek(0)
 		self.__handle.truncate(0)
 		self.__header.write(self.__handle)
 		self.__handle.flush()
 		self.__payload_start = self.__handle.tell()
+		self.__payload_offset = self.__payload_start
+		self.__content_header = None
 		self.__active = True
+	@property
+	def content_header(self):
+		return self.__content_header
+	@property
+	def stale_since(self):
+		"When the original changed, if this entry is being served while it is re-rendered"
+		return self.__stale_since
+	def mark_stale(self, since):
+		self.__stale_since = since
+	def read_content_header(self, reader):
+		"Parses the processor's header at the start of the payload and skips past it."
+		if self.__header is not None and self.__header.content is not None:
+			self.__content_header = self.__header.content
+			self.__payload_offset = self.__payload_start
+			self.rewind()
+			return self.__content_header
+		self.seek(0)
+		try:
+			self.__content_header = reader(self)
+			self.__payload_offset = self.__handle.tell()
+		except IOError:
+			self.__content_header = None
+			self.__payload_offset = self.__payload_start
+		self.rewind()
+		return self.__content_header
+	def seal(self, reader = None):
+		"""
+			Rewrites the header in place once the payload has been written, so
+			that it records the payload's length and, when the processor's
+			header has an encoding and a MIME type, the content type too.  The
+			processor's header stays where it is, inside the header's padding.
+		"""
+		if not self.__active:
+			raise RuntimeError('Entry is not available for sealing')
+		content = self.__header.content
+		if content is None and reader is not None:
+			content_header = self.read_content_header(reader)
+			if hasattr(content_header, 'encoding') and hasattr(content_header, 'mime'):
+				content = ContentType(content_header.encoding, content_header.mime)
+		header_length = self.__payload_offset if content is not None else self.__payload_start
+		header = self.__header.replace(content = content, header_length = header_length, \
+				payload_length = self.size - header_length)
+		try:
+			if len(header) > header_length:
+				raise ValueError
+		except ValueError:
+			# The processor's header is too short to hold the content type.
+			header_length = self.__payload_start
+			header = self.__header.replace(content = None, header_length = header_length, payload_length = self.size - header_length)
+		self.__handle.seek(0)
+		self.__header = header
+		header.write(self.__handle)
+		self.__handle.flush()
+		if content is not None:
+			self.__payload_start = self.__payload_offset = header_length
+			self.__content_header = content
+		self.rewind()
+	@property
+	def payload_length(self):
+		"Length of the payload after the processor's header"
+		if self.__header is not None and self.__header.payload_length is not None:
+			return self.__header.payload_length - (self.__payload_offset - self.__payload_start)
+		return self.size - self.__payload_offset
+	def record(self, source_stat):
+		if not self.__active:
+			raise RuntimeError('Entry is not available for indexing')
+		size = fstat(self.__handle.fileno()).st_size
+		return IndexRecord(self.__header, self.__content_header, self.__payload_start, \
+				self.__payload_offset, size - self.__payload_offset, source_stat, self.entry_id)
 	def seek(self, pos):
 		if not self.__active:
 			raise RuntimeError('Entry is not available for seeking')
 		self.__handle.seek(self.__payload_start + pos)
+	def rewind(self):
+		"Seeks to the start of the payload, after the processor's header if it has been read."
+		if not self.__active:
+			raise RuntimeError('Entry is not available for seeking')
+		self.__handle.seek(self.__payload_offset)
 	def read(self, length = None):
 		if not self.__active:
 			raise RuntimeError('Entry is not available for reading')
 		return self.__handle.read(length)
 	def write(self, s):
 		return self.__handle.write(s)
+	def flush(self):
+		self.__handle.flush()
 	@property
 	def name(self):
 		return self.__handle.name
 	def fileno(self):
 		return self.__handle.fileno()
+	@property
+	def entry_id(self):
+		"Inode and device of the entry itself, even if its payload is in an object"
+		info = fstat(self.__path_handle.fileno())
+		return info.st_ino, info.st_dev
+	@property
+	def size(self):
+		"Size of the file holding the payload, header included"
+		return fstat(self.__handle.fileno()).st_size
+	@property
+	def content_header_length(self):
+		return self.__payload_offset - self.__payload_start
+	@property
+	def file_position(self):
+		"Absolute position in the entry file, headers included"
+		return self.__handle.tell()
 
 
 class FileLock(object):
+	"""
+		Cache-wide lock.  This uses flock() so that threads of the same process
+		exclude each other, too.
+	"""
 	EXCLUSIVE, SHARED = range(2)
 	__slots__ = '__path', '__mode', '__fd'
 	def __init__(self, path, mode):
@@ -172,12 +1205,52 @@ class FileLock(object):
 	def acquire(self):
 		if self.__mode == self.EXCLUSIVE:
 			self.__fd = open(self.__path, 'wb')
-			fcntl.lockf(self.__fd, fcntl.LOCK_EX)
+			fcntl.flock(self.__fd, fcntl.LOCK_EX)
 		else:
 			self.__fd = open(self.__path, 'rb')
-			fcntl.lockf(self.__fd, fcntl.LOCK_SH)
+			fcntl.flock(self.__fd, fcntl.LOCK_SH)
 	def release(self):
-		fcntl.lockf(self.__fd, fcntl.LOCK_UN)
+		fcntl.flock(self.__fd, fcntl.LOCK_UN)
+		self.__fd.close()
+		self.__fd = None
+	def __enter__(self):
+		self.acquire()
+	def __exit__(self, type, value, tb):
+		self.release()
+
+
+class RenderLock(object):
+	"""
+		Lock file claimed by whichever process is rendering an entry.  The
+		file is unlinked on release, so anybody who was waiting on the old
+		inode notices it is gone and starts over with a fresh file.
+	"""
+	__slots__ = '__path', '__fd'
+	def __init__(self, path):
+		self.__path = path
+		self.__fd = None
+	def acquire(self):
+		while True:
+			fd = open(self.__path, 'ab')
+			try:
+				fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+				try:
+					current = os.stat(self.__path)
+				except OSError:
+					current = None
+				if current is not None and current.st_ino == fstat(fd.fileno()).st_ino:
+					self.__fd, fd = fd, None
+					return
+				LOGGER.debug('Render lock %s was released under us; retrying' % self.__path)
+			finally:
+				if fd is not None:
+					fd.close()
+	def release(self):
+		try:
+			remove(self.__path)
+		except OSError:
+			pass
+		fcntl.flock(self.__fd.fileno(), fcntl.LOCK_UN)
 		self.__fd.close()
 		self.__fd = None
 	def __enter__(self):
@@ -190,19 +1263,40 @@ class NoCache(Exception):
 	pass
 
 
+def copy_shared(handle, outf, blocksize = 16 * 1024):
+	"Copies all of handle to outf with pread(), leaving the shared offset alone"
+	offset = 0
+	data = os.pread(handle.fileno(), blocksize, offset)
+	while data:
+		outf.write(data)
+		offset += len(data)
+		data = os.pread(handle.fileno(), blocksize, offset)
+
+
 class AutoProcess(object):
-	__slots__ = '__inf', '__method', '__header'
-	def __init__(self, header, inf, method):
+	__slots__ = '__inf', '__method', '__header', '__flights', '__key'
+	def __init__(self, header, inf, method, flights = None, key = None):
 		self.__header = header
 		self.__inf = inf
 		self.__method = method
+		self.__flights, self.__key = flights, key
 	@property
 	def header(self):
 		return self.__header
-	def __call__(self, outf):
-		LOGGER.debug('Autprocess executing')
+	def __render(self):
+		output = TemporaryFile('w+b')
 		with self.__inf as inf:
-			return self.__method(inf.handle, outf, False)
+			self.__method(inf.handle, output, False)
+		output.flush()
+		return output
+	def __call__(self, outf):
+		LOGGER.debug('Autoprocess executing')
+		if self.__flights is None:
+			with self.__inf as inf:
+				return self.__method(inf.handle, outf, False)
+		# Everybody asking for this path meanwhile gets a copy of the same run.
+		output = self.__flights(self.__key, self.__render)
+		copy_shared(output, outf)
 	def close(self):
 		pass
 
@@ -217,6 +1311,25 @@ class Cache(object):
 			for fname in fnames:
 				if not fname.startswith('.'):
 					yield path_join(path, fname)
+	TEMPORARY_SUFFIX = '.tmp'
+	VARIANTS = '.variants'
+	OBJECTS = '.objects'
+	# zlib window sizes for each content coding
+	ENCODINGS = {
+		'gzip' : 16 + zlib.MAX_WBITS,
+		'deflate' : zlib.MAX_WBITS,
+	}
+	BLOCKSIZE = 65536
+	@classmethod
+	def find_temporary_files(cls, root):
+		"Yields entries that are being rendered, or whose render was abandoned"
+		for path, dnames, fnames in os.walk(root):
+			filtered_dnames = [d for d in dnames if not d.startswith('.')]
+			del dnames[:]
+			dnames.extend(filtered_dnames)
+			for fname in fnames:
+				if fname.startswith('.') and fname.endswith(cls.TEMPORARY_SUFFIX):
+					yield path_join(path, fname)
 	@staticmethod
 	def find_dirs(root):
 		for path, dnames, fname in os.walk(root, topdown = False):
@@ -227,6 +1340,38 @@ class Cache(object):
 			else:
 				yield path
 	@staticmethod
+	def walk_entries(root, after = None):
+		"""
+			Yields (directory, file names) for every directory in a cache,
+			children first and in sorted order, so that a walk can be resumed
+			after a given directory (relative to root) without listing
+			anything that comes before it.
+		"""
+		after = tuple(after.split(os.path.sep)) if after is not None else None
+		def done(parts):
+			if after is None or parts == after[:len(parts)] and len(parts) < len(after):
+				# Ancestors are finished after their children.
+				return False
+			return parts[:len(after)] == after or parts < after
+		def visit(parts):
+			if done(parts):
+				return
+			directory = path_join(root, *parts)
+			try:
+				names = sorted(os.listdir(directory))
+			except OSError:
+				return
+			fnames = []
+			for name in names:
+				if isdir(path_join(directory, name)):
+					if not name.startswith('.'):
+						for item in visit(parts + (name,)):
+							yield item
+				else:
+					fnames.append(name)
+			yield directory, fnames
+		return visit(())
+	@staticmethod
 	def mkdir_p(root, name):
 		root_parts = root.split(os.path.sep)
 		parts = name.split(os.path.sep)
@@ -243,16 +1388,51 @@ class Cache(object):
 				except OSError:
 					continue
 
-	Options = namedtuple('Options', ['max_age', 'max_entries', 'auto_scrub'])
-	__slots__ = '__root', '__filter_function', '__checksum_function', '__source_root', '__lock', '__known_entry_count', '__options',
-	def __init__(self, root, source_root, checksum_function, filter_function, max_age = None, max_entries = None, auto_scrub = False):
+	Options = namedtuple('Options', ['max_age', 'max_entries', 'auto_scrub', 'max_bytes'])
+	__slots__ = '__root', '__filter_function', '__checksum_function', '__source_root', '__lock', '__options', '__stat_validation', '__index', '__content_header_reader', '__flights', '__stale_while_revalidate', '__scheduler', '__access', '__statistics', '__scrub_pass', '__scrub_cursor', '__encodings', '__memory', '__fingerprint_function', '__sources', '__missing', '__objects',
+	def __init__(self, root, source_root, checksum_function, filter_function, max_age = None, max_entries = None, auto_scrub = False, stat_validation = False, index_entries = None, content_header_reader = None, stale_while_revalidate = None, scheduler = None, max_bytes = None, initial_scrub = True, encodings = (), memory_bytes = None, fingerprint_function = None, missing_entries = None, deduplicate = False, checksum_memo = None):
 		self.__root = root
 		if not isdir(source_root):
 			raise ValueError('Not a directory: %s' % source_root)
 		self.__source_root = source_root
 		self.__checksum_function = checksum_function
 		self.__filter_function = filter_function
-		self.__known_entry_count = None
+		self.__fingerprint_function = fingerprint_function
+		self.__missing = MissingIndex(missing_entries) if missing_entries else None
+		self.__sources = SourceState.shared(source_root, checksum_function, checksum_memo)
+		self.__statistics = None
+		self.__scrub_pass = None
+		self.__stat_validation = bool(stat_validation)
+		self.__content_header_reader = content_header_reader
+		encodings = tuple(encodings or ())
+		for encoding in encodings:
+			if encoding not in self.ENCODINGS:
+				raise ValueError('Unsupported encoding: %s' % encoding)
+		if encodings and content_header_reader is None:
+			LOGGER.warning('Precompressed variants need a content header reader; disabling them for %s' % root)
+			encodings = ()
+		self.__encodings = encodings
+		self.__flights = worker.SingleFlight()
+		if stale_while_revalidate is not None and not isinstance(stale_while_revalidate, timedelta):
+			stale_while_revalidate = timedelta(seconds = stale_while_revalidate)
+		self.__stale_while_revalidate = stale_while_revalidate
+		self.__scheduler = scheduler
+		if stale_while_revalidate is not None and scheduler is None:
+			LOGGER.warning('Stale-while-revalidate needs a scheduler; disabling it for %s' % root)
+			self.__stale_while_revalidate = None
+		self.__index = None
+		self.__access = None
+		self.__memory = None
+		if memory_bytes:
+			if self.__stat_validation:
+				self.__memory = MemoryTier(memory_bytes)
+			else:
+				LOGGER.warning('The memory tier is only used with stat validation; disabling it for %s' % root)
+		if index_entries:
+			if self.__stat_validation:
+				self.__index = HeaderIndex(index_entries)
+			else:
+				LOGGER.warning('The header index is only used with stat validation; disabling it for %s' % root)
 		
 		# Create files
 		if not isdir(root):
@@ -260,6 +1440,8 @@ class Cache(object):
 		common.fix_dir_perms(self.__root)
 		with open(self.lockfile, 'wb') as lockf:
 			common.fix_perms(lockf)
+		self.__statistics = SharedStatistics(path_join(self.__root, '.stats'))
+		self.__objects = ObjectStore(path_join(self.__root, self.OBJECTS)) if deduplicate else None
 
 		# Store options
 		if max_age is not None and not isinstance(max_age, timedelta):
@@ -268,101 +1450,475 @@ class Cache(object):
 			max_entries = int(max_entries)
 			if max_entries < 2:
 				raise ValueError('Invalid number of maximum entries: %d' % max_entries)
+		if max_bytes is not None:
+			max_bytes = int(max_bytes)
+			if max_bytes < 1:
+				raise ValueError('Invalid maximum number of bytes: %d' % max_bytes)
 		auto_scrub = bool(auto_scrub)
-		self.__options = self.Options(max_age, max_entries, auto_scrub)
+		self.__options = self.Options(max_age, max_entries, auto_scrub, max_bytes)
+		if max_age is not None or max_entries is not None or max_bytes is not None:
+			self.__access = AccessIndex(path_join(self.__root, '.access.sqlite'))
+			if self.__statistics.fresh:
+				self.__statistics.set_totals(len(self.__access), self.__access.total_size)
+		self.__scrub_cursor = ScrubCursor(path_join(self.__root, '.scrub-cursor'))
 
 		# Scrub to set up the structures for the first time
-		self.scrub()
+		if initial_scrub:
+			self.scrub()
 	
 	def __enter__(self):
 		return self
 	def __exit__(self, type, value, tb):
 		self.close()
 	def close(self):
-		pass
+		if self.__access is not None:
+			self.__access.close()
+		if self.__statistics is not None:
+			self.__statistics.close()
 	def __str__(self):
 		return 'Cache at %s mirroring original %s' % (self.__root, self.__source_root)
 	def schedule_scrub(self, tentative = False):
 		return self.scrub(tentative)
-	def __get_entry(self, path):
-		path = normpath(path)
-		if any((part.startswith('.') for part in path.split(os.path.sep))):
-			raise ValueError('Path entries cannot start with "."')
-
-		if self.options.auto_scrub and self.options.max_entries is not None:
-			LOGGER.debug('Scheduling a scrub because max_entries=%s and auto_scrub=True' % self.options.max_entries)
-			self.schedule_scrub(True)
-		
-		with FileLock(self.lockfile, FileLock.SHARED):
-			LOGGER.debug('Got original at %s' % path)
-			entry = None
-			try:
-				original_path = normpath(path_join(self.__source_root, path))
-				with filestuff.LockedFile(original_path) as original:
-					LOGGER.debug('Opening entry at %s' % path)
-					cache_path = normpath(path_join(self.__root, path))
-					self.mkdir_p(self.__root, dirname(cache_path))
-					handle = None
-					update = False
-					try:
-						handle = open(cache_path, 'r+b')
-						LOGGER.debug('Entry exists at %s' % path)
-						update = True
-					except IOError:
-						handle = open(cache_path, 'w+b')
-						LOGGER.debug('Entry does not exist at %s' % path)
-						update = False
-					common.fix_perms(handle)
-					entry = Entry(handle)
-
-					header = entry.header
-					new_header = EntryHeader(original.size, True, original.modified, original.checksum(self.__checksum_function))
-					if header is not None and not header.cached:
-						LOGGER.debug('Not cached for %s' % path)
-						if header != new_header:
-							# If anything has changed, update the entry.
-							entry.header = EntryHeader(new_header.size, False, new_header.timestamp, new_header.checksum)
-						# The lock will be acquired after original has been freed
-						return AutoProcess(entry.header, filestuff.LockedFile(original_path), self.__filter_function)
-					if header != new_header:
+	def __indexed_entry(self, path, record):
+		try:
+			source_stat = filestuff.stat_tuple(os.stat(path_join(self.__source_root, path)))
+		except OSError:
+			self.__index.discard(path)
+			return None
+		if source_stat != record.source_stat:
+			LOGGER.debug('Index record for %s is out of date' % path)
+			self.__index.discard(path)
+			return None
+		try:
+			handle = open(path_join(self.__root, path), 'rb')
+		except IOError:
+			self.__index.discard(path)
+			return None
+		info = fstat(handle.fileno())
+		if (info.st_ino, info.st_dev) != record.entry_id:
+			# Replaced by someone else; let the slow path sort it out.
+			LOGGER.debug('Index record for %s names another entry' % path)
+			handle.close()
+			self.__index.discard(path)
+			return None
+		entry = Entry(handle, record, exclusive = False, objects = self.__objects)
+		LOGGER.debug('Index hit for %s' % path)
+		return entry
+	def __fingerprint(self, path):
+		"Identifies the processor that renders path, if the filter function can tell"
+		if self.__fingerprint_function is None:
+			return None
+		return self.__fingerprint_function(path)
+	def __check(self, path, header, original, source_stat, fingerprint, hint = None):
+		"""
+			Returns whether the entry is stale along with a header describing
+			the original.  hint is a header computed earlier for the same
+			original, which is reused if the original still stats the same.
+			Entries rendered by a different processor are stale too.
+		"""
+		if hint is not None and hint.stat_matches(source_stat) and hint.fingerprint == fingerprint:
+			new_header = hint
+		elif self.__stat_validation and header is not None and header.stat_matches(source_stat):
+			# Size, times, inode and device are unchanged, so the checksum is too.
+			LOGGER.debug('Stat unchanged for %s; skipping checksum' % original.name)
+			new_header = EntryHeader(header.size, True, header.timestamp_ns, header.checksum, header.stat, fingerprint = fingerprint)
+		else:
+			new_header = EntryHeader(source_stat.size, True, source_stat.mtime_ns, self.__sources.checksum(path, original, source_stat), \
+					source_stat, fingerprint = fingerprint)
+		return (header is None or not header.same_source(new_header) or header.fingerprint != fingerprint), new_header
+	def __stale_since(self, header, new_header):
+		"""
+			If a cached entry that is out of date may still be served while it
+			is rendered again, returns since when (in nanoseconds) it has been
+			out of date.
+		"""
+		if header is None or not header.cached:
+			return None
+		if header.same_source(new_header):
+			# Only the processor changed, so there is no hurry.
+			if self.__scheduler is None:
+				return None
+			return filestuff.time_ns()
+		if self.__stale_while_revalidate is None:
+			return None
+		if filestuff.time_ns() - new_header.timestamp_ns > self.__stale_while_revalidate.total_seconds() * 1000000000:
+			return None
+		return new_header.timestamp_ns
+	def __lookup(self, path, original_path, cache_path):
+		"""
+			Opens a valid entry under a shared lock.  If it needs rendering,
+			the entry is None and the header describes the original, if known.
+			Entries returned with stale_since set still need rendering.
+		"""
+		with filestuff.LockedFile(original_path) as original:
+			LOGGER.debug('Opening entry at %s' % path)
+			try:
+				handle = open(cache_path, 'rb')
+			except IOError:
+				LOGGER.debug('Entry does not exist at %s' % path)
+				return None, None
+			entry = Entry(handle, exclusive = False, objects = self.__objects)
+			try:
+				source_stat = original.stat
+				stale, new_header = self.__check(path, entry.header, original, source_stat, self.__fingerprint(path))
+				stale_since = self.__stale_since(entry.header, new_header) if stale else None
+				if stale_since is not None:
+					LOGGER.debug('Serving stale entry for %s' % path)
+					entry.mark_stale(stale_since)
+				elif stale:
+					entry.close()
+					return None, new_header
+				if not entry.header.cached:
+					LOGGER.debug('Not cached for %s' % path)
+					entry.close()
+					# The lock will be acquired after original has been freed
+					return AutoProcess(entry.header, filestuff.LockedFile(original_path), self.__filter_function, \
+							self.__flights, ('process', path)), new_header
+				if self.__content_header_reader is not None:
+					entry.read_content_header(self.__content_header_reader)
+				else:
+					entry.seek(0)
+				if self.__index is not None and not stale and entry.header.reference is None:
+					self.__index.put(path, entry.record(source_stat))
+				return entry, new_header
+			except:
+				entry.close()
+				raise
+	def __current_header(self, cache_path):
+		try:
+			handle = open(cache_path, 'rb')
+		except IOError:
+			return None
+		entry = Entry(handle, exclusive = False, objects = self.__objects)
+		try:
+			return entry.header
+		finally:
+			entry.close()
+	def __render(self, path, original_path, cache_path, hint = None, force = False):
+		"""
+			Brings the entry up to date while holding its render lock.  The new
+			entry is written to a temporary file next to it and renamed into
+			place, so readers keep the old inode and never wait on a render.
+			Returns whether the entry was rewritten.
+		"""
+		if not isfile(original_path):
+			raise IOError('%s does not exist' % original_path)
+		self.mkdir_p(self.__root, dirname(cache_path))
+		name = os.path.basename(cache_path)
+		with RenderLock(path_join(dirname(cache_path), '.%s.render' % name)):
+			with filestuff.LockedFile(original_path) as original:
+				header = self.__current_header(cache_path)
+				stale, new_header = self.__check(path, header, original, original.stat, self.__fingerprint(path), hint)
+				if not stale and not force:
+					LOGGER.debug('%s was brought up to date by somebody else' % path)
+					return False
+				fd, temporary = mkstemp(prefix = '.%s.' % name, suffix = self.TEMPORARY_SUFFIX, dir = dirname(cache_path))
+				entry = Entry(os.fdopen(fd, 'w+b'))
+				key = None
+				try:
+					common.fix_perms(entry)
+					if header is not None and not header.cached and header.fingerprint == new_header.fingerprint and not force:
+						# If anything has changed, update the entry.
+						entry.header = new_header.replace(cached = False)
+					elif self.__objects is not None and not force and ObjectStore.key(new_header) in self.__objects:
+						LOGGER.debug('Reusing the render of an identical original for %s' % path)
+						entry.header = new_header.replace(reference = ObjectStore.key(new_header))
+					else:
 						LOGGER.debug('Calling processor for %s' % path)
 						try:
 							entry.header = new_header
 							self.__filter_function(original.handle, entry, True)
+							if self.__objects is not None:
+								key = ObjectStore.key(new_header)
 						except NoCache:
 							LOGGER.debug('%s does not want to be cached' % path)
 							# Flag the entry as no-cache
-							entry.header = EntryHeader(new_header.size, False, new_header.timestamp, new_header.checksum)
-							try:
-								entry.close()
-							except:
-								LOGGER.exception('When closing entry %s' % entry.header)
-							# The lock will be acquired after original has been freed
-							return AutoProcess(entry.header, filestuff.LockedFile(original_path), self.__filter_function)
+							entry.header = new_header.replace(cached = False)
 						except NotImplementedError:
 							# Truncate the entry
 							entry.header = new_header
-					entry.seek(0)
-					if not update:
+					entry.flush()
+					try:
+						previous_size = os.stat(cache_path).st_size + self.__variants_size(path)
+						if header is not None and header.reference is not None:
+							previous_size += self.__objects.size(header.reference)
+					except OSError:
+						previous_size = 0
+					if entry.header.reference is not None:
+						size = entry.size + self.__compress_object(path, entry.header)
+					else:
+						entry.seal(self.__content_header_reader if entry.header.cached else None)
+						# Variants go first; they are only used while they match the entry.
+						size = entry.size + self.__compress(path, entry)
+					if key is not None:
+						# Every path is charged for the whole render it refers to.
+						self.__objects.publish(temporary, key, force)
+						reference = self.__write_reference(cache_path, entry.header.replace(reference = key, content = None))
+						remove(temporary)
+						temporary = reference
+						size += os.stat(reference).st_size
+					os.rename(temporary, cache_path)
+					temporary = None
+					if header is None:
 						LOGGER.debug('Adding new entry for %s' % path)
-						self.__known_entry_count += 1
-					return entry
-			except IOError:
-				print('FOO')
-				if entry is not None:
+					self.__statistics.adjust((1 if header is None else 0), size - previous_size)
+					self.__touch(path, size)
+					return True
+				finally:
 					try:
 						entry.close()
 					except:
-						pass
+						LOGGER.exception('When closing entry %s' % temporary)
+					if temporary is not None:
+						try:
+							remove(temporary)
+						except OSError:
+							pass
+	def __write_reference(self, cache_path, header):
+		"Writes an entry that refers to an object to a temporary file, and returns its name"
+		fd, temporary = mkstemp(prefix = '.%s.' % os.path.basename(cache_path), suffix = self.TEMPORARY_SUFFIX, dir = dirname(cache_path))
+		entry = Entry(os.fdopen(fd, 'w+b'))
+		try:
+			common.fix_perms(entry)
+			entry.header = header
+		except:
+			entry.close()
+			remove(temporary)
+			raise
+		entry.close()
+		return temporary
+	def __compress_object(self, path, header):
+		"""
+			Writes the variants of a path that refers to an existing object.
+			Returns the size of the object and the variants.
+		"""
+		entry = Entry(self.__objects.open(header.reference), exclusive = False)
+		try:
+			if entry.header is None or entry.header.checksum != header.checksum:
+				raise IOError('Object %s is damaged' % header.reference)
+			# Variants describe the path's original, not the object's.
+			return entry.size + self.__compress(path, entry, header.replace(reference = None, content = entry.header.content))
+		finally:
+			entry.close()
+	def __schedule_render(self, path, original_path, cache_path, hint):
+		if ('render', path) in self.__flights:
+			LOGGER.debug('%s is already being rendered' % path)
+			return
+		self.__scheduler(self.__background_render, path, original_path, cache_path, hint)
+	def __background_render(self, path, original_path, cache_path, hint):
+		LOGGER.debug('Rendering %s in the background' % path)
+		try:
+			with FileLock(self.lockfile, FileLock.SHARED):
+				self.__flights(('render', path), self.__render, path, original_path, cache_path, hint)
+		except:
+			LOGGER.exception('When rendering %s in the background' % path)
+	def __upgrade(self, path, cache_path):
+		"""
+			Rewrites an entry in an older format in the current one, copying
+			the payload instead of calling the processor again.  Returns
+			whether the entry was rewritten.
+		"""
+		name = os.path.basename(cache_path)
+		with RenderLock(path_join(dirname(cache_path), '.%s.render' % name)):
+			try:
+				current = Entry(open(cache_path, 'rb'), exclusive = False)
+			except IOError:
+				return False
+			try:
+				if current.header is None or not current.header.legacy:
+					return False
+				LOGGER.debug('Upgrading entry for %s' % path)
+				previous_size = current.size
+				fd, temporary = mkstemp(prefix = '.%s.' % name, suffix = self.TEMPORARY_SUFFIX, dir = dirname(cache_path))
+				entry = Entry(os.fdopen(fd, 'w+b'))
+				try:
+					common.fix_perms(entry)
+					entry.header = current.header
+					copyfileobj(current, entry)
+					entry.flush()
+					entry.seal(self.__content_header_reader if entry.header.cached else None)
+					size = entry.size
+					os.rename(temporary, cache_path)
+					temporary = None
+				finally:
+					entry.close()
+					if temporary is not None:
+						try:
+							remove(temporary)
+						except OSError:
+							pass
+			finally:
+				current.close()
+		self.__statistics.adjust(0, size - previous_size)
+		self.__touch(path, size + self.__variants_size(path))
+		return True
+	def __schedule_upgrade(self, path, cache_path):
+		if self.__scheduler is not None:
+			self.__scheduler(self.__background_upgrade, path, cache_path)
+			return
+		# Already under the cache lock
+		try:
+			self.__flights(('upgrade', path), self.__upgrade, path, cache_path)
+		except:
+			LOGGER.exception('When upgrading %s' % path)
+	def __background_upgrade(self, path, cache_path):
+		try:
+			with FileLock(self.lockfile, FileLock.SHARED):
+				self.__flights(('upgrade', path), self.__upgrade, path, cache_path)
+		except:
+			LOGGER.exception('When upgrading %s' % path)
+	@staticmethod
+	def __normalize(path):
+		path = normpath(path)
+		if any((part.startswith('.') for part in path.split(os.path.sep))):
+			raise ValueError('Path entries cannot start with "."')
+		return path
+	def __auto_scrub(self):
+		if self.options.auto_scrub and (self.options.max_entries is not None or self.options.max_bytes is not None):
+			LOGGER.debug('Scheduling a scrub because max_entries=%s, max_bytes=%s and auto_scrub=True' % (self.options.max_entries, self.options.max_bytes))
+			self.schedule_scrub(True)
+	def render(self, path, force = False):
+		"""
+			Renders an entry ahead of any request for it, if it is stale or
+			force is set.  Returns whether the entry was rewritten.
+		"""
+		path = self.__normalize(path)
+		self.__auto_scrub()
+		original_path = normpath(path_join(self.__source_root, path))
+		cache_path = normpath(path_join(self.__root, path))
+		try:
+			with FileLock(self.lockfile, FileLock.SHARED):
+				return self.__flights(('render', path), self.__render, path, original_path, cache_path, None, force)
+		except IOError:
+			raise KeyError(path)
+	def invalidate(self, path):
+		"""
+			Forgets what is remembered in memory about an original that has
+			just changed, so that it is looked at again.  Entries on disk are
+			checked against their originals anyway.
+		"""
+		path = self.__normalize(path)
+		if self.__index is not None:
+			self.__index.discard(path)
+		if self.__memory is not None:
+			self.__memory.discard(path)
+		if self.__missing is not None:
+			self.__missing.discard(path)
+		self.__sources.discard(path)
+	def __memory_entry(self, path):
+		"""
+			Looks for a record in the memory tier that still matches both the
+			original and the entry file on disk.
+		"""
+		record = self.__memory.get(path)
+		if record is not None:
+			try:
+				source_stat = filestuff.stat_tuple(os.stat(path_join(self.__source_root, path)))
+				info = os.stat(path_join(self.__root, path))
+			except OSError:
+				source_stat = info = None
+			if info is not None and source_stat == record.source_stat and (info.st_ino, info.st_dev) == record.entry_id:
+				self.__memory.hit()
+				self.__statistics.hit(len(record.payload))
+				self.__touch(path)
+				return MemoryEntry(path, record, record.payload)
+			LOGGER.debug('Memory record for %s is out of date' % path)
+			self.__memory.discard(path)
+		self.__memory.miss()
+		return None
+	def __promote(self, path, entry):
+		"""
+			Copies a valid entry into the memory tier, and returns it as a
+			MemoryEntry if it was taken.
+		"""
+		if not isinstance(entry, Entry) or entry.stale_since is not None or entry.content_header is None \
+				or entry.size - entry.file_position > self.__memory.max_entry_bytes:
+			return entry
+		try:
+			source_stat = filestuff.stat_tuple(os.stat(path_join(self.__source_root, path)))
+		except OSError:
+			return entry
+		if not entry.header.stat_matches(source_stat):
+			# Changed since the entry was checked
+			return entry
+		record = MemoryRecord(entry.header, entry.content_header, entry.read(), source_stat, entry.entry_id, {})
+		if not self.__memory.put(path, record):
+			entry.rewind()
+			return entry
+		entry.close()
+		return MemoryEntry(path, record, record.payload)
+	def __remember_missing(self, path):
+		original_path = path_join(self.__source_root, path)
+		if os.path.lexists(original_path):
+			# Unreadable or not a file; it may come and go in other ways.
+			return
+		try:
+			parent, mtime_ns = MissingIndex.nearest_parent(self.__source_root, path)
+		except ValueError:
+			return
+		# The parent may have changed since the original was looked for.
+		if not os.path.lexists(original_path):
+			self.__missing.add(path, parent, mtime_ns)
+	def __get_entry(self, path):
+		path = self.__normalize(path)
+		if self.__missing is not None:
+			if self.__missing.missing(self.__source_root, path):
+				LOGGER.debug('%s is known to be missing' % path)
 				raise KeyError(path)
+			try:
+				return self.__get_present_entry(path)
+			except KeyError:
+				self.__remember_missing(path)
+				raise
+		return self.__get_present_entry(path)
+	def __get_present_entry(self, path):
+		if self.__memory is not None:
+			entry = self.__memory_entry(path)
+			if entry is not None:
+				return entry
+		self.__auto_scrub()
+
+		entry = self.__get_disk_entry(path)
+		if self.__memory is not None:
+			try:
+				entry = self.__promote(path, entry)
 			except:
-				if entry is not None:
-					try:
-						remove(entry.name)
-						entry.close()
-					except:
-						pass
+				entry.close()
 				raise
+		return entry
+	def __get_disk_entry(self, path):
+		with FileLock(self.lockfile, FileLock.SHARED):
+			if self.__index is not None:
+				record = self.__index.get(path)
+				if record is not None:
+					entry = self.__indexed_entry(path, record)
+					if entry is not None:
+						self.__statistics.hit(record.payload_offset + record.payload_length)
+						self.__touch(path)
+						return entry
+			LOGGER.debug('Got original at %s' % path)
+			original_path = normpath(path_join(self.__source_root, path))
+			cache_path = normpath(path_join(self.__root, path))
+			try:
+				rendered = False
+				while True:
+					entry, hint = self.__lookup(path, original_path, cache_path)
+					if entry is not None:
+						if getattr(entry, 'stale_since', None) is not None:
+							self.__schedule_render(path, original_path, cache_path, hint)
+						elif entry.header.legacy:
+							self.__schedule_upgrade(path, cache_path)
+						if isinstance(entry, Entry):
+							(self.__statistics.miss if rendered else self.__statistics.hit)(entry.size)
+						else:
+							self.__statistics.miss(0)
+						self.__touch(path)
+						return entry
+					# Concurrent misses wait for a single render, then look again.
+					self.__flights(('render', path), self.__render, path, original_path, cache_path, hint)
+					rendered = True
+			except IOError:
+				raise KeyError(path)
 	def __getitem__(self, path):
 		return EntryWrapper(path, self.__get_entry)
 	@property
@@ -374,40 +1930,372 @@ class Cache(object):
 	@property
 	def options(self):
 		return self.__options
+	@property
+	def stat_validation(self):
+		return self.__stat_validation
+	@property
+	def index(self):
+		return self.__index
+	@property
+	def stale_while_revalidate(self):
+		return self.__stale_while_revalidate
+	@property
+	def access_index(self):
+		return self.__access
+	@property
+	def statistics(self):
+		return self.__statistics
+	@property
+	def objects(self):
+		return self.__objects
+	@property
+	def memory(self):
+		return self.__memory
+	@property
+	def sources(self):
+		return self.__sources
+	@property
+	def missing(self):
+		return self.__missing
+	def flush(self):
+		"Writes out access records that are being batched"
+		if self.__access is not None:
+			self.__access.flush()
+	def __touch(self, path, size = None):
+		if self.__access is not None:
+			self.__access.touch(path, size)
+	def __discard(self, path):
+		"Forgets about an entry that is being removed, and removes its variants"
+		if self.__index is not None:
+			self.__index.discard(path)
+		if self.__memory is not None:
+			self.__memory.discard(path)
+		if self.__access is not None:
+			self.__access.discard(path)
+		for encoding in self.__encodings:
+			self.__remove_variant(path, encoding)
+	@property
+	def encodings(self):
+		return self.__encodings
+	def variant_path(self, path, encoding):
+		return path_join(self.__root, self.VARIANTS, encoding, path)
+	def __remove_variant(self, path, encoding):
+		fname = self.variant_path(path, encoding)
+		try:
+			remove(fname)
+		except OSError:
+			pass
+		top = path_join(self.__root, self.VARIANTS, encoding)
+		dname = dirname(fname)
+		while normpath(dname) != normpath(top):
+			try:
+				rmdir(dname)
+			except OSError:
+				break
+			dname = dirname(dname)
+	def __variants_size(self, path):
+		size = 0
+		for encoding in self.__encodings:
+			try:
+				size += os.stat(self.variant_path(path, encoding)).st_size
+			except OSError:
+				pass
+		return size
+	def __compress(self, path, entry, header = None):
+		"""
+			Writes a compressed copy of a freshly rendered entry for each
+			configured encoding.  Variants keep the entry header, or header if
+			it is given, and the processor's header as they are, so only the
+			body is compressed.  Returns the number of bytes written.
+		"""
+		if not self.__encodings:
+			return 0
+		if not entry.header.cached or entry.read_content_header(self.__content_header_reader) is None:
+			for encoding in self.__encodings:
+				self.__remove_variant(path, encoding)
+			return 0
+		entry.seek(0)
+		prefix = entry.read(entry.content_header_length)
+		written = 0
+		for encoding in self.__encodings:
+			variant_path = self.variant_path(path, encoding)
+			self.mkdir_p(self.__root, dirname(variant_path))
+			fd, temporary = mkstemp(prefix = '.%s.' % os.path.basename(variant_path), suffix = self.TEMPORARY_SUFFIX, dir = dirname(variant_path))
+			variant = Entry(os.fdopen(fd, 'w+b'))
+			try:
+				common.fix_perms(variant)
+				variant.header = header if header is not None else entry.header
+				variant.write(prefix)
+				compressor = zlib.compressobj(9, zlib.DEFLATED, self.ENCODINGS[encoding])
+				entry.rewind()
+				original_length = compressed_length = 0
+				for block in iter(lambda: entry.read(self.BLOCKSIZE), b''):
+					original_length += len(block)
+					compressed_length += variant.write(compressor.compress(block))
+				compressed_length += variant.write(compressor.flush())
+				variant.flush()
+				variant.seal()
+				if compressed_length >= original_length:
+					LOGGER.debug('%s does not compress with %s' % (path, encoding))
+					self.__remove_variant(path, encoding)
+					continue
+				os.rename(temporary, variant_path)
+				temporary = None
+				written += variant.size
+			finally:
+				variant.close()
+				if temporary is not None:
+					try:
+						remove(temporary)
+					except OSError:
+						pass
+		entry.rewind()
+		return written
+	def open_variant(self, path, entry, encoding):
+		"""
+			Opens the precompressed variant of an open entry, positioned after
+			the processor's header, or returns None if there is no variant
+			matching the entry.
+		"""
+		if encoding not in self.__encodings:
+			return None
+		path = self.__normalize(path)
+		if isinstance(entry, MemoryEntry):
+			data = entry.record.variants.get(encoding, None)
+			if data is not None:
+				return MemoryEntry(path, entry.record, data)
+		try:
+			handle = open(self.variant_path(path, encoding), 'rb')
+		except IOError:
+			return None
+		variant = Entry(handle, exclusive = False)
+		if variant.header is None or entry.header is None or not variant.header.same_source(entry.header) \
+				or variant.read_content_header(self.__content_header_reader) is None:
+			variant.close()
+			return None
+		if isinstance(entry, MemoryEntry):
+			try:
+				data = variant.read()
+			finally:
+				variant.close()
+			self.__memory.add_variant(path, entry.record, encoding, data)
+			return MemoryEntry(path, entry.record, data)
+		return variant
+	def __remove_entry(self, path, size):
+		"Evicts an entry and removes any directories it leaves empty"
+		self.__discard(path)
+		self.__statistics.evict(size)
+		fname = path_join(self.__root, path)
+		try:
+			remove(fname)
+		except OSError:
+			pass
+		dname = dirname(fname)
+		while normpath(dname) != normpath(self.__root):
+			try:
+				rmdir(dname)
+			except OSError:
+				break
+			dname = dirname(dname)
+	def __evict(self):
+		"""
+			Removes expired and least recently used entries using only the
+			access index.  Returns the number of entries and bytes left.
+		"""
+		if self.options.max_age is not None:
+			for path, size in self.__access.older_than(time() - self.options.max_age.total_seconds()):
+				LOGGER.debug('Expiring %s' % path)
+				self.__remove_entry(path, size)
+		ecount = len(self.__access)
+		if self.options.max_entries is not None and ecount >= self.options.max_entries:
+			for path, size in self.__access.oldest(count = ecount - self.options.max_entries + 1):
+				LOGGER.debug('Evicting %s' % path)
+				self.__remove_entry(path, size)
+		total = self.__access.total_size
+		if self.options.max_bytes is not None and total > self.options.max_bytes:
+			for path, size in self.__access.oldest(size = total - self.options.max_bytes):
+				LOGGER.debug('Evicting %s (%d bytes)' % (path, size))
+				self.__remove_entry(path, size)
+		return len(self.__access), self.__access.total_size
+	def __over_budget(self):
+		entries, size = self.__statistics.entries, self.__statistics.bytes
+		if self.options.max_entries is not None and entries >= self.options.max_entries:
+			return True
+		if self.options.max_bytes is not None and size > self.options.max_bytes:
+			return True
+		return False
 	def __len__(self):
 		"Only call this from outside of this class."
 		with FileLock(self.lockfile, FileLock.EXCLUSIVE):
-			return self.__known_entry_count
+			return self.__statistics.entries
+	def __scrub_temporary(self, fname):
+		# Renders in progress hold an exclusive lock on their file.
+		try:
+			with open(fname, 'rb') as temporary:
+				fcntl.flock(temporary.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+				LOGGER.debug('Removing abandoned render %s' % fname)
+				remove(fname)
+		except (IOError, OSError):
+			# Still being rendered, or published in the meantime
+			pass
+	def __scrub_file(self, scrub, fname, cutoff):
+		"""
+			Checks one file for an incremental scrub.  Entries that are in use
+			are skipped rather than waited for.
+		"""
+		if os.path.basename(fname).startswith('.'):
+			if fname.endswith(self.TEMPORARY_SUFFIX):
+				self.__scrub_temporary(fname)
+			return
+		relative = relpath(fname, self.__root)
+		try:
+			handle = open(fname, 'rb')
+		except IOError:
+			return
+		with handle:
+			try:
+				fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+			except IOError:
+				LOGGER.debug('Skipping %s because it is in use' % relative)
+				scrub.seen.add(relative)
+				return
+			info = fstat(handle.fileno())
+			if not isfile(path_join(self.__source_root, relative)):
+				self.__discard(relative)
+				remove(fname)
+			elif cutoff is not None and info.st_mtime < cutoff:
+				self.__discard(relative)
+				self.__statistics.evict(info.st_size)
+				remove(fname)
+			else:
+				scrub.seen.add(relative)
+				size = info.st_size + self.__variants_size(relative) + self.__referenced_size(handle, scrub.references)
+				scrub.found.append((relative, info.st_mtime, size))
+	def __referenced_size(self, handle, references):
+		"""
+			Adds the object an open entry refers to, if any, to references and
+			returns the object's size.
+		"""
+		if self.__objects is None:
+			return 0
+		handle.seek(0)
+		try:
+			reference = EntryHeader.read(handle).reference
+		except (ValueError, IOError):
+			return 0
+		if reference is None:
+			return 0
+		references.add(reference)
+		return self.__objects.size(reference)
+	def __collect_objects(self, references, before):
+		if self.__objects is None:
+			return
+		count, size = self.__objects.collect(references, before)
+		if count:
+			LOGGER.info('Collected %d unreferenced objects (%d bytes) from %s' % (count, size, self))
+	def __finish_scrub_pass(self, scrub, finished = False):
+		"""
+			Records what a slice of an incremental scrub found.  Once a pass
+			that started at the beginning has finished, whatever it did not
+			find is gone.
+		"""
+		finished = finished and scrub.complete
+		if finished:
+			self.__collect_objects(scrub.references, scrub.started)
+		if self.__access is not None:
+			self.__access.ensure(scrub.found)
+			if finished:
+				missing = self.__access.discard_unseen(scrub.seen, scrub.started)
+				LOGGER.debug('Dropped %d missing entries from the access index' % missing)
+			self.__statistics.set_totals(*self.__evict())
+		elif finished:
+			self.__statistics.set_totals(len(scrub.seen))
+		del scrub.found[:]
+	def scrub_slice(self, time_slice):
+		"""
+			Does as much of an incremental scrub as fits in time_slice (a
+			timedelta) while holding the cache lock, and saves the position so
+			that the next slice, or the next process, carries on from there.
+			Returns True when a pass over the whole cache has been finished.
+		"""
+		deadline = monotonic() + time_slice.total_seconds()
+		with FileLock(self.lockfile, FileLock.EXCLUSIVE):
+			scrub = self.__scrub_pass
+			if scrub is None:
+				after = self.__scrub_cursor.load()
+				LOGGER.info('Starting incremental scrub of %s%s' % (self, (' after %s' % after if after else '')))
+				scrub = self.__scrub_pass = ScrubPass(self.walk_entries(self.__root, after), after is None)
+			cutoff = None
+			if self.options.max_age is not None:
+				cutoff = time() - self.options.max_age.total_seconds()
+			finished = None
+			while True:
+				if scrub.files:
+					self.__scrub_file(scrub, path_join(scrub.directory, scrub.files.popleft()), cutoff)
+				else:
+					if scrub.directory is not None and normpath(scrub.directory) != normpath(self.__root):
+						try:
+							rmdir(scrub.directory)
+						except OSError:
+							# Directory is not empty
+							pass
+						finished = scrub.directory
+					try:
+						scrub.directory, fnames = next(scrub.walk)
+						scrub.files.extend(fnames)
+					except StopIteration:
+						self.__finish_scrub_pass(scrub, True)
+						self.__scrub_cursor.clear()
+						self.__scrub_pass = None
+						LOGGER.info('%s: %s' % (self, self.__statistics))
+						return True
+				if monotonic() >= deadline:
+					break
+			self.__finish_scrub_pass(scrub)
+			if finished is not None:
+				self.__scrub_cursor.save(relpath(finished, self.__root))
+			return False
 	def scrub(self, tentative = False):
-		if tentative and self.options.max_entries is not None:
+		if tentative and (self.options.max_entries is not None or self.options.max_bytes is not None):
 			LOGGER.debug('Performing check because tentative = True')
 			with FileLock(self.lockfile, FileLock.SHARED):
-				if self.__known_entry_count < self.options.max_entries:
-					# This is < because when tentative == True, an entry
-					# may be inserted.
+				if not self.__over_budget():
+					# Entry counts are compared with >= because when
+					# tentative == True, an entry may be inserted.
 					return False
-		LOGGER.info('Scrubbing cache %s' % self)
-
 		with FileLock(self.lockfile, FileLock.EXCLUSIVE):
+			if tentative and self.__access is not None:
+				LOGGER.info('Evicting from cache %s' % self)
+				self.__statistics.set_totals(*self.__evict())
+				LOGGER.info('%s: %s' % (self, self.__statistics))
+				return True
+
+			LOGGER.info('Scrubbing cache %s' % self)
+			started = time()
 			entries = []
+			references = set()
 			cutoff = None
 			if self.options.max_age is not None:
-				cutoff = datetime.utcnow().replace(tzinfo = utc) - self.options.max_age
+				cutoff = filestuff.time_ns() - int(self.options.max_age.total_seconds() * 1000000000)
 			for fname in self.find_files(self.__root):
-				with filestuff.ExclusivelyLockedFile(fname) as entry:
+				with filestuff.ExclusivelyFlockedFile(fname) as entry:
 					relative = relpath(fname, self.__root)
 					# Make sure original still exists, deleting cache entry otherwise
 					original = path_join(self.__source_root, relative)
 					if not isfile(original):
+						self.__discard(relative)
 						remove(entry.name)
 						continue
-					timestamp = entry.modified
+					timestamp = entry.modified_ns
 					# Check age
 					if cutoff is not None and timestamp < cutoff:
+						self.__discard(relative)
+						self.__statistics.evict(entry.size)
 						remove(entry.name)
 						continue
 					# Count as entry if it is young enough
-					entries.append((fname, timestamp))
+					size = entry.size + self.__variants_size(relative) + self.__referenced_size(entry.handle, references)
+					entries.append((fname, timestamp, size))
 
 			# Check timestamps when seeing if a file should be deleted in LRU mode
 			#     if they differ, skip that file
@@ -420,18 +2308,32 @@ class Cache(object):
 
 				try:
 					while ecount > 0 and ecount >= self.options.max_entries:
-						fname, timestamp = equeue.get(False)
-						with filestuff.ExclusivelyLockedFile(fname) as entry:
-							if entry.modified > timestamp:
-								equeue.put((fname, timestamp))
+						fname, timestamp, size = equeue.get(False)
+						with filestuff.ExclusivelyFlockedFile(fname) as entry:
+							if entry.modified_ns > timestamp:
+								equeue.put((fname, timestamp, size))
 							else:
+								self.__discard(relpath(fname, self.__root))
+								self.__statistics.evict(entry.size)
 								remove(fname)
 								ecount -= 1
 							equeue.task_done()
 				except Empty:
 					pass
 
+			entries = [entry for entry in entries if isfile(entry[0])]
+			ecount, nbytes = len(entries), sum((size for fname, timestamp, size in entries))
+			if self.__access is not None:
+				# Reconcile the access index with what is actually on disk.
+				self.__access.reset(((relpath(fname, self.__root), timestamp / 1000000000, size) \
+						for fname, timestamp, size in entries))
+				if self.options.max_bytes is not None and nbytes > self.options.max_bytes:
+					ecount, nbytes = self.__evict()
 			
+			for fname in self.find_temporary_files(self.__root):
+				self.__scrub_temporary(fname)
+			self.__collect_objects(references, started)
+
 			for dname in self.find_dirs(self.__root):
 				try:
 					rmdir(dname)
@@ -439,35 +2341,82 @@ class Cache(object):
 					# Directory is not empty
 					continue
 
-			self.__known_entry_count = ecount
+			self.__statistics.set_totals(ecount, nbytes)
+			# This supersedes any incremental scrub.
+			self.__scrub_pass = None
+			self.__scrub_cursor.clear()
+			LOGGER.info('%s: %s' % (self, self.__statistics))
 			return True
 
 class DispatcherCache(Cache):
-	__slots__ = '__worker', '__wlock',
-	def __init__(self, root, source_root, checksum_function, filter_function, max_age = None, max_entries = None, auto_scrub = False):
-		Cache.__init__(self, root, source_root, checksum_function, filter_function, max_age, max_entries, auto_scrub)
+	"""
+		Scrubs on a separate thread.  With a scrub_slice (a timedelta), full
+		scrubs are done incrementally, so the cache is never locked for much
+		longer than that at a time.
+	"""
+	__slots__ = '__worker', '__wlock', '__scrub_slice', '__scrubbing',
+	def __init__(self, *args, scrub_slice = None, **kwargs):
+		if scrub_slice is not None and not isinstance(scrub_slice, timedelta):
+			scrub_slice = timedelta(milliseconds = scrub_slice)
+		self.__scrub_slice = scrub_slice
+		self.__scrubbing = False
 		self.__wlock = Lock()
+		# The worker has to exist before the initial scrub is scheduled.
 		self.__worker = worker.Worker(autostart = True)
+		Cache.__init__(self, *args, **kwargs)
 	def schedule_scrub(self, tentative = False):
-		return self.__worker.schedule(self.scrub)
-	def close(self):
+		return self.__worker.schedule(self.scrub, tentative)
+	def scrub(self, tentative = False):
+		if tentative or self.__scrub_slice is None:
+			return Cache.scrub(self, tentative)
+		with self.__wlock:
+			if not self.__scrubbing and self.__worker is not None:
+				self.__scrubbing = True
+				self.__worker.schedule(self.__scrub_step)
+		return True
+	def __scrub_step(self):
+		try:
+			finished = self.scrub_slice(self.__scrub_slice)
+		except:
+			LOGGER.exception('When scrubbing %s' % self)
+			finished = True
+		with self.__wlock:
+			if finished or self.__worker is None:
+				self.__scrubbing = False
+				return
+		# Give waiting requests a turn at the lock.
+		sleep(self.__scrub_slice.total_seconds())
 		with self.__wlock:
 			if self.__worker is not None:
-				self.__worker.finish()
-				self.__worker.join()
-				self.__worker = None
+				self.__worker.schedule(self.__scrub_step)
+			else:
+				self.__scrubbing = False
+	@property
+	def scrubbing(self):
+		with self.__wlock:
+			return self.__scrubbing
+	def close(self):
+		with self.__wlock:
+			dispatcher, self.__worker = self.__worker, None
+		# Scrub steps take __wlock, so wait for them without holding it.
+		if dispatcher is not None:
+			dispatcher.finish()
+			dispatcher.join()
+		Cache.close(self)
 
 if __name__ == '__main__':
 	import unittest
+	from argparse import ArgumentParser
 	from os import remove, stat
 	from tempfile import TemporaryDirectory, NamedTemporaryFile, mkdtemp
 	from hashlib import md5
 	from codecs import getreader, getwriter
 	from shutil import copyfileobj, rmtree
 	from traceback import print_stack
-	from time import sleep
-
-	logging.basicConfig(level = logging.DEBUG)
+	from time import sleep, monotonic
+	from threading import Thread, Event, Barrier
+	from io import BytesIO
+	import gzip
 
 	def hashstring(s, cksum_type):
 		hasher = cksum_type()
@@ -512,7 +2461,13 @@ if __name__ == '__main__':
 		def test_bad_checksum(self):
 			self.assertRaises(ValueError, EntryHeader, 0, True, self.timestamp, ' ' * (0xFFFF + 1))
 		def test_bad_size(self):
-			self.assertRaises(ValueError, EntryHeader, 0xFFFFFFFF + 1, True, self.timestamp, ' ')
+			self.assertRaises(ValueError, EntryHeader, 0xFFFFFFFFFFFFFFFF + 1, True, self.timestamp, ' ')
+		def test_large_size(self):
+			test = EntryHeader(0xFFFFFFFF + 1, True, self.timestamp, self.FILE_CHECKSUM)
+			with open(self.path, 'wb') as outf:
+				test.write(outf)
+			with open(self.path, 'rb') as inf:
+				self.assertEqual(EntryHeader.read(inf).size, 0xFFFFFFFF + 1)
 		def test_write(self):
 			test = EntryHeader(len(self.FILE_TEXT), True, self.timestamp, self.FILE_CHECKSUM)
 			with open(self.path, 'wb') as outf:
@@ -527,13 +2482,83 @@ if __name__ == '__main__':
 			test2 = None
 			with open(self.path, 'rb') as inf:
 				test2 = EntryHeader.read(inf)
-				self.assertIsNotNone(test2)
+				self.assertIsNotNone(test2)
+				self.assertEqual(inf.read(), self.FILE_TEXT)
+
+			self.assertEqual(len(self.FILE_TEXT), test2.size)
+			self.assertEqual(self.timestamp, test2.timestamp)
+			self.assertTrue(timestamps_equivalent(self.timestamp, test2.timestamp))
+			self.assertEqual(self.FILE_CHECKSUM, test2.checksum)
+			self.assertIsNone(test2.stat)
+		def test_read_stat(self):
+			stat = filestuff.Stat(len(self.FILE_TEXT), 1234567890123456789, 1234567890987654321, 42, 7)
+			test = EntryHeader(len(self.FILE_TEXT), True, self.timestamp, self.FILE_CHECKSUM, stat)
+			with open(self.path, 'wb') as outf:
+				test.write(outf)
+				outf.write(self.FILE_TEXT)
+
+			with open(self.path, 'rb') as inf:
+				test2 = EntryHeader.read(inf)
+				self.assertEqual(inf.read(), self.FILE_TEXT)
+			self.assertEqual(test2.stat, stat)
+			self.assertTrue(test2.stat_matches(stat))
+			self.assertFalse(test2.stat_matches(stat._replace(mtime_ns = stat.mtime_ns + 1)))
+		def test_timestamp_ns(self):
+			test = EntryHeader(len(self.FILE_TEXT), True, 1234567890123456789, self.FILE_CHECKSUM)
+			with TemporaryFile() as outf:
+				test.write(outf)
+				outf.seek(0)
+				test2 = EntryHeader.read(outf)
+			self.assertEqual(test2.timestamp_ns, 1234567890123456789)
+			self.assertEqual(test2.timestamp, datetime(2009, 2, 13, 23, 31, 30, 123456, utc))
+			self.assertEqual(test, test2)
+			self.assertNotEqual(test, test.replace(timestamp = test.timestamp_ns + 1))
+			# As written from a float before nanoseconds were kept
+			self.assertEqual(test, test.replace(timestamp = 1234567890123457000))
+			self.assertNotEqual(test, test.replace(timestamp = 1234567890123458000))
+		def test_read_legacy(self):
+			seconds, microseconds = EntryHeader.datetime2fp(self.timestamp)
+			with open(self.path, 'wb') as outf:
+				outf.write(EntryHeader.LEGACY_MAGIC)
+				outf.write(struct.pack(EntryHeader.legacy_fmt, len(self.FILE_TEXT), True, seconds, microseconds, len(self.FILE_CHECKSUM)))
+				outf.write(self.FILE_CHECKSUM)
+				outf.write(self.FILE_TEXT)
+
+			with open(self.path, 'rb') as inf:
+				test2 = EntryHeader.read(inf)
 				self.assertEqual(inf.read(), self.FILE_TEXT)
-
 			self.assertEqual(len(self.FILE_TEXT), test2.size)
 			self.assertEqual(self.timestamp, test2.timestamp)
-			self.assertTrue(timestamps_equivalent(self.timestamp, test2.timestamp))
 			self.assertEqual(self.FILE_CHECKSUM, test2.checksum)
+			self.assertIsNone(test2.stat)
+			self.assertFalse(test2.stat_matches(None))
+			self.assertTrue(test2.legacy)
+			self.assertFalse(test2.sealed)
+		def test_read_sealed(self):
+			content = ContentType('utf8', 'text/plain')
+			test = EntryHeader(len(self.FILE_TEXT), True, self.timestamp, self.FILE_CHECKSUM, None, content, len(self.FILE_TEXT), 200)
+			with open(self.path, 'wb') as outf:
+				self.assertEqual(test.write(outf), 200)
+				outf.write(self.FILE_TEXT)
+
+			with open(self.path, 'rb') as inf:
+				test2 = EntryHeader.read(inf)
+				self.assertEqual(inf.read(), self.FILE_TEXT)
+			self.assertEqual(test2, test)
+			self.assertFalse(test2.legacy)
+			self.assertEqual(test2.content, content)
+			self.assertEqual(test2.payload_length, len(self.FILE_TEXT))
+			self.assertEqual(test2.header_length, 200)
+		def test_read_fingerprint(self):
+			test = EntryHeader(len(self.FILE_TEXT), True, self.timestamp, self.FILE_CHECKSUM, fingerprint = b'processor')
+			with open(self.path, 'wb') as outf:
+				test.write(outf)
+				outf.write(self.FILE_TEXT)
+			with open(self.path, 'rb') as inf:
+				test2 = EntryHeader.read(inf)
+				self.assertEqual(inf.read(), self.FILE_TEXT)
+			self.assertEqual(test2.fingerprint, b'processor')
+			self.assertRaises(ValueError, EntryHeader, 0, True, self.timestamp, b' ', fingerprint = b' ' * 0x100)
 	
 	class EntryWrapperTest(unittest.TestCase):
 		class MockCache(object):
@@ -643,6 +2668,25 @@ if __name__ == '__main__':
 			finally:
 				entry.close()
 	
+		def test_shared(self):
+			header = EntryHeader(len(self.FILE_TEXT), True, self.timestamp, self.FILE_CHECKSUM)
+			entry = Entry(open(self.path, 'w+b'))
+			try:
+				entry.header = header
+				entry.write(self.FILE_TEXT)
+			finally:
+				entry.close()
+
+			first = Entry(open(self.path, 'rb'), exclusive = False)
+			second = Entry(open(self.path, 'rb'), exclusive = False)
+			try:
+				self.assertFalse(first.exclusive)
+				self.assertEqual(first.read(), self.FILE_TEXT)
+				self.assertEqual(second.read(), self.FILE_TEXT)
+			finally:
+				first.close()
+				second.close()
+
 	class FindTest(unittest.TestCase):
 		def setUp(self):
 			self.tmpdir = mkdtemp()
@@ -724,7 +2768,7 @@ if __name__ == '__main__':
 				tmp.write(test_string)
 			self.assertTrue(isfile(temporary_path))
 			with filestuff.File(temporary_path) as info:
-				header = EntryHeader(info.size, True, info.modified, info.checksum(md5))
+				header = EntryHeader(info.size, True, info.modified_ns, info.checksum(md5))
 
 			with self.cache[temporary] as entry:
 				self.assertEqual(header, entry.header)
@@ -742,7 +2786,7 @@ if __name__ == '__main__':
 				tmp.write(test_string)
 			self.assertTrue(isfile(temporary_path))
 			with filestuff.File(temporary_path) as info:
-				header = EntryHeader(info.size, True, info.modified, info.checksum(md5))
+				header = EntryHeader(info.size, True, info.modified_ns, info.checksum(md5))
 
 			with self.cache[temporary] as entry:
 				self.assertEqual(header, entry.header)
@@ -766,7 +2810,7 @@ if __name__ == '__main__':
 			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
 				tmp.write(test_string)
 			with filestuff.File(temporary_path) as info:
-				header = EntryHeader(info.size, True, info.modified, info.checksum(md5))
+				header = EntryHeader(info.size, True, info.modified_ns, info.checksum(md5))
 
 			with self.cache[temporary] as entry:
 				self.assertEqual(header, entry.header)
@@ -806,7 +2850,7 @@ if __name__ == '__main__':
 				tmp.write(test_string)
 			self.assertTrue(isfile(temporary_path))
 			with filestuff.File(temporary_path) as info:
-				header = EntryHeader(info.size, True, info.modified, info.checksum(md5))
+				header = EntryHeader(info.size, True, info.modified_ns, info.checksum(md5))
 
 			with self.cache[temporary] as entry:
 				self.assertEqual(header, entry.header)
@@ -823,6 +2867,696 @@ if __name__ == '__main__':
 				self.assertEqual('TOUCHED\nfoobar'.encode('ascii'), data)
 			self.assertEqual(self.count, 1)
 			self.assertEqual(len(self.cache), 1)
+	class StatValidationCacheTest(BaseCacheTest):
+		def checksum(self):
+			self.checksums += 1
+			return md5()
+		def get_cache(self, cachedir, tmpdir):
+			self.checksums = 0
+			return Cache(self.cachedir, self.tmpdir, self.checksum, self.process, stat_validation = True)
+		def test_hit_skips_checksum(self):
+			temporary = 'test.txt'
+			temporary_path = path_join(self.tmpdir, temporary)
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+
+			with self.cache[temporary] as entry:
+				self.assertEqual('TOUCHED\nfoobar'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 1)
+			self.assertEqual(self.checksums, 1)
+
+			for i in range(3):
+				with self.cache[temporary] as entry:
+					self.assertEqual('TOUCHED\nfoobar'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 1)
+			self.assertEqual(self.checksums, 1)
+		def test_changed_stat(self):
+			temporary = 'test.txt'
+			temporary_path = path_join(self.tmpdir, temporary)
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			with self.cache[temporary] as entry:
+				pass
+			self.assertEqual(self.checksums, 1)
+
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('barfoo')
+			with filestuff.File(temporary_path) as info:
+				header = EntryHeader(info.size, True, info.modified_ns, info.checksum(md5))
+
+			with self.cache[temporary] as entry:
+				self.assertEqual(header, entry.header)
+				self.assertEqual('TOUCHED\nbarfoo'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 2)
+			self.assertEqual(self.checksums, 2)
+	class HeaderIndexTest(unittest.TestCase):
+		def test_lru(self):
+			index = HeaderIndex(2)
+			index.put('a', 1)
+			index.put('b', 2)
+			self.assertEqual(index.get('a'), 1)
+			index.put('c', 3)
+			self.assertIsNone(index.get('b'))
+			self.assertEqual(index.get('a'), 1)
+			self.assertEqual(index.get('c'), 3)
+			index.discard('a')
+			self.assertIsNone(index.get('a'))
+			self.assertEqual(len(index), 1)
+		def test_invalid(self):
+			self.assertRaises(ValueError, HeaderIndex, 0)
+	class IndexedCacheTest(BaseCacheTest):
+		def read_content_header(self, stream):
+			self.header_reads += 1
+			if stream.read(8) != b'TOUCHED\n':
+				raise IOError
+			return 'touched'
+		def get_cache(self, cachedir, tmpdir):
+			self.header_reads = 0
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, stat_validation = True, \
+					index_entries = 10, content_header_reader = self.read_content_header)
+		def test_index_hit(self):
+			temporary = 'test.txt'
+			temporary_path = path_join(self.tmpdir, temporary)
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+
+			with self.cache[temporary] as entry:
+				self.assertEqual(entry.content_header, 'touched')
+				self.assertEqual(entry.read(), b'foobar')
+			# Once when the entry is sealed, once when it is opened
+			self.assertEqual(self.header_reads, 2)
+			self.assertEqual(len(self.cache.index), 1)
+			record = self.cache.index.get(temporary)
+			self.assertEqual(record.payload_length, len(b'foobar'))
+
+			for i in range(3):
+				with self.cache[temporary] as entry:
+					self.assertIs(entry.header, record.header)
+					self.assertEqual(entry.content_header, 'touched')
+					self.assertEqual(entry.read(), b'foobar')
+			self.assertEqual(self.header_reads, 2)
+			self.assertEqual(self.count, 1)
+		def test_index_replaced(self):
+			temporary = 'test.txt'
+			with open(path_join(self.tmpdir, temporary), 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			with self.cache[temporary] as entry:
+				pass
+			record = self.cache.index.get(temporary)
+
+			# Another writer replaces the entry with one of the same size
+			cache_path = path_join(self.cachedir, temporary)
+			with open(cache_path, 'rb') as f:
+				data = f.read()
+			with open(cache_path + '.new', 'wb') as f:
+				f.write(data.replace(b'foobar', b'raboof'))
+			os.rename(cache_path + '.new', cache_path)
+			with self.cache[temporary] as entry:
+				self.assertIsNot(entry.header, record.header)
+				self.assertEqual(entry.read(), b'raboof')
+			self.assertEqual(self.header_reads, 3)
+			self.assertEqual(self.count, 1)
+		def test_index_invalidated(self):
+			temporary = 'test.txt'
+			temporary_path = path_join(self.tmpdir, temporary)
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			with self.cache[temporary] as entry:
+				pass
+
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobarbaz')
+			with self.cache[temporary] as entry:
+				self.assertEqual(entry.read(), b'foobarbaz')
+			self.assertEqual(self.count, 2)
+			self.assertEqual(self.header_reads, 4)
+
+			remove(temporary_path)
+			self.assertRaises(KeyError, self.cache[temporary].__enter__)
+			self.assertIsNone(self.cache.index.get(temporary))
+	class SealedCacheTest(BaseCacheTest):
+		MIME = b'text/plain'
+		def process(self, inf, outf, cached):
+			self.count += 1
+			outf.write(struct.pack('!BB', 0, len(self.MIME)) + self.MIME)
+			copyfileobj(inf, outf)
+		def read_content_header(self, stream):
+			self.header_reads += 1
+			try:
+				encoding_length, = struct.unpack('!B', stream.read(1))
+				encoding = stream.read(encoding_length).decode('ascii') or None
+				mime_length, = struct.unpack('!B', stream.read(1))
+			except struct.error:
+				raise IOError
+			return ContentType(encoding, stream.read(mime_length).decode('ascii'))
+		def get_cache(self, cachedir, tmpdir):
+			self.header_reads = 0
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, content_header_reader = self.read_content_header)
+		def write(self, name, data):
+			with open(path_join(self.tmpdir, name), 'wb') as tmp:
+				tmp.write(data)
+		def test_sealed(self):
+			temporary = 'test.txt'
+			self.write(temporary, b'foobar')
+			for i in range(3):
+				with self.cache[temporary] as entry:
+					self.assertTrue(entry.header.sealed)
+					self.assertEqual(entry.content_header, ContentType(None, 'text/plain'))
+					self.assertEqual(entry.payload_length, len(b'foobar'))
+					self.assertEqual(entry.read(), b'foobar')
+			# Only when sealing
+			self.assertEqual(self.header_reads, 1)
+			self.assertEqual(self.count, 1)
+		def test_upgrade(self):
+			temporary = 'test.txt'
+			self.write(temporary, b'foobar')
+			with filestuff.File(path_join(self.tmpdir, temporary)) as info:
+				header = EntryHeader(info.size, True, info.modified_ns, info.checksum(md5))
+			seconds, microseconds = EntryHeader.datetime2fp(header.timestamp)
+			with open(path_join(self.cachedir, temporary), 'wb') as outf:
+				outf.write(EntryHeader.LEGACY_MAGIC)
+				outf.write(struct.pack(EntryHeader.legacy_fmt, header.size, True, seconds, microseconds, len(header.checksum)))
+				outf.write(header.checksum)
+				outf.write(struct.pack('!BB', 0, len(self.MIME)) + self.MIME + b'foobar')
+
+			with self.cache[temporary] as entry:
+				self.assertTrue(entry.header.legacy)
+				self.assertEqual(entry.read(), b'foobar')
+			with self.cache[temporary] as entry:
+				self.assertFalse(entry.header.legacy)
+				self.assertEqual(entry.header.content, ContentType(None, 'text/plain'))
+				self.assertEqual(entry.read(), b'foobar')
+			self.assertEqual(self.count, 0)
+	class PublishingCacheTest(BaseCacheTest):
+		def get_cache(self, cachedir, tmpdir):
+			return Cache(self.cachedir, self.tmpdir, md5, self.process)
+		def test_reader_keeps_old_entry(self):
+			temporary = 'test.txt'
+			temporary_path = path_join(self.tmpdir, temporary)
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+
+			with self.cache[temporary] as old:
+				with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+					tmp.write('barfoo')
+				rendered = []
+				def render():
+					with self.cache[temporary] as entry:
+						rendered.append(entry.read())
+				thread = Thread(target = render)
+				thread.start()
+				# The render must not wait for this reader to finish.
+				thread.join(5)
+				self.assertFalse(thread.is_alive())
+				self.assertEqual(rendered, [b'TOUCHED\nbarfoo'])
+				self.assertEqual(old.read(), b'TOUCHED\nfoobar')
+			self.assertEqual(self.count, 2)
+			self.assertEqual(list(Cache.find_temporary_files(self.cachedir)), [])
+		def test_scrub_abandoned(self):
+			abandoned = path_join(self.cachedir, '.test.txt.abcdef' + Cache.TEMPORARY_SUFFIX)
+			with open(abandoned, 'wb') as f:
+				f.write(b'partial')
+			in_progress = path_join(self.cachedir, '.other.txt.abcdef' + Cache.TEMPORARY_SUFFIX)
+			with open(in_progress, 'wb') as f:
+				fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+				self.cache.scrub()
+			self.assertFalse(isfile(abandoned))
+			self.assertTrue(isfile(in_progress))
+	class RenderLockTest(unittest.TestCase):
+		def setUp(self):
+			self.tmpdir = mkdtemp()
+			self.path = path_join(self.tmpdir, '.test.render')
+		def tearDown(self):
+			rmtree(self.tmpdir)
+		def test_release_removes(self):
+			lock = RenderLock(self.path)
+			with lock:
+				self.assertTrue(isfile(self.path))
+			self.assertFalse(isfile(self.path))
+		def test_exclusive(self):
+			acquired = Event()
+			def acquire():
+				with RenderLock(self.path):
+					acquired.set()
+			with RenderLock(self.path):
+				thread = Thread(target = acquire)
+				thread.start()
+				self.assertFalse(acquired.wait(0.2))
+			self.assertTrue(acquired.wait(5))
+			thread.join()
+	class CoalescingCacheTest(BaseCacheTest):
+		THREADS = 5
+		def process(self, inf, outf, cached):
+			with self.lock:
+				self.count += 1
+			sleep(0.3)
+			if not cached or not inf.name.endswith('.nocache'):
+				outf.write('TOUCHED\n'.encode('ascii'))
+				copyfileobj(inf, outf)
+			else:
+				raise NoCache
+		def get_cache(self, cachedir, tmpdir):
+			self.lock = Lock()
+			return Cache(self.cachedir, self.tmpdir, md5, self.process)
+		def run_threads(self, target):
+			barrier = Barrier(self.THREADS)
+			results = []
+			def run():
+				barrier.wait()
+				results.append(target())
+			threads = [Thread(target = run) for i in range(self.THREADS)]
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			return results
+		def test_concurrent_misses(self):
+			temporary = 'test.txt'
+			with open(path_join(self.tmpdir, temporary), 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			def read():
+				with self.cache[temporary] as entry:
+					return entry.read()
+			results = self.run_threads(read)
+			self.assertEqual(results, [b'TOUCHED\nfoobar'] * self.THREADS)
+			self.assertEqual(self.count, 1)
+		def test_concurrent_nocache(self):
+			temporary = 'test.nocache'
+			with open(path_join(self.tmpdir, temporary), 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			with self.cache[temporary] as entry:
+				self.assertIsInstance(entry, AutoProcess)
+			self.assertEqual(self.count, 1)
+
+			entries = []
+			for i in range(self.THREADS):
+				wrapper = self.cache[temporary]
+				entries.append(wrapper.__enter__())
+			def read():
+				outf = BytesIO()
+				entries.pop()(outf)
+				return outf.getvalue()
+			results = self.run_threads(read)
+			self.assertEqual(results, [b'TOUCHED\nfoobar'] * self.THREADS)
+			self.assertEqual(self.count, 2)
+	class MissingCacheTest(BaseCacheTest):
+		def get_cache(self, cachedir, tmpdir):
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, missing_entries = 10)
+		def test_missing(self):
+			temporary = path_join('sub', 'test.txt')
+			for i in range(2):
+				self.assertRaises(KeyError, self.cache[temporary].__enter__)
+			self.assertEqual(len(self.cache.missing), 1)
+			self.assertFalse(isdir(path_join(self.cachedir, 'sub')))
+
+			# Creating the directory changes the parent's modification time.
+			mkdir(path_join(self.tmpdir, 'sub'))
+			with open(path_join(self.tmpdir, temporary), 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			with self.cache[temporary] as entry:
+				self.assertEqual('TOUCHED\nfoobar'.encode('ascii'), entry.read())
+			self.assertEqual(len(self.cache.missing), 0)
+		def test_invalidate(self):
+			self.assertRaises(KeyError, self.cache['test.txt'].__enter__)
+			self.assertEqual(len(self.cache.missing), 1)
+			self.cache.invalidate('test.txt')
+			self.assertEqual(len(self.cache.missing), 0)
+		def test_nearest_parent(self):
+			mkdir(path_join(self.tmpdir, 'sub'))
+			with open(path_join(self.tmpdir, 'sub', 'file'), 'w') as tmp:
+				pass
+			parent, mtime_ns = MissingIndex.nearest_parent(self.tmpdir, path_join('sub', 'file', 'missing', 'test.txt'))
+			self.assertEqual(parent, 'sub')
+			self.assertEqual(mtime_ns, os.stat(path_join(self.tmpdir, 'sub')).st_mtime_ns)
+			self.assertEqual(MissingIndex.nearest_parent(self.tmpdir, 'test.txt')[0], '')
+	class SharedSourceTest(BaseCacheTest):
+		def hasher(self):
+			self.checksums += 1
+			return md5()
+		def get_cache(self, cachedir, tmpdir):
+			self.checksums = 0
+			self.othercachedir = mkdtemp()
+			self.other = Cache(self.othercachedir, self.tmpdir, self.hasher, self.process)
+			return Cache(self.cachedir, self.tmpdir, self.hasher, self.process)
+		def tearDown(self):
+			self.other.close()
+			rmtree(self.othercachedir)
+			BaseCacheTest.tearDown(self)
+		def test_shared(self):
+			self.assertIs(self.cache.sources, self.other.sources)
+			temporary = 'test.txt'
+			temporary_path = path_join(self.tmpdir, temporary)
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			for cache in [self.cache, self.other, self.cache, self.other]:
+				with cache[temporary] as entry:
+					self.assertEqual('TOUCHED\nfoobar'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 2)
+			self.assertEqual(self.checksums, 1)
+
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('barfoo')
+			for cache in [self.cache, self.other]:
+				with cache[temporary] as entry:
+					self.assertEqual('TOUCHED\nbarfoo'.encode('ascii'), entry.read())
+			self.assertEqual(self.checksums, 2)
+		def test_separate(self):
+			cachedir = mkdtemp()
+			cache = Cache(cachedir, self.tmpdir, md5, self.process)
+			try:
+				self.assertIsNot(cache.sources, self.cache.sources)
+			finally:
+				cache.close()
+				rmtree(cachedir)
+	class ChecksumMemoCacheTest(BaseCacheTest):
+		def get_cache(self, cachedir, tmpdir):
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, checksum_memo = path_join(self.cachedir, '.checksums.sqlite'))
+		def test_memo(self):
+			temporary = 'test.txt'
+			with open(path_join(self.tmpdir, temporary), 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			with self.cache[temporary] as entry:
+				checksum = entry.header.checksum
+			memo = self.cache.sources.memo
+			# Just written, so too recent to be recorded.
+			self.assertEqual(len(memo), 0)
+			source_stat = filestuff.stat_tuple(os.stat(path_join(self.tmpdir, temporary)))
+			self.assertTrue(memo.put(source_stat, md5, checksum, now = time() + 10))
+			self.cache.invalidate(temporary)
+			with self.cache[temporary] as entry:
+				self.assertEqual(entry.header.checksum, checksum)
+			self.assertEqual(self.count, 1)
+			# The memo is trusted over the file while the stat matches.
+			self.assertTrue(memo.put(source_stat, md5, b'recorded', now = time() + 10))
+			self.cache.invalidate(temporary)
+			with self.cache[temporary] as entry:
+				self.assertEqual(entry.header.checksum, b'recorded')
+			self.assertEqual(self.count, 2)
+	class FingerprintCacheTest(BaseCacheTest):
+		def schedule(self, func, *args, **kwargs):
+			self.scheduled.append((func, args, kwargs))
+		def get_fingerprint(self, path):
+			return self.fingerprint
+		def get_cache(self, cachedir, tmpdir):
+			self.scheduled = []
+			self.fingerprint = b'one'
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, fingerprint_function = self.get_fingerprint)
+		def test_changed_processor(self):
+			temporary = 'test.txt'
+			with open(path_join(self.tmpdir, temporary), 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			for i in range(2):
+				with self.cache[temporary] as entry:
+					self.assertEqual(entry.header.fingerprint, b'one')
+			self.assertEqual(self.count, 1)
+
+			self.fingerprint = b'two'
+			with self.cache[temporary] as entry:
+				self.assertEqual(entry.header.fingerprint, b'two')
+				self.assertEqual('TOUCHED\nfoobar'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 2)
+		def test_background(self):
+			self.cache.close()
+			self.cache = Cache(self.cachedir, self.tmpdir, md5, self.process, fingerprint_function = self.get_fingerprint, \
+					scheduler = self.schedule)
+			temporary = 'test.txt'
+			with open(path_join(self.tmpdir, temporary), 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			with self.cache[temporary] as entry:
+				pass
+
+			# The old rendering is served until the new one is ready.
+			self.fingerprint = b'two'
+			with self.cache[temporary] as entry:
+				self.assertIsNotNone(entry.stale_since)
+				self.assertEqual(entry.header.fingerprint, b'one')
+			self.assertEqual(self.count, 1)
+			self.assertEqual(len(self.scheduled), 1)
+			func, args, kwargs = self.scheduled.pop()
+			func(*args, **kwargs)
+			self.assertEqual(self.count, 2)
+			with self.cache[temporary] as entry:
+				self.assertIsNone(entry.stale_since)
+				self.assertEqual(entry.header.fingerprint, b'two')
+	class DeduplicatingCacheTest(BaseCacheTest):
+		def read_content_header(self, stream):
+			if stream.read(8) != b'TOUCHED\n':
+				raise IOError
+			return 'touched'
+		def get_cache(self, cachedir, tmpdir):
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, content_header_reader = self.read_content_header, \
+					encodings = ['gzip'], deduplicate = True)
+		def write(self, name, data):
+			with open(path_join(self.tmpdir, name), 'wb') as tmp:
+				tmp.write(data)
+		def objects(self):
+			return sorted((fname for path, dnames, fnames in os.walk(self.cache.objects.root) for fname in fnames))
+		def test_copies(self):
+			data = b'foobar' * 100
+			for name in ['a.txt', 'b.txt']:
+				self.write(name, data)
+			for name in ['a.txt', 'b.txt', 'a.txt']:
+				with self.cache[name] as entry:
+					self.assertEqual(entry.content_header, 'touched')
+					self.assertEqual(entry.payload_length, len(data))
+					self.assertEqual(entry.read(), data)
+					variant = self.cache.open_variant(name, entry, 'gzip')
+					try:
+						self.assertEqual(gzip.decompress(variant.read()), data)
+					finally:
+						variant.close()
+			self.assertEqual(self.count, 1)
+			self.assertEqual(len(self.objects()), 1)
+			self.assertLess(os.stat(path_join(self.cachedir, 'b.txt')).st_size, len(data))
+
+			# A revert finds the old rendering again.
+			self.write('a.txt', b'barfoo')
+			with self.cache['a.txt'] as entry:
+				self.assertEqual(entry.read(), b'barfoo')
+			self.assertEqual(self.count, 2)
+			self.write('a.txt', data)
+			with self.cache['a.txt'] as entry:
+				self.assertEqual(entry.read(), data)
+			self.assertEqual(self.count, 2)
+			self.assertEqual(len(self.cache), 2)
+		def test_collect(self):
+			self.write('a.txt', b'foobar')
+			with self.cache['a.txt'] as entry:
+				pass
+			self.write('a.txt', b'barfoo')
+			with self.cache['a.txt'] as entry:
+				pass
+			self.assertEqual(len(self.objects()), 2)
+			sleep(0.01)
+			self.cache.scrub()
+			self.assertEqual(len(self.objects()), 1)
+			with self.cache['a.txt'] as entry:
+				self.assertEqual(entry.read(), b'barfoo')
+			self.assertEqual(self.count, 2)
+
+			remove(path_join(self.tmpdir, 'a.txt'))
+			sleep(0.01)
+			self.cache.scrub()
+			self.assertEqual(self.objects(), [])
+		def test_missing_object(self):
+			self.write('a.txt', b'foobar')
+			with self.cache['a.txt'] as entry:
+				pass
+			rmtree(self.cache.objects.root)
+			mkdir(self.cache.objects.root)
+			with self.cache['a.txt'] as entry:
+				self.assertEqual(entry.read(), b'foobar')
+			self.assertEqual(self.count, 2)
+			self.assertEqual(len(self.objects()), 1)
+	class StaleWhileRevalidateCacheTest(BaseCacheTest):
+		def schedule(self, func, *args, **kwargs):
+			self.scheduled.append((func, args, kwargs))
+		def run_scheduled(self):
+			while self.scheduled:
+				func, args, kwargs = self.scheduled.pop(0)
+				func(*args, **kwargs)
+		def get_cache(self, cachedir, tmpdir):
+			self.scheduled = []
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, stale_while_revalidate = 60, scheduler = self.schedule)
+		def test_serve_stale(self):
+			temporary = 'test.txt'
+			temporary_path = path_join(self.tmpdir, temporary)
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			with self.cache[temporary] as entry:
+				self.assertIsNone(entry.stale_since)
+				self.assertEqual('TOUCHED\nfoobar'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 1)
+			self.assertEqual(self.scheduled, [])
+
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('barfoo')
+			for i in range(2):
+				with self.cache[temporary] as entry:
+					self.assertIsNotNone(entry.stale_since)
+					self.assertEqual('TOUCHED\nfoobar'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 1)
+			self.assertEqual(len(self.scheduled), 2)
+
+			self.run_scheduled()
+			self.assertEqual(self.count, 2)
+			with self.cache[temporary] as entry:
+				self.assertIsNone(entry.stale_since)
+				self.assertEqual('TOUCHED\nbarfoo'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 2)
+			self.assertEqual(self.scheduled, [])
+		def test_outside_window(self):
+			temporary = 'test.txt'
+			temporary_path = path_join(self.tmpdir, temporary)
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			with self.cache[temporary] as entry:
+				pass
+
+			with open(temporary_path, 'w', encoding = 'ascii') as tmp:
+				tmp.write('barfoo')
+			old = datetime.now().timestamp() - 120
+			utime(temporary_path, (old, old))
+			with self.cache[temporary] as entry:
+				self.assertIsNone(entry.stale_since)
+				self.assertEqual('TOUCHED\nbarfoo'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 2)
+			self.assertEqual(self.scheduled, [])
+	class RenderCacheTest(BaseCacheTest):
+		def get_cache(self, cachedir, tmpdir):
+			return Cache(self.cachedir, self.tmpdir, md5, self.process)
+		def test_render(self):
+			temporary = 'test.txt'
+			with open(path_join(self.tmpdir, temporary), 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar')
+			self.assertTrue(self.cache.render(temporary))
+			self.assertEqual(self.count, 1)
+			self.assertFalse(self.cache.render(temporary))
+			self.assertEqual(self.count, 1)
+			with self.cache[temporary] as entry:
+				self.assertEqual('TOUCHED\nfoobar'.encode('ascii'), entry.read())
+			self.assertEqual(self.count, 1)
+
+			self.assertTrue(self.cache.render(temporary, force = True))
+			self.assertEqual(self.count, 2)
+			self.assertRaises(KeyError, self.cache.render, 'missing.txt')
+	class VariantCacheTest(BaseCacheTest):
+		def read_content_header(self, stream):
+			if stream.read(8) != b'TOUCHED\n':
+				raise IOError
+			return 'touched'
+		def get_cache(self, cachedir, tmpdir):
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, content_header_reader = self.read_content_header, \
+					encodings = ['gzip', 'deflate'])
+		def write(self, name, data):
+			with open(path_join(self.tmpdir, name), 'wb') as tmp:
+				tmp.write(data)
+		def test_variants(self):
+			temporary = 'test.txt'
+			data = b'foobar' * 1000
+			self.write(temporary, data)
+			with self.cache[temporary] as entry:
+				for encoding, decompress in [('gzip', gzip.decompress), ('deflate', zlib.decompress)]:
+					variant = self.cache.open_variant(temporary, entry, encoding)
+					self.assertIsNotNone(variant)
+					try:
+						self.assertEqual(variant.content_header, 'touched')
+						compressed = variant.read()
+						self.assertLess(len(compressed), len(data))
+						self.assertEqual(decompress(compressed), data)
+					finally:
+						variant.close()
+				self.assertIsNone(self.cache.open_variant(temporary, entry, 'br'))
+			self.assertEqual(self.count, 1)
+
+			data = b'barfoo' * 1000
+			self.write(temporary, data)
+			with self.cache[temporary] as entry:
+				variant = self.cache.open_variant(temporary, entry, 'gzip')
+				try:
+					self.assertEqual(gzip.decompress(variant.read()), data)
+				finally:
+					variant.close()
+			self.assertEqual(self.count, 2)
+
+			remove(path_join(self.tmpdir, temporary))
+			self.cache.scrub()
+			self.assertFalse(isfile(self.cache.variant_path(temporary, 'gzip')))
+		def test_incompressible(self):
+			temporary = 'test.dat'
+			self.write(temporary, os.urandom(4096))
+			with self.cache[temporary] as entry:
+				self.assertIsNone(self.cache.open_variant(temporary, entry, 'gzip'))
+			self.assertFalse(isfile(self.cache.variant_path(temporary, 'gzip')))
+		def test_invalid(self):
+			self.assertRaises(ValueError, Cache, self.cachedir, self.tmpdir, md5, self.process, encodings = ['br'])
+	class MemoryTierTest(unittest.TestCase):
+		@staticmethod
+		def record(payload):
+			return MemoryRecord(None, None, payload, None, None, {})
+		def test_lru(self):
+			tier = MemoryTier(32, 16)
+			a, b, c = self.record(b'a' * 12), self.record(b'b' * 12), self.record(b'c' * 12)
+			self.assertTrue(tier.put('a', a))
+			self.assertTrue(tier.put('b', b))
+			self.assertIs(tier.get('a'), a)
+			self.assertTrue(tier.put('c', c))
+			# b was the least recently used
+			self.assertIsNone(tier.get('b'))
+			self.assertIs(tier.get('a'), a)
+			self.assertEqual(tier.bytes, 24)
+			self.assertFalse(tier.put('d', self.record(b'd' * 17)))
+			self.assertEqual(len(tier), 2)
+			self.assertTrue(tier.add_variant('a', a, 'gzip', b'zz'))
+			self.assertFalse(tier.add_variant('a', a, 'gzip', b'zz'))
+			self.assertEqual(tier.bytes, 26)
+			tier.discard('a')
+			self.assertEqual(tier.bytes, 12)
+			self.assertRaises(ValueError, MemoryTier, 0)
+	class MemoryCacheTest(BaseCacheTest):
+		def read_content_header(self, stream):
+			if stream.read(8) != b'TOUCHED\n':
+				raise IOError
+			return 'touched'
+		def get_cache(self, cachedir, tmpdir):
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, stat_validation = True, \
+					content_header_reader = self.read_content_header, memory_bytes = 1 << 20, encodings = ['gzip'])
+		def write(self, name, data):
+			with open(path_join(self.tmpdir, name), 'wb') as tmp:
+				tmp.write(data)
+		def test_memory(self):
+			temporary = 'test.txt'
+			self.write(temporary, b'foobar' * 100)
+			for i in range(3):
+				with self.cache[temporary] as entry:
+					self.assertEqual(entry.content_header, 'touched')
+					self.assertEqual(entry.read(), b'foobar' * 100)
+					if i > 0:
+						self.assertIsInstance(entry, MemoryEntry)
+					variant = self.cache.open_variant(temporary, entry, 'gzip')
+					try:
+						self.assertEqual(gzip.decompress(variant.read()), b'foobar' * 100)
+					finally:
+						variant.close()
+			self.assertEqual(self.count, 1)
+			self.assertEqual(len(self.cache.memory), 1)
+			self.assertEqual(self.cache.memory.bytes, len(b'foobar' * 100) + len(self.cache.memory.get(temporary).variants['gzip']))
+
+			self.write(temporary, b'barfoo' * 200)
+			with self.cache[temporary] as entry:
+				self.assertEqual(entry.read(), b'barfoo' * 200)
+			self.assertEqual(self.count, 2)
+
+			remove(path_join(self.tmpdir, temporary))
+			self.assertRaises(KeyError, self.cache[temporary].__enter__)
+			self.cache.scrub()
+			self.assertEqual(len(self.cache.memory), 0)
+		def test_requires_stat_validation(self):
+			cache = Cache(self.cachedir, self.tmpdir, md5, self.process, memory_bytes = 1024, initial_scrub = False)
+			try:
+				self.assertIsNone(cache.memory)
+			finally:
+				cache.close()
 	class ExpiringCacheTest(BaseCacheTest):
 		def get_cache(self, cachedir, tmpdir):
 			return Cache(self.cachedir, self.tmpdir, md5, self.process, max_age = timedelta(seconds = 1))
@@ -834,7 +3568,7 @@ if __name__ == '__main__':
 				tmp.write(test_string)
 			self.assertTrue(isfile(temporary_path))
 			with filestuff.File(temporary_path) as info:
-				header = EntryHeader(info.size, True, info.modified, info.checksum(md5))
+				header = EntryHeader(info.size, True, info.modified_ns, info.checksum(md5))
 
 			with self.cache[temporary] as entry:
 				self.assertEqual(header, entry.header)
@@ -931,6 +3665,239 @@ if __name__ == '__main__':
 				sleep(0.1)
 			self.assertEqual(self.count, 7)
 			self.assertTrue(len(self.cache) <= 5)
+	class AccessIndexTest(unittest.TestCase):
+		def setUp(self):
+			self.tmpdir = mkdtemp()
+			self.index = AccessIndex(path_join(self.tmpdir, 'index.sqlite'))
+		def tearDown(self):
+			self.index.close()
+			rmtree(self.tmpdir)
+		def test_order(self):
+			self.index.touch('a', 10, 3)
+			self.index.touch('b', 20, 1)
+			self.index.touch('c', 30, 2)
+			self.assertEqual(len(self.index), 3)
+			self.assertEqual(self.index.total_size, 60)
+			self.assertEqual(self.index.oldest(2), [('b', 20), ('c', 30)])
+			self.assertEqual(self.index.older_than(2.5), [('b', 20), ('c', 30)])
+			self.index.touch('b', accessed = 4)
+			self.assertEqual(self.index.oldest(1), [('c', 30)])
+			self.assertEqual(self.index.total_size, 60)
+			self.index.discard('c')
+			self.assertEqual(self.index.oldest(3), [('a', 10), ('b', 20)])
+		def test_oldest_size(self):
+			self.index.touch('a', 10, 1)
+			self.index.touch('b', 20, 2)
+			self.index.touch('c', 30, 3)
+			self.assertEqual(self.index.oldest(size = 10), [('a', 10)])
+			self.assertEqual(self.index.oldest(size = 11), [('a', 10), ('b', 20)])
+			self.assertEqual(self.index.oldest(size = 0), [])
+		def test_unknown_size(self):
+			self.index.touch('a')
+			self.assertEqual(self.index.oldest(1), [('a', 0)])
+		def test_persistent(self):
+			self.index.touch('a', 10, 1)
+			self.index.close()
+			self.index = AccessIndex(path_join(self.tmpdir, 'index.sqlite'))
+			self.assertEqual(self.index.oldest(1), [('a', 10)])
+		def test_upgrade(self):
+			self.index.close()
+			path = path_join(self.tmpdir, 'old.sqlite')
+			with sqlite3.connect(path) as connection:
+				connection.execute('CREATE TABLE Entries(path TEXT PRIMARY KEY, accessed REAL NOT NULL)')
+				connection.execute('INSERT INTO Entries(path, accessed) VALUES(?, ?)', ('a', 1))
+			self.index = AccessIndex(path)
+			self.assertEqual(self.index.oldest(1), [('a', 0)])
+		def test_reset(self):
+			self.index.touch('a', 10, 1)
+			self.index.reset([('b', 2, 20), ('c', 1, 30)])
+			self.assertEqual(self.index.oldest(3), [('c', 30), ('b', 20)])
+	class CacheStatisticsTest(unittest.TestCase):
+		def test_counts(self):
+			statistics = CacheStatistics()
+			statistics.hit(10)
+			statistics.hit(5)
+			statistics.miss(7)
+			statistics.evict(3)
+			self.assertEqual(statistics.snapshot(), CacheStatistics.Snapshot(2, 15, 1, 7, 1, 3))
+			self.assertEqual(statistics.drain(), CacheStatistics.Snapshot(2, 15, 1, 7, 1, 3))
+			self.assertEqual(statistics.snapshot(), CacheStatistics.Snapshot(0, 0, 0, 0, 0, 0))
+	class SharedStatisticsTest(unittest.TestCase):
+		def setUp(self):
+			self.tmpdir = mkdtemp()
+			self.path = path_join(self.tmpdir, '.stats')
+		def tearDown(self):
+			rmtree(self.tmpdir)
+		def test_shared(self):
+			first = SharedStatistics(self.path)
+			self.assertTrue(first.fresh)
+			second = SharedStatistics(self.path)
+			try:
+				self.assertFalse(second.fresh)
+				first.adjust(2, 100)
+				second.adjust(1, -10)
+				self.assertEqual((second.entries, second.bytes), (3, 90))
+				first.hit(10)
+				second.miss(7)
+				# Batched until flushed
+				self.assertEqual(second.snapshot(), CacheStatistics.Snapshot(0, 0, 1, 7, 0, 0))
+				first.flush()
+				second.evict(3)
+				self.assertEqual(first.snapshot(), CacheStatistics.Snapshot(1, 10, 1, 7, 1, 3))
+				first.set_totals(5)
+				self.assertEqual((second.entries, second.bytes), (5, 90))
+			finally:
+				first.close()
+				second.close()
+			third = SharedStatistics(self.path)
+			try:
+				self.assertFalse(third.fresh)
+				self.assertEqual(third.entries, 5)
+			finally:
+				third.close()
+		def test_processes(self):
+			statistics = SharedStatistics(self.path)
+			try:
+				children = []
+				for i in range(4):
+					pid = os.fork()
+					if pid == 0:
+						try:
+							child = SharedStatistics(self.path)
+							for j in range(100):
+								child.adjust(1, 1)
+							child.close()
+						finally:
+							os._exit(0)
+					children.append(pid)
+				for pid in children:
+					os.waitpid(pid, 0)
+				self.assertEqual((statistics.entries, statistics.bytes), (400, 400))
+			finally:
+				statistics.close()
+	class IndexedEvictionTest(BaseCacheTest):
+		class CountingCache(Cache):
+			walks = 0
+			@classmethod
+			def find_files(cls, root):
+				cls.walks += 1
+				return Cache.find_files(root)
+		def get_cache(self, cachedir, tmpdir):
+			self.CountingCache.walks = 0
+			return self.CountingCache(self.cachedir, self.tmpdir, md5, self.process, max_entries = 5, auto_scrub = True)
+		def test_evict_without_walk(self):
+			self.assertEqual(self.CountingCache.walks, 1)
+			infiles = ['%d.txt' % i for i in range(1, 8)]
+			for infile in infiles:
+				with open(path_join(self.tmpdir, infile), 'w', encoding = 'ascii') as f:
+					f.write('FILE=%s' % infile)
+			for infile in infiles:
+				with self.cache[infile] as entry:
+					pass
+				sleep(0.01)
+			with self.cache[infiles[-1]] as entry:
+				pass
+			self.assertEqual(self.count, 7)
+			self.assertEqual(self.CountingCache.walks, 1)
+			self.assertLessEqual(len(self.cache), 5)
+			self.assertFalse(isfile(path_join(self.cachedir, infiles[0])))
+			self.assertTrue(isfile(path_join(self.cachedir, infiles[-1])))
+
+			# A full scrub agrees with the index.
+			self.cache.scrub()
+			self.assertEqual(self.CountingCache.walks, 2)
+			self.assertEqual(len(self.cache.access_index), len(self.cache))
+	class ByteBudgetCacheTest(BaseCacheTest):
+		SIZE = 1000
+		def get_cache(self, cachedir, tmpdir):
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, auto_scrub = True, max_bytes = 3 * self.SIZE)
+		def test_exceed(self):
+			infiles = ['%d.txt' % i for i in range(1, 6)]
+			for infile in infiles:
+				with open(path_join(self.tmpdir, infile), 'w', encoding = 'ascii') as f:
+					f.write('x' * self.SIZE)
+			for infile in infiles:
+				with self.cache[infile] as entry:
+					pass
+				sleep(0.01)
+			with self.cache[infiles[-1]] as entry:
+				entry_size = entry.size
+			self.assertEqual(self.count, 5)
+			self.assertLessEqual(self.cache.access_index.total_size, 3 * self.SIZE)
+			self.assertFalse(isfile(path_join(self.cachedir, infiles[0])))
+			self.assertTrue(isfile(path_join(self.cachedir, infiles[-1])))
+
+			statistics = self.cache.statistics.snapshot()
+			self.assertEqual(statistics.misses, 5)
+			self.assertEqual(statistics.miss_bytes, 5 * entry_size)
+			self.assertEqual(statistics.hits, 1)
+			self.assertEqual(statistics.hit_bytes, entry_size)
+			self.assertEqual(statistics.evictions, 3)
+			self.assertEqual(statistics.evicted_bytes, 3 * entry_size)
+
+			self.cache.scrub()
+			self.assertEqual(self.cache.access_index.total_size, 2 * entry_size)
+	class WalkEntriesTest(unittest.TestCase):
+		def setUp(self):
+			self.tmpdir = mkdtemp()
+			for dname in ['a/x', 'a/y', 'b', '.hidden']:
+				os.makedirs(path_join(self.tmpdir, dname))
+			for fname in ['a/x/1', 'a/2', 'b/3', '4', '.hidden/5']:
+				with open(path_join(self.tmpdir, fname), 'wb'):
+					pass
+		def tearDown(self):
+			rmtree(self.tmpdir)
+		def walk(self, after = None):
+			return [(relpath(dname, self.tmpdir), fnames) for dname, fnames in Cache.walk_entries(self.tmpdir, after)]
+		def test_order(self):
+			self.assertEqual(self.walk(), [('a/x', ['1']), ('a/y', []), ('a', ['2']), ('b', ['3']), ('.', ['4'])])
+		def test_resume(self):
+			self.assertEqual(self.walk('a/x'), [('a/y', []), ('a', ['2']), ('b', ['3']), ('.', ['4'])])
+			self.assertEqual(self.walk('a'), [('b', ['3']), ('.', ['4'])])
+			self.assertEqual(self.walk('aa'), [('b', ['3']), ('.', ['4'])])
+			self.assertEqual(self.walk('b'), [('.', ['4'])])
+	class IncrementalScrubTest(BaseCacheTest):
+		def get_cache(self, cachedir, tmpdir):
+			return Cache(self.cachedir, self.tmpdir, md5, self.process, max_entries = 10)
+		def populate(self):
+			self.infiles = [path_join(dname, '%d.txt' % i) for dname in ['a', 'b', 'c'] for i in range(2)]
+			for infile in self.infiles:
+				os.makedirs(path_join(self.tmpdir, dirname(infile)), exist_ok = True)
+				with open(path_join(self.tmpdir, infile), 'w', encoding = 'ascii') as f:
+					f.write('FILE=%s' % infile)
+				with self.cache[infile] as entry:
+					pass
+			rmtree(path_join(self.tmpdir, 'b'))
+			remove(path_join(self.tmpdir, self.infiles[0]))
+		def test_slices(self):
+			self.populate()
+			cursor = path_join(self.cachedir, '.scrub-cursor')
+			slices, cursors = 0, set()
+			while not self.cache.scrub_slice(timedelta(0)):
+				slices += 1
+				if isfile(cursor):
+					with open(cursor, 'r', encoding = 'utf8') as f:
+						cursors.add(f.read().strip())
+			self.assertGreater(slices, len(self.infiles))
+			self.assertEqual(cursors, {'a', 'b', 'c'})
+			self.assertFalse(isfile(cursor))
+
+			self.assertFalse(isfile(path_join(self.cachedir, self.infiles[0])))
+			self.assertTrue(isfile(path_join(self.cachedir, self.infiles[1])))
+			self.assertFalse(isdir(path_join(self.cachedir, 'b')))
+			self.assertEqual(len(self.cache), 3)
+			self.assertEqual(len(self.cache.access_index), 3)
+		def test_dispatcher(self):
+			self.populate()
+			self.cache.close()
+			self.cache = DispatcherCache(self.cachedir, self.tmpdir, md5, self.process, max_entries = 10, scrub_slice = 1)
+			for i in range(100):
+				if not self.cache.scrubbing:
+					break
+				sleep(0.05)
+			self.assertFalse(self.cache.scrubbing)
+			self.assertFalse(isdir(path_join(self.cachedir, 'b')))
+			self.assertEqual(len(self.cache), 3)
 	class DispatcherCacheTest(BaseCacheTest):
 		def get_cache(self, cachedir, tmpdir):
 			return DispatcherCache(self.cachedir, self.tmpdir, md5, self.process, max_entries = 5, auto_scrub = True)
@@ -972,4 +3939,47 @@ if __name__ == '__main__':
 			# Wait for thread to do its business
 			sleep(0.5)
 			self.assertTrue(len(self.cache) <= 5)
-	unittest.main()
+
+	def benchmark(counts, hits, stream_time):
+		"Reports how hits on one entry scale with the number of threads streaming it"
+		tmpdir, cachedir = mkdtemp(), mkdtemp()
+		def process(inf, outf, cached):
+			copyfileobj(inf, outf)
+		def stream(path):
+			for i in range(hits):
+				with cache[path] as entry:
+					entry.read()
+					# Stands in for a slow client on the other end.
+					sleep(stream_time)
+		cache = Cache(cachedir, tmpdir, md5, process)
+		try:
+			with open(path_join(tmpdir, 'test.txt'), 'w', encoding = 'ascii') as tmp:
+				tmp.write('foobar' * 1024)
+			with cache['test.txt'] as entry:
+				pass
+			for count in counts:
+				threads = [Thread(target = stream, args = ('test.txt',)) for i in range(count)]
+				start = monotonic()
+				for thread in threads:
+					thread.start()
+				for thread in threads:
+					thread.join()
+				elapsed = monotonic() - start
+				print('%d thread(s): %d hits in %.3fs (%.1f hits/s)' % (count, count * hits, elapsed, count * hits / elapsed))
+		finally:
+			cache.close()
+			rmtree(cachedir)
+			rmtree(tmpdir)
+
+	parser = ArgumentParser(description = 'Runs the tests, or measures how concurrent hits on an entry scale')
+	parser.add_argument('--benchmark', dest = 'benchmark', action = 'store_true', default = False, help = 'Report hits/s for each number of threads instead of running the tests')
+	parser.add_argument('--threads', dest = 'threads', nargs = '+', metavar = 'COUNT', type = int, default = [1, 2, 4, 8], help = 'Numbers of threads to benchmark')
+	parser.add_argument('--hits', dest = 'hits', metavar = 'COUNT', type = int, default = 10, help = 'Hits per thread')
+	parser.add_argument('--stream-time', dest = 'stream_time', metavar = 'SECONDS', type = float, default = 0.01, help = 'How long each hit holds the entry open')
+	args, remaining = parser.parse_known_args()
+	if args.benchmark:
+		logging.basicConfig(level = logging.WARNING)
+		benchmark(args.threads, args.hits, args.stream_time)
+	else:
+		logging.basicConfig(level = logging.DEBUG)
+		unittest.main(argv = sys.argv[:1] + remaining)
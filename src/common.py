@@ -24,3 +24,9 @@ def fix_perms(handle):
 		info = os.stat(handle)
 		if (info.st_mode & allbits) != file_perms:
 			os.chmod(handle, file_perms)
+# What the dbm modules behind shelve may add to a database path
+DBM_SUFFIXES = ('', '.db', '.dat', '.dir', '.bak', '.pag')
+def fix_db_perms(path):
+	for suffix in DBM_SUFFIXES:
+		if os.path.isfile(path + suffix):
+			fix_perms(path + suffix)
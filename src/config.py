@@ -18,6 +18,8 @@ def positive_int(value):
 	return value
 
 class Configuration(object):
+	# Where processors run; the first is the default
+	BACKENDS = ('thread', 'process')
 	@staticmethod
 	def xpath_single(document, xpath, nsmap = None):
 		matches = document.xpath(xpath, namespaces = nsmap)
@@ -50,9 +52,17 @@ class Configuration(object):
 			except KeyError:
 				pass
 
+			backend = self.BACKENDS[0]
+			try:
+				backend = child.attrib['backend'].strip()
+			except KeyError:
+				pass
+			if backend not in self.BACKENDS:
+				raise ValueError('Invalid processor backend: %s' % backend)
+
 			proc = None
-			if (name, mime) in procs:
-				proc = procs[name, mime]
+			if (name, mime, backend) in procs:
+				proc = procs[name, mime, backend]
 			else:
 				if mime is not None:
 					try:
@@ -62,8 +72,14 @@ class Configuration(object):
 						mime = none
 				if proc is None:
 					proc = processors.get_processor(name)(self.encoding)
-
-				procs[name, mime] = proc
+				# Worked out here so that requests only look it up
+				proc.fingerprint
+				if backend == 'process':
+					if self.process_backend is None:
+						self.process_backend = processors.ProcessBackend(self.processes)
+					proc = processors.OutOfProcess(proc, self.process_backend)
+
+				procs[name, mime, backend] = proc
 			if proc is None:
 				raise RuntimeError
 			if extensions:
@@ -95,6 +111,12 @@ class Configuration(object):
 		except KeyError:
 			self.worker_threads = 1
 
+		self.watch = bool(document.xpath('/configuration/watch'))
+		try:
+			self.watch_interval = timedelta(seconds = positive_int(self.xpath_single(document, '/configuration/watch/@poll-interval')))
+		except KeyError:
+			self.watch_interval = None
+
 		self.cache_dir = self.get_path(dirname(stream.name), self.xpath_single(document, '/configuration/cache/@dir').strip())
 		self.checksum_function = hashers.get_hasher( \
 			self.xpath_single(document, '/configuration/cache/checksum-function/text()').strip())
@@ -117,8 +139,39 @@ class Configuration(object):
 		except KeyError:
 			self.max_entries = None
 
+		try:
+			self.max_bytes = positive_int(self.xpath_single(document, '/configuration/cache/max-bytes/text()'))
+		except KeyError:
+			self.max_bytes = None
+
+		try:
+			self.index_entries = positive_int(self.xpath_single(document, '/configuration/cache/index-entries/text()'))
+		except KeyError:
+			self.index_entries = None
+
+		try:
+			self.missing_entries = positive_int(self.xpath_single(document, '/configuration/cache/missing-entries/text()'))
+		except KeyError:
+			self.missing_entries = None
+
+		try:
+			self.stale_while_revalidate = timedelta(seconds = positive_int(self.xpath_single(document, '/configuration/cache/stale-while-revalidate/@seconds')))
+		except KeyError:
+			self.stale_while_revalidate = None
+
 		self.auto_scrub = bool(document.xpath('/configuration/cache/auto-scrub'))
 		self.send_etags = bool(document.xpath('/configuration/cache/send-etags'))
+		self.stat_validation = bool(document.xpath('/configuration/cache/stat-validation'))
+		self.deduplicate = bool(document.xpath('/configuration/cache/deduplicate'))
+		self.checksum_memo = bool(document.xpath('/configuration/cache/checksum-memo'))
+		try:
+			self.precompress = tuple(self.xpath_single(document, '/configuration/cache/precompress/text()').split())
+		except KeyError:
+			self.precompress = ()
+		try:
+			self.memory_bytes = positive_int(self.xpath_single(document, '/configuration/cache/memory-cache/@bytes'))
+		except KeyError:
+			self.memory_bytes = None
 
 
 		# Search cache
@@ -138,9 +191,18 @@ class Configuration(object):
 
 
 		self.dispatcher_thread = bool(document.xpath('/configuration/cache/dispatcher-thread'))
+		try:
+			self.scrub_slice = timedelta(milliseconds = positive_int(self.xpath_single(document, '/configuration/cache/dispatcher-thread/@scrub-slice')))
+		except KeyError:
+			self.scrub_slice = None
 
 		self.encoding = self.xpath_single(document, '/configuration/processors/encoding/text()')
 
+		try:
+			self.processes = positive_int(self.xpath_single(document, '/configuration/processors/@processes'))
+		except KeyError:
+			self.processes = None
+		self.process_backend = None
 		self.processors = {}
 		self.processors.update(self.include_processors(self.xpath_single(document, '/configuration/processors'), stream.name))
 
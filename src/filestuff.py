@@ -4,16 +4,86 @@ if sys.version_info < (3, 3):
 	raise RuntimeError('At least Python 3.3 is required')
 
 import os.path
-from os.path import normpath
+from os.path import normpath, join as path_join
 import fcntl
 from datetime import datetime
 from os import fstat
 from pytz import utc
-import logging
+from collections import namedtuple
+from threading import Lock
+from time import time
+import logging, sqlite3
+import hashers, common
 
 
 LOGGER = logging.getLogger(__name__)
 
+Stat = namedtuple('Stat', ['size', 'mtime_ns', 'ctime_ns', 'inode', 'device'])
+
+try:
+	from time import time_ns
+except ImportError:
+	# Before Python 3.7
+	def time_ns():
+		return int(time() * 1000000000)
+
+def ns2datetime(ns):
+	"Timestamps are kept as integer nanoseconds; this is for formatting them."
+	seconds, ns = divmod(ns, 1000000000)
+	return datetime.utcfromtimestamp(seconds).replace(microsecond = ns // 1000, tzinfo = utc)
+
+def stat_tuple(info):
+	return Stat(info.st_size, info.st_mtime_ns, info.st_ctime_ns, info.st_ino, info.st_dev)
+
+class ChecksumMemo(object):
+	"""
+		Persistent record of checksums by the identity and stat of the file
+		they were computed from, so that a restart or a new cache does not
+		read every original again.  One row is kept per file and algorithm;
+		it is only used while the size and both timestamps still match.
+	"""
+	# Files changed this recently may change again within the timestamp
+	# granularity without their stat changing, so they are not recorded.
+	RACY_SECONDS = 2
+	__slots__ = '__connection', '__lock', '__names', '__racy_ns',
+	def __init__(self, path, racy_seconds = RACY_SECONDS):
+		self.__racy_ns = int(racy_seconds * 1000000000)
+		self.__lock = Lock()
+		self.__names = {}
+		self.__connection = sqlite3.connect(path, timeout = 60, check_same_thread = False)
+		common.fix_perms(path)
+		with self.__connection:
+			self.__connection.execute('CREATE TABLE IF NOT EXISTS Checksums(device INTEGER NOT NULL, inode INTEGER NOT NULL, algorithm TEXT NOT NULL, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, ctime_ns INTEGER NOT NULL, checksum BLOB NOT NULL, PRIMARY KEY(device, inode, algorithm))')
+	def close(self):
+		with self.__lock:
+			if self.__connection is not None:
+				self.__connection.close()
+				self.__connection = None
+	def __del__(self):
+		self.close()
+	def __name(self, cksum_type):
+		name = self.__names.get(cksum_type, None)
+		if name is None:
+			name = self.__names[cksum_type] = cksum_type().name
+		return name
+	def get(self, info, cksum_type):
+		"Returns the recorded checksum for a Stat, or None"
+		with self.__lock:
+			row = self.__connection.execute('SELECT checksum FROM Checksums WHERE device = ? AND inode = ? AND algorithm = ? AND size = ? AND mtime_ns = ? AND ctime_ns = ?', (info.device, info.inode, self.__name(cksum_type), info.size, info.mtime_ns, info.ctime_ns)).fetchone()
+		return None if row is None else bytes(row[0])
+	def put(self, info, cksum_type, checksum, now = None):
+		if now is None:
+			now = time()
+		if max(info.mtime_ns, info.ctime_ns) > int(now * 1000000000) - self.__racy_ns:
+			return False
+		with self.__lock:
+			with self.__connection:
+				self.__connection.execute('INSERT OR REPLACE INTO Checksums(device, inode, algorithm, size, mtime_ns, ctime_ns, checksum) VALUES(?, ?, ?, ?, ?, ?, ?)', (info.device, info.inode, self.__name(cksum_type), info.size, info.mtime_ns, info.ctime_ns, checksum))
+		return True
+	def __len__(self):
+		with self.__lock:
+			return self.__connection.execute('SELECT COUNT(*) FROM Checksums').fetchone()[0]
+
 class _BaseFile(object):
 	@property
 	def name(self):
@@ -21,12 +91,15 @@ class _BaseFile(object):
 	def fileno(self):
 		raise NotImplementedError
 	@property
+	def modified_ns(self):
+		raise NotImplementedError
+	@property
 	def modified(self):
 		raise NotImplementedError
 	@property
 	def size(self):
 		raise NotImplementedError
-	def checksum(self, cksum_type):
+	def checksum(self, cksum_type, memo = None):
 		raise NotImplementedError
 	@property
 	def handle(self):
@@ -40,7 +113,6 @@ class BaseFile(object):
 
 class _File(object):
 	__slots__ = '__fd',
-	BLOCKSIZE = 4096
 	def __init__(self, fd):
 		self.__fd = fd
 	@property
@@ -49,9 +121,11 @@ class _File(object):
 	def fileno(self):
 		return self.__fd.fileno()
 	@property
+	def modified_ns(self):
+		return fstat(self.__fd.fileno()).st_mtime_ns
+	@property
 	def modified(self):
-		info = fstat(self.__fd.fileno())
-		return datetime.utcfromtimestamp(info.st_mtime).replace(tzinfo = utc)
+		return ns2datetime(self.modified_ns)
 	@property
 	def timestamp(self):
 		return self.modified
@@ -59,17 +133,20 @@ class _File(object):
 	def size(self):
 		info = fstat(self.__fd.fileno())
 		return info.st_size
-	def checksum(self, cksum_type):
-		hasher = cksum_type()
-		self.__fd.seek(0)
-		try:
-			data = self.__fd.read(self.BLOCKSIZE)
-			while data:
-				hasher.update(data)
-				data = self.__fd.read(self.BLOCKSIZE)
-			return hasher.digest()
-		finally:
-			self.__fd.seek(0)
+	@property
+	def stat(self):
+		return stat_tuple(fstat(self.__fd.fileno()))
+	def checksum(self, cksum_type, memo = None):
+		if memo is None:
+			return hashers.checksum_file(self.__fd, cksum_type)
+		info = self.stat
+		checksum = memo.get(info, cksum_type)
+		if checksum is None:
+			checksum = hashers.checksum_file(self.__fd, cksum_type)
+			# Only record it if the file did not change while being read.
+			if self.stat == info:
+				memo.put(info, cksum_type, checksum)
+		return checksum
 	@property
 	def handle(self):
 		return self.__fd
@@ -121,10 +198,29 @@ class ExclusivelyLockedFile(File):
 		self.fd = None
 		LOGGER.debug('Closed exclusively locked file %s' % self.path)
 
+class ExclusivelyFlockedFile(File):
+	"""
+		Uses flock() instead of lockf(), so the lock belongs to this open file
+		rather than to the process and excludes other threads too.
+	"""
+	def __enter__(self):
+		LOGGER.debug('Opening exclusively flocked file %s' % self.path)
+		self.fd = open(self.path, 'r+b')
+		fcntl.flock(self.fd.fileno(), fcntl.LOCK_EX)
+		return _File(self.fd)
+	def __exit__(self, type, value, tb):
+		LOGGER.debug('Closing exclusively flocked file %s closed=%s' % (self.path, self.fd.closed))
+		self.fd.flush()
+		fcntl.flock(self.fd.fileno(), fcntl.LOCK_UN)
+		self.fd.close()
+		self.fd = None
+		LOGGER.debug('Closed exclusively flocked file %s' % self.path)
+
 if __name__ == '__main__':
 	import unittest
 	from os import remove, stat
-	from tempfile import NamedTemporaryFile
+	from tempfile import NamedTemporaryFile, mkdtemp
+	from shutil import rmtree
 	from hashlib import md5
 	from dateutil.tz import tzlocal
 
@@ -143,7 +239,8 @@ if __name__ == '__main__':
 			with NamedTemporaryFile(delete = False) as tmp:
 				self.path = tmp.name
 				tmp.write(self.FILE_TEXT)
-			self.mtime = datetime.fromtimestamp(stat(self.path).st_mtime).replace(tzinfo = localtz).astimezone(utc)
+			self.mtime_ns = stat(self.path).st_mtime_ns
+			self.mtime = datetime.fromtimestamp(self.mtime_ns // 1000000000).replace(microsecond = self.mtime_ns % 1000000000 // 1000, tzinfo = localtz).astimezone(utc)
 		def tearDown(self):
 			remove(self.path)
 		def test_file_basic(self):
@@ -154,6 +251,16 @@ if __name__ == '__main__':
 				self.assertEqual(info.size, len(self.FILE_TEXT))
 				self.assertEqual(info.modified, self.mtime)
 				self.assertEqual(info.checksum(md5), self.FILE_CHECKSUM)
+		def test_file_modified_ns(self):
+			os.utime(self.path, ns = (1, 1234567890123456789))
+			with File(self.path) as info:
+				self.assertEqual(info.modified_ns, 1234567890123456789)
+				self.assertEqual(info.modified, datetime(2009, 2, 13, 23, 31, 30, 123456, utc))
+		def test_file_stat(self):
+			expected = stat_tuple(stat(self.path))
+			with File(self.path) as info:
+				self.assertEqual(info.stat, expected)
+				self.assertEqual(info.stat.size, len(self.FILE_TEXT))
 		def test_file_info_read(self):
 			with File(self.path) as info:
 				self.assertEqual(info.checksum(md5), self.FILE_CHECKSUM)
@@ -169,4 +276,59 @@ if __name__ == '__main__':
 				self.assertEqual(info.size, len(self.FILE_TEXT))
 				self.assertEqual(info.modified, self.mtime)
 				self.assertEqual(info.checksum(md5), self.FILE_CHECKSUM)
+
+			with ExclusivelyFlockedFile(self.path) as info:
+				self.assertEqual(info.size, len(self.FILE_TEXT))
+				self.assertEqual(info.modified, self.mtime)
+				self.assertEqual(info.checksum(md5), self.FILE_CHECKSUM)
+
+	class ChecksumMemoTests(unittest.TestCase):
+		def setUp(self):
+			self.tmpdir = mkdtemp()
+			self.path = path_join(self.tmpdir, 'source')
+			with open(self.path, 'wb') as handle:
+				handle.write(FileTests.FILE_TEXT)
+			os.utime(self.path, (1, 1))
+			# Changing the times just changed ctime.
+			self.memo = ChecksumMemo(path_join(self.tmpdir, 'memo.sqlite'), 0)
+		def tearDown(self):
+			self.memo.close()
+			rmtree(self.tmpdir)
+		def test_memo(self):
+			with File(self.path) as info:
+				self.assertEqual(info.checksum(md5, self.memo), FileTests.FILE_CHECKSUM)
+				source_stat = info.stat
+			self.assertEqual(len(self.memo), 1)
+			self.assertEqual(self.memo.get(source_stat, md5), FileTests.FILE_CHECKSUM)
+			self.assertIsNone(self.memo.get(source_stat, hashers.get_hasher('sha1')))
+			self.assertIsNone(self.memo.get(source_stat._replace(mtime_ns = source_stat.mtime_ns + 1), md5))
+			self.assertIsNone(self.memo.get(source_stat._replace(inode = source_stat.inode + 1), md5))
+		def test_used(self):
+			with File(self.path) as info:
+				self.memo.put(info.stat, md5, b'recorded')
+				self.assertEqual(info.checksum(md5, self.memo), b'recorded')
+				self.assertEqual(info.checksum(md5), FileTests.FILE_CHECKSUM)
+		def test_changed(self):
+			with File(self.path) as info:
+				info.checksum(md5, self.memo)
+			with open(self.path, 'ab') as handle:
+				handle.write(b'MORE')
+			os.utime(self.path, (2, 2))
+			with File(self.path) as info:
+				self.assertEqual(info.checksum(md5, self.memo), hashstring(FileTests.FILE_TEXT + b'MORE', md5))
+			self.assertEqual(len(self.memo), 1)
+		def test_racy(self):
+			self.memo.close()
+			self.memo = ChecksumMemo(path_join(self.tmpdir, 'memo.sqlite'))
+			with File(self.path) as info:
+				self.assertEqual(info.checksum(md5, self.memo), FileTests.FILE_CHECKSUM)
+				self.assertFalse(self.memo.put(info.stat, md5, FileTests.FILE_CHECKSUM))
+			self.assertEqual(len(self.memo), 0)
+		def test_persistent(self):
+			with File(self.path) as info:
+				info.checksum(md5, self.memo)
+				source_stat = info.stat
+			self.memo.close()
+			self.memo = ChecksumMemo(path_join(self.tmpdir, 'memo.sqlite'), 0)
+			self.assertEqual(self.memo.get(source_stat, md5), FileTests.FILE_CHECKSUM)
 	unittest.main()
@@ -4,21 +4,25 @@ if sys.version_info < (3, 3):
 	raise RuntimeError('At least Python 3.3 is required')
 import hashlib, functools
 from zlib import adler32, crc32
-import struct
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import struct, os
 import logging
 
 
 LOGGER = logging.getLogger(__name__)
 
 STEP = 4096
+# Files are read this much at a time, at offsets that are multiples of it.
+BLOCKSIZE = 1 << 20
 
 class Adler32(object):
 	name = 'adler32'
 	__slots__ = '__checksum',
 	def __init__(self):
-		self.__checksum = None
+		self.__checksum = 1
 	def update(self, data):
-		self.__checksum = adler32(data, self.__checksum) if self.__checksum is not None else adler32(data)
+		self.__checksum = adler32(data, self.__checksum)
 	def digest(self):
 		return struct.pack('!I', self.__checksum)
 		
@@ -26,19 +30,110 @@ class CRC32(object):
 	name = 'crc32'
 	__slots__ = '__checksum',
 	def __init__(self):
-		self.__checksum = None
+		self.__checksum = 0
 	def update(self, data):
-		self.__checksum = crc32(data, self.__checksum) if self.__checksum is not None else crc32(data)
+		self.__checksum = crc32(data, self.__checksum)
 	def digest(self):
 		return struct.pack('!I', self.__checksum)
 
-
+if hasattr(hashlib, 'blake2b'):
+	class Blake2bTree(object):
+		"""
+			BLAKE2b in tree mode: LEAF_SIZE pieces of the data are hashed
+			separately, and their digests are hashed again.  The leaves of a
+			whole file can be hashed in parallel with digest_file().
+		"""
+		name = 'blake2b-tree'
+		LEAF_SIZE = 1 << 20
+		DIGEST_SIZE = 64
+		__slots__ = '__leaves', '__buffer',
+		executor = executor_pid = None
+		executor_lock = Lock()
+		@classmethod
+		def node(cls, offset, depth, last):
+			return hashlib.blake2b(digest_size = cls.DIGEST_SIZE, fanout = 0, depth = 2, leaf_size = cls.LEAF_SIZE, \
+					node_offset = offset, node_depth = depth, inner_size = cls.DIGEST_SIZE, last_node = last)
+		@classmethod
+		def root(cls, leaves):
+			root = cls.node(0, 1, True)
+			for leaf in leaves:
+				root.update(leaf)
+			return root.digest()
+		@classmethod
+		def leaf(cls, data, index, last):
+			leaf = cls.node(index, 0, last)
+			leaf.update(data)
+			return leaf.digest()
+		def __init__(self):
+			self.__leaves = []
+			self.__buffer = bytearray()
+		def update(self, data):
+			data = memoryview(data)
+			while data:
+				if len(self.__buffer) == self.LEAF_SIZE:
+					# Only now is it known that this leaf is not the last one.
+					self.__leaves.append(self.leaf(self.__buffer, len(self.__leaves), False))
+					self.__buffer = bytearray()
+				count = min(len(data), self.LEAF_SIZE - len(self.__buffer))
+				self.__buffer += data[:count]
+				data = data[count:]
+		def digest(self):
+			return self.root(self.__leaves + [self.leaf(self.__buffer, len(self.__leaves), True)])
+		@classmethod
+		def get_executor(cls):
+			with cls.executor_lock:
+				# The threads do not survive a fork.
+				if cls.executor is None or cls.executor_pid != os.getpid():
+					cls.executor, cls.executor_pid = ThreadPoolExecutor(os.cpu_count() or 1), os.getpid()
+				return cls.executor
+		@classmethod
+		def hash_leaf(cls, fileno, index, last):
+			return cls.leaf(os.pread(fileno, cls.LEAF_SIZE, index * cls.LEAF_SIZE), index, last)
+		@classmethod
+		def digest_file(cls, fileno, size):
+			"""
+				Hashes the leaves of a file in parallel.  Reading and hashing
+				both release the GIL, so the threads really run at once.
+			"""
+			count = max(1, -(-size // cls.LEAF_SIZE))
+			if count == 1:
+				return cls.root([cls.hash_leaf(fileno, 0, True)])
+			executor = cls.get_executor()
+			leaves = [executor.submit(cls.hash_leaf, fileno, i, i == count - 1) for i in range(count)]
+			return cls.root((leaf.result() for leaf in leaves))
 
 ALGORITHMS = {name.lower() : functools.partial(hashlib.new, name) for name in hashlib.algorithms_available}
 ALGORITHMS[Adler32.name] = Adler32
 ALGORITHMS[CRC32.name] = CRC32
+if 'Blake2bTree' in globals():
+	ALGORITHMS[Blake2bTree.name] = Blake2bTree
 
 
+def checksum_file(handle, cksum_type):
+	"""
+		Checksums an open file from the start, and leaves it at the start.
+		The file is read in large blocks straight into a buffer that is
+		reused, and hashlib and zlib release the GIL while they work on
+		them.  Files are not mmap()ed, because a source that is truncated
+		while it is being hashed would kill the process with SIGBUS.
+	"""
+	size = os.fstat(handle.fileno()).st_size
+	if hasattr(cksum_type, 'digest_file'):
+		return cksum_type.digest_file(handle.fileno(), size)
+	hasher = cksum_type()
+	# One more byte than expected finds the end of small files in one read.
+	buff = bytearray(max(1, min(BLOCKSIZE, size + 1)))
+	view = memoryview(buff)
+	handle.seek(0)
+	try:
+		count = handle.readinto(buff)
+		while count:
+			hasher.update(view[:count])
+			count = handle.readinto(buff)
+		return hasher.digest()
+	finally:
+		view.release()
+		handle.seek(0)
 def available_hashers():
 	global ALGORITHMS
 	LOGGER.debug('Getting available hashers')
@@ -54,7 +149,9 @@ def get_hasher(name):
 if __name__ == '__main__':
 	import unittest
 	import timeit
-	logging.basicConfig(level = logging.DEBUG)
+	import zlib
+	from argparse import ArgumentParser
+	from tempfile import TemporaryFile
 	class HashTest(unittest.TestCase):
 		TEST_DATA = b'TEST' * 4096
 		def test_available(self):
@@ -79,6 +176,81 @@ if __name__ == '__main__':
 				digest = hasher.digest()
 				self.assertGreater(len(digest), 0)
 				print('%s => %s' % (algorithm, digest))
+		def test_zlib(self):
+			for cksum_type, function in [(Adler32, zlib.adler32), (CRC32, zlib.crc32)]:
+				self.assertEqual(cksum_type().digest(), struct.pack('!I', function(b'')))
+				hasher = cksum_type()
+				hasher.update(self.TEST_DATA[:5])
+				hasher.update(self.TEST_DATA[5:])
+				self.assertEqual(hasher.digest(), struct.pack('!I', function(self.TEST_DATA)))
+	class ChecksumFileTest(unittest.TestCase):
+		def setUp(self):
+			self.file = TemporaryFile()
+		def tearDown(self):
+			self.file.close()
+		def write(self, data):
+			self.file.seek(0)
+			self.file.truncate()
+			self.file.write(data)
+			self.file.flush()
+		def test_checksum_file(self):
+			for data in [b'', b'TEST', os.urandom(2 * BLOCKSIZE + 5)]:
+				self.write(data)
+				for algorithm in ['md5', 'sha1', 'adler32', 'crc32']:
+					hasher = get_hasher(algorithm)()
+					hasher.update(data)
+					self.assertEqual(checksum_file(self.file, get_hasher(algorithm)), hasher.digest())
+					self.assertEqual(self.file.tell(), 0)
+		if 'Blake2bTree' in globals():
+			class SmallTree(Blake2bTree):
+				LEAF_SIZE = 1024
+			def test_tree(self):
+				data = os.urandom(3 * self.SmallTree.LEAF_SIZE)
+				digests = set()
+				for size in [0, 1, self.SmallTree.LEAF_SIZE, self.SmallTree.LEAF_SIZE + 1, len(data)]:
+					self.write(data[:size])
+					hasher = self.SmallTree()
+					# Pieces that do not line up with the leaves
+					for i in range(0, size, 100):
+						hasher.update(data[i:min(size, i + 100)])
+					digest = hasher.digest()
+					self.assertEqual(checksum_file(self.file, self.SmallTree), digest)
+					digests.add(digest)
+				self.assertEqual(len(digests), 5)
+				self.assertNotEqual(checksum_file(self.file, Blake2bTree), checksum_file(self.file, self.SmallTree))
 
+	def benchmark(sizes, algorithms, volume = 1 << 26, repeat = 3):
+		"""
+			Reports how fast each checksum function hashes files of each size.
+			The files have just been written, so this measures hashing rather
+			than the disk.
+		"""
+		print('%-16s %12s %12s' % ('Algorithm', 'File size', 'MB/s'))
+		for size in sizes:
+			with TemporaryFile() as tmp:
+				for offset in range(0, size, BLOCKSIZE):
+					tmp.write(os.urandom(min(BLOCKSIZE, size - offset)))
+				tmp.flush()
+				for name in sorted(algorithms):
+					cksum_type = get_hasher(name)
+					try:
+						checksum_file(tmp, cksum_type)
+					except TypeError:
+						# Extendable output functions need a digest length.
+						continue
+					timer = timeit.Timer(functools.partial(checksum_file, tmp, cksum_type))
+					number = max(1, volume // max(size, 1))
+					best = min(timer.repeat(repeat, number)) / number
+					print('%-16s %12d %12.1f' % (name, size, size / best / 1000000))
 
-	unittest.main()
+	parser = ArgumentParser(description = 'Runs the tests, or measures how fast each checksum function is')
+	parser.add_argument('--benchmark', dest = 'benchmark', action = 'store_true', default = False, help = 'Report MB/s for each checksum function and file size instead of running the tests')
+	parser.add_argument('--sizes', dest = 'sizes', nargs = '+', metavar = 'BYTES', type = int, default = [4096, 1 << 20, 1 << 26], help = 'File sizes to benchmark')
+	parser.add_argument('--algorithms', dest = 'algorithms', nargs = '+', metavar = 'NAME', help = 'Checksum functions to benchmark.  DEFAULT: all of them')
+	args, remaining = parser.parse_known_args()
+	if args.benchmark:
+		logging.basicConfig(level = logging.WARNING)
+		benchmark(args.sizes, args.algorithms or available_hashers())
+	else:
+		logging.basicConfig(level = logging.DEBUG)
+		unittest.main(argv = sys.argv[:1] + remaining)
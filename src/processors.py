@@ -4,16 +4,20 @@ if sys.version_info < (3, 3):
 	raise RuntimeError('At least Python 3.3 is required')
 
 from os import environ, getuid
-import struct, platform, os, stat
+import struct, platform, os, stat, hashlib
 from collections import namedtuple
 from os.path import pathsep, join as path_join, normpath, isfile, basename
 import logging
-from subprocess import Popen, CalledProcessError, PIPE
+from subprocess import Popen, CalledProcessError, PIPE, check_output
 from shutil import copyfileobj
 import magic, chardet
 from tempfile import TemporaryFile
 from codecs import getreader, getwriter
 from time import sleep
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.reduction import DupFd
+import multiprocessing, io
 import cache
 
 LOGGER = logging.getLogger(__name__)
@@ -74,14 +78,20 @@ else:
 		raise ValueError(executable)
 
 
+# At module level so that it can be pickled
+Header = namedtuple('Header', ['encoding', 'mime'])
+
 class BaseProcessor(object):
-	Header = namedtuple('Header', ['encoding', 'mime'])
+	Header = Header
 	length_format = '!B'
 	length_length = 1
 
 	NAME = NotImplemented
 	MIME = NotImplemented
+	# Whether the output depends on the name of the file, not just its contents
+	NAME_DEPENDENT = False
 
+	__slots__ = '__fingerprint',
 	processors = {}
 	@classmethod
 	def register(cls):
@@ -96,6 +106,26 @@ class BaseProcessor(object):
 	def get_processor(cls, name):
 		return cls.processors[name]
 	@classmethod
+	def tool_version(cls):
+		"Version of whatever does the rendering, so that upgrading it invalidates old renderings"
+		return ''
+	def describe(self):
+		"Everything about this processor that affects its output"
+		return (self.NAME, type(self).__name__, self.tool_version())
+	@property
+	def fingerprint(self):
+		"Worked out once, as describe() may have to ask the tool for its version"
+		try:
+			return self.__fingerprint
+		except AttributeError:
+			self.__fingerprint = hashlib.sha1(repr(self.describe()).encode('utf8')).digest()
+			return self.__fingerprint
+	def fingerprint_for(self, path):
+		"Renderings of files with different names only match if the name is not used."
+		if not self.NAME_DEPENDENT:
+			return self.fingerprint
+		return hashlib.sha1(self.fingerprint + basename(path).encode('utf8')).digest()
+	@classmethod
 	def write_header(self, stream, header):
 		LOGGER.debug('Writing header to %s' % stream)
 		count = 0
@@ -174,6 +204,8 @@ class Processor(BaseProcessor):
 	@property
 	def mime_type(self):
 		return self.MIME
+	def describe(self):
+		return BaseProcessor.describe(self) + (tuple(self.header),)
 	def __call__(self, inf, outf, cached):
 		self.write_header(outf, self.header)
 		return self.process(inf, outf)
@@ -200,6 +232,9 @@ class AutoBaseProcessor(BaseProcessor):
 	def process(self, inf, outf):
 		copyfileobj(inf, outf)
 	@classmethod
+	def tool_version(cls):
+		return 'magic=%s chardet=%s' % (getattr(magic, '__version__', ''), getattr(chardet, '__version__', ''))
+	@classmethod
 	def auto_header(cls, buff):
 		mime_type = magic.from_buffer(buff, mime = True).decode('ascii')
 		cinfo = chardet.detect(buff)
@@ -249,10 +284,22 @@ try:
 		ATTRIBUTES = []
 		FOOTER_LINK = '\n\'\'\'\'\nlink:/[Index]\n'
 		insert_link = True
+		version = None
 		__slots__ = 'footer_link',
 		def __init__(self, encoding):
 			Processor.__init__(self, encoding)
 			self.footer_link = self.FOOTER_LINK.encode(encoding)
+		@classmethod
+		def tool_version(cls):
+			if AsciidocProcessor.version is None:
+				try:
+					AsciidocProcessor.version = check_output([asciidoc, '--version']).decode('ascii', 'replace').strip()
+				except (OSError, CalledProcessError):
+					LOGGER.warning('Could not find out the version of %s' % asciidoc)
+					AsciidocProcessor.version = ''
+			return AsciidocProcessor.version
+		def describe(self):
+			return Processor.describe(self) + (self.BACKEND, tuple(self.ATTRIBUTES), self.insert_link and self.FOOTER_LINK)
 		def process(self, inf, outf):
 			if self.BACKEND is NotImplemented:
 				raise NotImplementedError
@@ -299,7 +346,15 @@ try:
 		DOCUMENT_START = NotImplemented
 		DOCUMENT_END = '\n</body>\n</html>\n'
 		FOOTER_LINK = '\n<p><a href="/">Index</a></p>\n'
+		# The file name is the title.
+		NAME_DEPENDENT = True
 		insert_link = True
+		@classmethod
+		def tool_version(cls):
+			return getattr(markdown, '__version__', getattr(markdown, 'version', ''))
+		def describe(self):
+			return Processor.describe(self) + (self.BACKEND, tuple(self.EXTENSIONS), self.DOCUMENT_START, self.DOCUMENT_END, \
+					self.insert_link and self.FOOTER_LINK)
 		def process(self, inf, outf):
 			if self.DOCUMENT_START is NotImplemented or self.BACKEND is NotImplemented:
 				raise NotImplementedError
@@ -362,6 +417,76 @@ try:
 except ImportError:
 	pass
 
+class ProcessBackend(object):
+	"""
+		Runs processors in a pool of processes, so that rendering uses every
+		core instead of competing for the GIL with the server.  The child
+		reads the original through a duplicate of the server's descriptor
+		and writes into a temporary file, which is then copied to the real
+		output; neither goes through a pipe as pickled bytes.
+	"""
+	__slots__ = '__size', '__executor', '__pid', '__lock',
+	def __init__(self, size = None):
+		size = int(size or os.cpu_count() or 1)
+		if size < 1:
+			raise ValueError('Invalid number of processes: %d' % size)
+		self.__size = size
+		self.__executor = self.__pid = None
+		self.__lock = Lock()
+	@property
+	def size(self):
+		return self.__size
+	def get_executor(self):
+		with self.__lock:
+			# The pool does not survive a fork.
+			if self.__executor is None or self.__pid != os.getpid():
+				context = None
+				if 'forkserver' in multiprocessing.get_all_start_methods():
+					# Forking the threaded server itself is not safe.
+					context = multiprocessing.get_context('forkserver')
+				self.__executor, self.__pid = ProcessPoolExecutor(self.__size, context), os.getpid()
+			return self.__executor
+	def shutdown(self):
+		with self.__lock:
+			if self.__executor is not None and self.__pid == os.getpid():
+				self.__executor.shutdown()
+			self.__executor = self.__pid = None
+	@staticmethod
+	def run(processor, inf, name, position, outf, cached):
+		raw = io.FileIO(inf.detach(), 'rb')
+		# Some processors use the name of the original.
+		raw.name = name
+		with io.BufferedReader(raw) as reader, open(outf.detach(), 'wb') as writer:
+			# The descriptor shares its offset with the server's.
+			reader.seek(position)
+			return processor(reader, writer, cached)
+	def __call__(self, processor, inf, outf, cached):
+		try:
+			fileno = inf.fileno()
+		except (AttributeError, io.UnsupportedOperation):
+			fileno = None
+		if fileno is None or multiprocessing.current_process().daemon:
+			# Not a real file, or already in a pool process that cannot have children
+			return processor(inf, outf, cached)
+		with TemporaryFile('w+b') as output:
+			result = self.get_executor().submit(self.run, processor, DupFd(fileno), inf.name, inf.tell(), DupFd(output.fileno()), cached).result()
+			output.seek(0)
+			copyfileobj(output, outf)
+		return result
+
+class OutOfProcess(object):
+	"Renders with a processor through a ProcessBackend; otherwise it is the processor."
+	__slots__ = 'processor', 'backend',
+	def __init__(self, processor, backend):
+		self.processor = processor
+		self.backend = backend
+	def __getattr__(self, name):
+		return getattr(self.processor, name)
+	def __call__(self, inf, outf, cached):
+		return self.backend(self.processor, inf, outf, cached)
+	def __repr__(self):
+		return 'OutOfProcess(%s)' % repr(self.processor)
+
 def available_processors():
 	LOGGER.debug('Getting available hashers')
 	return Processor.available_processors()
@@ -428,6 +553,82 @@ if __name__ == '__main__':
 				self.assertEqual(text, ftext)
 			finally:
 				remove(name)
+	class TestFingerprint(unittest.TestCase):
+		def test_fingerprint(self):
+			raw = get_processor('raw')('text/plain', None)
+			self.assertEqual(raw.fingerprint, get_processor('raw')('text/plain', None).fingerprint)
+			self.assertNotEqual(raw.fingerprint, get_processor('raw')('text/html', None).fingerprint)
+			self.assertNotEqual(raw.fingerprint, get_processor('autoraw')('utf8').fingerprint)
+			for name in available_processors():
+				proctype = get_processor(name)
+				try:
+					proc = proctype('text/plain', 'utf8')
+				except TypeError:
+					proc = proctype('utf8')
+				self.assertLessEqual(len(proc.fingerprint), 0xFF)
+		def test_fingerprint_for(self):
+			raw = get_processor('raw')('text/plain', None)
+			self.assertEqual(raw.fingerprint_for('a/b.txt'), raw.fingerprint_for('c.txt'))
+			if 'MarkdownHTML5Processor' in globals():
+				md = MarkdownHTML5Processor('utf8')
+				self.assertEqual(md.fingerprint_for('a/b.md'), md.fingerprint_for('c/b.md'))
+				self.assertNotEqual(md.fingerprint_for('a/b.md'), md.fingerprint_for('a/c.md'))
+		def test_fingerprint_once(self):
+			class Counting(RawProcessor):
+				described = 0
+				def describe(self):
+					Counting.described += 1
+					return RawProcessor.describe(self)
+			proc = Counting('text/plain', None)
+			fingerprint = proc.fingerprint
+			for path in ['a.txt', 'b/c.txt']:
+				self.assertIs(proc.fingerprint_for(path), fingerprint)
+			self.assertEqual(Counting.described, 1)
+	class TestProcessBackend(unittest.TestCase):
+		TEXT = b'Some *text*\n'
+		@classmethod
+		def setUpClass(cls):
+			cls.backend = ProcessBackend(2)
+		@classmethod
+		def tearDownClass(cls):
+			cls.backend.shutdown()
+		def setUp(self):
+			with NamedTemporaryFile('wb', suffix = '.md', delete = False) as f:
+				self.inf = f.name
+				f.write(self.TEXT)
+		def tearDown(self):
+			remove(self.inf)
+		def render(self, proc, skip = 0):
+			with open(self.inf, 'rb') as inf, TemporaryFile('w+b') as outf:
+				inf.read(skip)
+				proc(inf, outf, True)
+				outf.seek(0)
+				return outf.read()
+		def test_raw(self):
+			raw = get_processor('raw')('text/plain', None)
+			proc = OutOfProcess(raw, self.backend)
+			self.assertEqual(proc.fingerprint, raw.fingerprint)
+			self.assertEqual(proc.fingerprint_for(self.inf), raw.fingerprint_for(self.inf))
+			self.assertEqual(self.render(proc), self.render(raw))
+			self.assertTrue(self.render(proc).endswith(self.TEXT))
+			# Read from where the server's handle is
+			self.assertEqual(self.render(proc, 5), self.render(raw, 5))
+		def test_nocache(self):
+			proc = OutOfProcess(get_processor('autoraw-nocache')('utf8'), self.backend)
+			with open(self.inf, 'rb') as inf, TemporaryFile('w+b') as outf:
+				self.assertRaises(cache.NoCache, proc, inf, outf, True)
+		def test_in_process(self):
+			from io import BytesIO
+			proc = OutOfProcess(get_processor('raw')('text/plain', None), self.backend)
+			outf = BytesIO()
+			proc(BytesIO(self.TEXT), outf, True)
+			self.assertTrue(outf.getvalue().endswith(self.TEXT))
+		if 'MarkdownHTML5Processor' in vars():
+			def test_name(self):
+				md = MarkdownHTML5Processor('utf8')
+				rendered = self.render(OutOfProcess(md, self.backend))
+				self.assertEqual(rendered, self.render(md))
+				self.assertIn(basename(self.inf).encode('utf8'), rendered)
 	if 'AsciidocXHTMLProcessor' in vars():
 		class TestAsciidoc(unittest.TestCase):
 			DOCUMENT = \
@@ -5,8 +5,7 @@ if sys.version_info < (3, 3):
 
 import logging, os, codecs, shelve, pickle, os.path, stat
 import config, cache, processors, filestuff, common
-from datetime import datetime, timedelta
-from pytz import utc
+from datetime import timedelta
 import itertools, functools
 from os.path import relpath, basename, join as path_join, dirname
 from collections import namedtuple
@@ -93,8 +92,8 @@ class ContentFilter(Filter):
 class BaseSearchCache(object):
 	__slots__ = '__db', '__sorted_scan', '__latest_mtime_callback', '__options', '__lock', '__length',
 	@staticmethod
-	def utcnow():
-		return datetime.utcnow().replace(tzinfo = utc)
+	def now_ns():
+		return filestuff.time_ns()
 	@staticmethod
 	def get_db():
 		raise NotImplementedError
@@ -112,7 +111,7 @@ class BaseSearchCache(object):
 			if max_entries < 2:
 				raise ValueError('Invalid number of maximum entries: %d' % max_entries)
 		auto_scrub = bool(auto_scrub)
-		self.__options = cache.Cache.Options(max_age, max_entries, auto_scrub)
+		self.__options = cache.Cache.Options(max_age, max_entries, auto_scrub, None)
 		self.scrub()
 	def __len__(self):
 		with self:
@@ -141,10 +140,10 @@ class BaseSearchCache(object):
 		with self:
 			try:
 				entry_timestamp = self.__db[date_key]
-				if mtime is None or entry_timestamp < mtime:
+				if mtime is None or not self.fresh(entry_timestamp, mtime):
 					# If mtime is None, then there are no files left
 					raise ValueError
-				self.__db[date_key] = self.utcnow()
+				self.__db[date_key] = self.now_ns()
 
 				LOGGER.debug('Returning cached result for %s' % str_filter)
 				return self.__db[str_filter]
@@ -155,13 +154,13 @@ class BaseSearchCache(object):
 
 		LOGGER.debug('No matches for %s; calling sorted scan' % str_filter)
 		entry_content = list(self.__sorted_scan(search_filter))
-		new_entry_timestamp = self.utcnow()
+		new_entry_timestamp = self.now_ns()
 		with self:
 			other_updated = False
 			try:
 				# Done this way because another thread might've updated it while DB wasn't locked.
 				other_updated = (self.__db[date_key] > entry_timestamp)
-			except KeyError:
+			except (KeyError, TypeError):
 				pass
 			if not other_updated:
 				print(entry_content)
@@ -171,6 +170,10 @@ class BaseSearchCache(object):
 					# Inside of "not other_updated" because another thread might've inserted this while DB wasn't locked.
 					self.__length += 1
 		return entry_content
+	@staticmethod
+	def fresh(entry_timestamp, mtime):
+		# Entries stored before timestamps were kept in nanoseconds are stale.
+		return isinstance(entry_timestamp, int) and entry_timestamp >= mtime
 	@property
 	def options(self):
 		return self.__options
@@ -190,7 +193,7 @@ class BaseSearchCache(object):
 		mtime = self.__latest_mtime_callback(True)
 		cutoff = None
 		if self.options.max_age is not None:
-			cutoff = datetime.utcnow().replace(tzinfo = utc) - self.options.max_age
+			cutoff = self.now_ns() - int(self.options.max_age.total_seconds() * 1000000000)
 		entries = []
 		LOGGER.info('Scrubbing cache %s' % self)
 		with self:
@@ -199,7 +202,7 @@ class BaseSearchCache(object):
 					continue
 				date_key = '=date:' + key
 				entry_timestamp = self.__db[date_key]
-				if mtime is None or entry_timestamp < mtime:
+				if mtime is None or not self.fresh(entry_timestamp, mtime):
 					# If mtime is none, then there are no files left
 					self.__remove(key, date_key)
 					continue
@@ -228,7 +231,7 @@ class SearchCache(BaseSearchCache):
 			common.fix_perms(f)
 		BaseSearchCache.__init__(self, shelve.open(dbfile, 'c', pickle.HIGHEST_PROTOCOL), \
 				sorted_scan, latest_mtime_callback, max_age, max_entries, auto_scrub)
-		common.fix_perms(dbfile)
+		common.fix_db_perms(dbfile)
 	def close(self):
 		if self._BaseSearchCache__db is not None:
 			self._BaseSearchCache__db.close()
@@ -255,7 +258,11 @@ class TemporarySearchCache(BaseSearchCache):
 
 
 
-FileInfo = namedtuple('FileInfo', ['name', 'modified', 'size'])
+class FileInfo(namedtuple('FileInfo', ['name', 'modified_ns', 'size'])):
+	__slots__ = ()
+	@property
+	def modified(self):
+		return filestuff.ns2datetime(self.modified_ns)
 
 class Search(object):
 	__slots__ = 'server', '__cache',
@@ -296,31 +303,34 @@ class Search(object):
 			yield path, True
 			for fname in fnames:
 				yield path_join(path, fname), False
+	@staticmethod
+	def stored_latest_mtime(server):
+		"LATEST_MTIME in nanoseconds, or None; older runs stored a datetime."
+		latest_mtime = server.getvar('LATEST_MTIME')
+		return latest_mtime if isinstance(latest_mtime, int) else None
 	def get_latest_mtime(self, refresh = False):
 		# Will only be called if caching is enabled
-		latest_mtime = self.server.getvar('LATEST_MTIME')
-		if not refresh and latest_mtime is None:
+		latest_mtime = self.stored_latest_mtime(self.server)
+		if self.server.watching or not refresh and latest_mtime is None:
 			return latest_mtime
 		for path, path_isdir in self.itertree(self.server.root):
 			try:
-				info = os.stat(path)
+				modified = os.stat(path).st_mtime_ns
 			except OSError:
 				continue
-			modified = datetime.utcfromtimestamp(info.st_mtime).replace(tzinfo = utc)
 			if latest_mtime is None or modified > latest_mtime:
 				latest_mtime = modified
 		self.server.setvar('LATEST_MTIME', latest_mtime)
 		return latest_mtime
 	def filter_files(self, filter_func):
-		latest_mtime = self.server.getvar('LATEST_MTIME')
+		latest_mtime = self.stored_latest_mtime(self.server)
 		root = self.server.root
 		try:
 			for path, path_isdir in self.itertree(root):
 				try:
-					info = os.stat(path)
+					modified = os.stat(path).st_mtime_ns
 				except OSError:
 					continue
-				modified = datetime.utcfromtimestamp(info.st_mtime).replace(tzinfo = utc)
 				if latest_mtime is None or modified > latest_mtime:
 					latest_mtime = modified
 				if path_isdir:
@@ -329,7 +339,7 @@ class Search(object):
 				if filter_func(relpath(path, root), root):
 					try:
 						with filestuff.LockedFile(path) as f:
-							info = FileInfo(relpath(path, root), f.modified, f.size)
+							info = FileInfo(relpath(path, root), f.modified_ns, f.size)
 						# Refresh this, just in case
 						if latest_mtime is None or modified > latest_mtime:
 							latest_mtime = modified
@@ -388,7 +398,7 @@ if __name__ == '__main__':
 		def get_cache(self):
 			raise NotImplementedError
 		def setUp(self):
-			self.mtime = TemporarySearchCache.utcnow()
+			self.mtime = TemporarySearchCache.now_ns()
 			self.cache = self.get_cache()
 			self.count = 0
 		def tearDown(self):
@@ -443,7 +453,7 @@ if __name__ == '__main__':
 			self.assertEqual(self.count, 1)
 
 			sleep(0.5)
-			self.mtime = TemporarySearchCache.utcnow()
+			self.mtime = TemporarySearchCache.now_ns()
 
 			func = PathFilter('a')
 			results = self.cache(func)
@@ -456,7 +466,7 @@ if __name__ == '__main__':
 			self.assertEqual(self.count, 1)
 
 			sleep(0.5)
-			self.mtime = TemporarySearchCache.utcnow()
+			self.mtime = TemporarySearchCache.now_ns()
 			self.cache.scrub()
 
 			func = PathFilter('a')
@@ -5,8 +5,10 @@ if sys.version_info < (3, 3):
 
 import tornado.ioloop
 import tornado.web
-import logging, binascii, cgi, shelve, pickle, shutil
-import config, cache, processors, filestuff, search, worker, common
+import tornado.gen
+import tornado.iostream
+import logging, binascii, cgi, shelve, pickle, hashlib
+import config, cache, processors, filestuff, search, worker, common, watcher
 from dateutil.parser import parse as date_parse
 from threading import Semaphore
 from pytz import utc
@@ -14,8 +16,9 @@ from dateutil.tz import tzlocal
 from email.utils import format_datetime
 from shutil import copyfileobj
 from collections import namedtuple
-import itertools, functools
-from os.path import relpath, join as path_join, isdir
+import itertools, functools, multiprocessing, multiprocessing.util, os, mmap
+from time import monotonic
+from os.path import relpath, join as path_join, isdir, isfile
 from os import mkdir
 from codecs import getreader, getwriter
 
@@ -25,13 +28,15 @@ LOGGER = logging.getLogger('wikiserv')
 
 class VarHost(object):
 	__slots__ = 'runtime_vars',
+	# Whether LATEST_MTIME is kept current as the source directory changes
+	watching = False
 	def __init__(self, path):
 		self.runtime_vars = shelve.open(path, 'c', protocol = pickle.HIGHEST_PROTOCOL)
-		common.fix_perms(path)
+		common.fix_db_perms(path)
 	def __del__(self):
 		self.close()
 	def close(self):
-		if self.runtime_vars is not None:
+		if getattr(self, 'runtime_vars', None) is not None:
 			self.runtime_vars.close()
 			self.runtime_vars = None
 	def getvar(self, key):
@@ -43,8 +48,47 @@ class VarHost(object):
 		self.runtime_vars[key] = value
 
 
-class Server(VarHost):
-	__slots__ = 'configuration', 'caches', 'processors', 'send_etags', 'search', 'preview_lines', 'workers', 'runtime_vars',
+class Renderer(object):
+	"Fills the caches using the configured processors and preview_lines"
+	__slots__ = ()
+	@property
+	def default_processor(self):
+		return self.processors[None]
+	def processor_for(self, fname):
+		for extension, processor in self.processors.items():
+			if extension is None:
+				continue
+			elif fname.endswith(extension):
+				return processor
+		else:
+			return self.default_processor
+	def process(self, inf, outf, cached):
+		return self.processor_for(inf.name)(inf, outf, cached)
+	def process_fingerprint(self, path):
+		return self.processor_for(path).fingerprint_for(path)
+	def set_preview_lines(self, preview_lines):
+		self.preview_lines = preview_lines
+		# Fixed along with preview_lines, so it is not worked out per request
+		self.doc_head_digest = hashlib.sha1(repr(('doc_head', preview_lines, processors.AutoBaseProcessor.tool_version())).encode('utf8')).digest()
+	def doc_head_fingerprint(self, path):
+		return self.doc_head_digest
+	def doc_head(self, inf, outf, cached):
+		LOGGER.debug('doc_head inf=%s outf=%s' % (inf, outf))
+		buff = inf.read(2048)
+		header = processors.AutoBaseProcessor.auto_header(buff)
+		if header.encoding is None:
+			raise NotImplementedError
+		inf.seek(0)
+		reader = getreader(header.encoding)(inf)
+
+		processors.Processor.write_header(outf, header)
+		writer = getwriter(header.encoding)(outf)
+		for line in itertools.islice(reader, self.preview_lines):
+			writer.write(line)
+
+
+class Server(Renderer, VarHost):
+	__slots__ = 'configuration', 'caches', 'processors', 'send_etags', 'search', 'preview_lines', 'doc_head_digest', 'workers', 'runtime_vars', 'watcher', 'pending',
 	instance = None
 	ilock = Semaphore()
 	localzone = tzlocal()
@@ -68,8 +112,20 @@ class Server(VarHost):
 			cls.instance.close()
 			cls.instance = None
 	@staticmethod
-	def get_cache(configuration, process, subdir = None):
-		ctype = cache.DispatcherCache if configuration.dispatcher_thread else cache.Cache
+	def get_cache(configuration, process, subdir = None, scheduler = None, **kwargs):
+		ctype = cache.Cache
+		if configuration.dispatcher_thread:
+			ctype = cache.DispatcherCache
+			kwargs['scrub_slice'] = configuration.scrub_slice
+		kwargs['missing_entries'] = configuration.missing_entries
+		kwargs['deduplicate'] = configuration.deduplicate
+		if configuration.checksum_memo:
+			# One memo for every cache, since they share the source root.
+			kwargs['checksum_memo'] = path_join(configuration.cache_dir, '.checksums.sqlite')
+		if subdir == 'document':
+			# Previews are only used internally.
+			kwargs['encodings'] = configuration.precompress
+			kwargs['memory_bytes'] = configuration.memory_bytes
 		return ctype(
 			(path_join(configuration.cache_dir, subdir) if subdir is not None else configuration.cache_dir),
 			configuration.source_dir,
@@ -77,13 +133,33 @@ class Server(VarHost):
 			process,
 			configuration.max_age,
 			configuration.max_entries,
-			configuration.auto_scrub
+			configuration.auto_scrub,
+			configuration.stat_validation,
+			configuration.index_entries,
+			processors.Processor.read_header,
+			(configuration.stale_while_revalidate if scheduler is not None else None),
+			scheduler,
+			configuration.max_bytes,
+			**kwargs
 		)
+	@staticmethod
+	def check_preview(configuration):
+		"""
+			Returns the caches to skip.  Previews of a different length are
+			rendered again as they are used, because of their fingerprints.
+		"""
+		skip = []
+		if not configuration.preview_lines:
+			skip.append('preview')
+		return skip
 	@classmethod
 	def process_funcs(cls, obj):
 		return {ctype : getattr(obj, method) for ctype, method in cls.CACHE_TYPES.items()}
 	@classmethod
-	def get_caches(cls, configuration, process_funcs, skip = frozenset()):
+	def fingerprint_funcs(cls, obj):
+		return {ctype : getattr(obj, '%s_fingerprint' % method) for ctype, method in cls.CACHE_TYPES.items()}
+	@classmethod
+	def get_caches(cls, configuration, process_funcs, skip = frozenset(), scheduler = None, fingerprint_funcs = None, **kwargs):
 		if not isdir(configuration.cache_dir):
 			mkdir(configuration.cache_dir)
 		common.fix_dir_perms(configuration.cache_dir)
@@ -93,36 +169,75 @@ class Server(VarHost):
 			pfsrc = lambda ctype: process_funcs[ctype]
 		else:
 			pfsrc = lambda ctype: process_funcs
-		return {ctype : cls.get_cache(configuration, pfsrc(ctype), ctype) for ctype in cls.CACHE_TYPES.keys() if not ctype in skip}
+		caches = {}
+		for ctype in cls.CACHE_TYPES.keys():
+			if ctype in skip:
+				continue
+			if fingerprint_funcs is not None:
+				kwargs['fingerprint_function'] = fingerprint_funcs[ctype]
+			caches[ctype] = cls.get_cache(configuration, pfsrc(ctype), ctype, scheduler, **kwargs)
+		return caches
 	def __init__(self, configuration):
+		# Set before anything is built: Search asks whether we are watching,
+		# and close() may run on a partly built server.
+		self.configuration = configuration
 		self.caches = {}
 		self.workers = None
 		self.search = None
-		self.preview_lines = configuration.preview_lines
+		self.watcher = None
+		self.pending = set()
+		self.set_preview_lines(configuration.preview_lines)
 		self.processors = configuration.processors
 		self.send_etags = configuration.send_etags
 		VarHost.__init__(self, configuration.runtime_vars)
-		skip = []
-		if not self.preview_lines:
-			skip.append('preview')
-		else:
-			preview_root = path_join(configuration.cache_dir, 'preview')
-			if self.preview_lines != self.getvar('PREVIEW_LINES'):
-				try:
-					shutil.rmtree(preview_root)
-				except OSError:
-					pass
-				self.setvar('PREVIEW_LINES', self.preview_lines)
+		skip = self.check_preview(configuration)
 
-		self.caches.update(self.get_caches(configuration, self.process_funcs(self), skip))
+		self.workers = worker.WorkerPool(configuration.worker_threads, autostart = True)
+		# Background renders wait behind the pages people are waiting for.
+		scheduler = functools.partial(self.workers.schedule, priority = worker.MAINTENANCE)
+		self.caches.update(self.get_caches(configuration, self.process_funcs(self), skip, scheduler, self.fingerprint_funcs(self)))
 		if configuration.use_search_cache:
 			self.search = search.Search(self, path_join(configuration.cache_dir, 'search'), \
 					configuration.search_max_age, configuration.search_max_entries, configuration.search_auto_scrub)
 		else:
 			self.search = search.Search(self)
-		self.workers = worker.WorkerPool(configuration.worker_threads, autostart = True)
+
+		if configuration.watch:
+			# Walk the tree once; from then on the watcher keeps this current.
+			self.search.get_latest_mtime(True)
+			self.watcher = watcher.watch(self.root, self.source_changed, configuration.watch_interval or watcher.DEFAULT_INTERVAL)
+			self.watcher.start()
 	def __del__(self):
 		self.close()
+	@property
+	def watching(self):
+		return self.watcher is not None and self.watcher.is_alive()
+	def source_changed(self, path, modified):
+		"""
+			Called by the watcher when something under the source directory
+			changes.  Documents are rendered again in the background, so that
+			they are ready before anybody asks for them.
+		"""
+		latest_mtime = search.Search.stored_latest_mtime(self)
+		if modified is not None and (latest_mtime is None or modified > latest_mtime):
+			self.setvar('LATEST_MTIME', modified)
+		if not path:
+			return
+		for cache in self.caches.values():
+			cache.invalidate(path)
+		if isfile(path_join(self.root, path)) and path not in self.pending:
+			self.pending.add(path)
+			self.workers.schedule(self.prerender, path, priority = worker.MAINTENANCE)
+	def prerender(self, path):
+		# Changes from now on need another render.
+		self.pending.discard(path)
+		for name, cache in self.caches.items():
+			try:
+				if cache.render(path):
+					LOGGER.debug('Rendered %s into cache [%s] after a change' % (path, name))
+			except KeyError:
+				# Removed again in the meantime
+				pass
 	def __getitem__(self, key):
 		return self.cache[key]
 	@property
@@ -140,57 +255,189 @@ class Server(VarHost):
 			return None
 		with self.preview[path] as preview:
 			try:
-				header = processors.Processor.read_header(preview)
+				header = read_content_header(preview)
 				reader = getreader(header.encoding)(preview)
 				return reader.read()
 			except IOError:
 				return None
-	@property
-	def default_processor(self):
-		return self.processors[None]
-	def process(self, inf, outf, cached):
-		fname = inf.name
-		for extension, processor in self.processors.items():
-			if extension is None:
-				continue
-			elif fname.endswith(extension):
-				return processor(inf, outf, cached)
-		else:
-			return self.default_processor(inf, outf, cached)
-	def doc_head(self, inf, outf, cached):
-		LOGGER.debug('doc_head inf=%s outf=%s' % (inf, outf))
-		buff = inf.read(2048)
-		header = processors.AutoBaseProcessor.auto_header(buff)
-		if header.encoding is None:
-			raise NotImplementedError
-		inf.seek(0)
-		reader = getreader(header.encoding)(inf)
-
-		processors.Processor.write_header(outf, header)
-		writer = getwriter(header.encoding)(outf)
-		for line in itertools.islice(reader, self.preview_lines):
-			writer.write(line)
 	def close(self):
-		for name, cache in self.caches.items():
+		if getattr(self, 'watcher', None) is not None:
+			self.watcher.stop()
+			self.watcher.join()
+			self.watcher = None
+		# Background renders need the caches, so let them finish first.
+		if getattr(self, 'workers', None) is not None:
+			self.workers.finish()
+			self.workers.join()
+			LOGGER.info('Workers: %s' % self.workers.queue)
+			self.workers = None
+		configuration = getattr(self, 'configuration', None)
+		if configuration is not None and configuration.process_backend is not None:
+			configuration.process_backend.shutdown()
+		caches = getattr(self, 'caches', {})
+		for name, cache in caches.items():
+			LOGGER.info('Cache [%s]: %s' % (name, cache.statistics))
+			if cache.memory is not None:
+				LOGGER.info('Cache [%s] memory tier: %s' % (name, cache.memory))
 			try:
 				cache.close()
 			except:
 				LOGGER.exception('Closing cache [%s]=%s' % (name, cache))
-		self.caches.clear()
-		if self.workers is not None:
-			self.workers.finish()
-			self.workers.join()
-			self.workers = None
-		if self.search is not None:
+		caches.clear()
+		if getattr(self, 'search', None) is not None:
 			self.search.close()
 			self.search = None
 		VarHost.close(self)
 
 
+class Prebuilder(Renderer):
+	"""
+		Renders every document into the caches ahead of time, in a pool of
+		processes.  Finished paths are written to a journal in the cache
+		directory so that an interrupted prebuild can be resumed.
+	"""
+	__slots__ = 'processors', 'preview_lines', 'doc_head_digest', 'caches', 'force',
+	JOURNAL = '.prebuild'
+	PROGRESS_INTERVAL = 5
+	current = None
+	def __init__(self, configuration, skip, force, initial_scrub = False):
+		self.processors = configuration.processors
+		self.set_preview_lines(configuration.preview_lines)
+		self.force = force
+		# Only the parent scrubs; the workers trust it to have done so.
+		self.caches = Server.get_caches(configuration, Server.process_funcs(self), skip, \
+				fingerprint_funcs = Server.fingerprint_funcs(self), initial_scrub = initial_scrub)
+	def close(self):
+		for cache in self.caches.values():
+			cache.close()
+		self.caches.clear()
+	def build(self, path):
+		"""
+			Returns the number of entries that had to be rendered, or raises
+			KeyError if the document does not exist.
+		"""
+		rendered = 0
+		for cache in self.caches.values():
+			if cache.render(path, self.force):
+				rendered += 1
+			# Pool workers are not shut down gracefully.
+			cache.flush()
+		return rendered
+	@staticmethod
+	def plain_caches(configuration):
+		"Dispatcher threads would keep the workers from exiting, and nobody waits on them anyway."
+		configuration.dispatcher_thread = False
+		configuration.scrub_slice = None
+	@staticmethod
+	def initialize_worker(config_path, skip, force):
+		with open(config_path, 'rb') as f:
+			configuration = config.Configuration(f)
+		Prebuilder.plain_caches(configuration)
+		Prebuilder.current = Prebuilder(configuration, skip, force)
+		# Pool workers exit without returning to us.
+		multiprocessing.util.Finalize(None, Prebuilder.current.close, exitpriority = 10)
+	@staticmethod
+	def build_in_worker(path):
+		try:
+			return path, Prebuilder.current.build(path), None
+		except Exception as e:
+			LOGGER.exception('When prebuilding %s' % path)
+			return path, 0, '%s: %s' % (type(e).__name__, e)
+	@classmethod
+	def run(cls, configuration, config_path, jobs = None, changed_only = False, resume = False):
+		"""
+			Renders every document under the source directory, or only those
+			whose entries are stale if changed_only is set.  Returns the paths
+			that could not be rendered.
+		"""
+		cls.plain_caches(configuration)
+		skip = Server.check_preview(configuration)
+		cls(configuration, skip, not changed_only, True).close()
+
+		journal_path = path_join(configuration.cache_dir, cls.JOURNAL)
+		done = set()
+		if resume:
+			try:
+				with open(journal_path, 'r', encoding = 'utf8') as journal:
+					done.update((line.rstrip('\n') for line in journal))
+			except IOError:
+				pass
+		paths = sorted((relpath(path, configuration.source_dir) for path in search.Search.find_files(configuration.source_dir)))
+		total = len(paths)
+		paths = [path for path in paths if path not in done]
+		LOGGER.info('Prebuilding %d of %d documents' % (len(paths), total))
+
+		failed = []
+		rendered = finished = 0
+		started = last_report = monotonic()
+		def report():
+			elapsed = monotonic() - started
+			sys.stderr.write('Prebuilt %d/%d documents (%d entries rendered, %d failed) in %.1fs\n' \
+					% (total - len(paths) + finished, total, rendered, len(failed), elapsed))
+		pool = multiprocessing.Pool(jobs or multiprocessing.cpu_count(), cls.initialize_worker, (config_path, skip, not changed_only))
+		try:
+			with open(journal_path, ('a' if resume else 'w'), encoding = 'utf8') as journal:
+				common.fix_perms(journal)
+				for path, count, error in pool.imap_unordered(cls.build_in_worker, paths, 8):
+					finished += 1
+					if error is not None:
+						failed.append((path, error))
+					else:
+						rendered += count
+						journal.write(path + '\n')
+						journal.flush()
+					if monotonic() - last_report >= cls.PROGRESS_INTERVAL:
+						last_report = monotonic()
+						report()
+			pool.close()
+		except:
+			pool.terminate()
+			raise
+		finally:
+			pool.join()
+		report()
+		if not failed:
+			os.remove(journal_path)
+		return failed
+
+
 
 
 Element = namedtuple('Element', ['tag', 'attrib', 'text'])
 
+def read_content_header(entry):
+	"Cached entries have already parsed the processor's header."
+	header = getattr(entry, 'content_header', None)
+	if header is not None:
+		return header
+	return processors.Processor.read_header(entry)
+
+def choose_encoding(accept_encoding, available):
+	"""
+		Picks the available content coding the client prefers, going by the
+		q-values in its Accept-Encoding header, or None for identity.
+	"""
+	if not accept_encoding or not available:
+		return None
+	qvalues = {}
+	for item in accept_encoding.split(','):
+		parts = [part.strip() for part in item.split(';')]
+		coding, q = parts[0].lower(), 1.0
+		for param in parts[1:]:
+			if param.lower().startswith('q='):
+				try:
+					q = float(param[2:])
+				except ValueError:
+					q = 0.0
+		if coding:
+			qvalues[coding] = q
+	best, best_q = None, 0.0
+	for coding in available:
+		q = qvalues.get(coding, qvalues.get('*', 0.0))
+		if q > best_q:
+			best, best_q = coding, q
+	return best
+
 def xhtml_head(stream, title, *head):
 	print('<?xml version="1.0" encoding="UTF-8" ?>', file = stream)
 	print('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">', file = stream)
@@ -239,7 +486,7 @@ class IndexHandler(tornado.web.RequestHandler):
 		if not files:
 			return [], (start > 0), more
 
-		newest = max(files, key = lambda x: x.modified)
+		newest = max(files, key = lambda x: x.modified_ns)
 		self.set_header('Last-Modified', format_datetime(newest.modified))
 		self.set_header('Cache-Control', ('no-cache' if filter_func else 'Public'))
 		if prev_mtime is not None and newest.modified.replace(microsecond = 0) <= prev_mtime:
@@ -321,9 +568,27 @@ class IndexHandler(tornado.web.RequestHandler):
 
 
 class WikiHandler(tornado.web.RequestHandler):
+	# Smaller payloads are cheaper to copy than to map.
+	MMAP_THRESHOLD = 65536
+	MMAP_CHUNK = 1048576
 	def compute_etag(self):
 		return None
-	def check_fill_headers(self, entry, header = None):
+	def open_variant(self, server, path, entry):
+		"""
+			Returns the precompressed variant of entry the client accepts, and
+			its encoding, or (None, None).
+		"""
+		if not server.cache.encodings:
+			return None, None
+		self.set_header('Vary', 'Accept-Encoding')
+		encoding = choose_encoding(self.request.headers.get('Accept-Encoding', None), server.cache.encodings)
+		if encoding is None:
+			return None, None
+		variant = server.cache.open_variant(path, entry, encoding)
+		if variant is None:
+			return None, None
+		return variant, encoding
+	def check_fill_headers(self, entry, header = None, encoding = None):
 		LOGGER.debug('Getting headers for request')
 		prev_mtime = None
 		server = Server.get_instance()
@@ -339,10 +604,20 @@ class WikiHandler(tornado.web.RequestHandler):
 		if server.send_etags:
 			checksum = header.checksum
 			if checksum:
-				self.set_header('Etag', '"%s"' % binascii.hexlify(checksum).decode('ascii'))
+				etag = binascii.hexlify(checksum).decode('ascii')
+				if encoding is not None:
+					etag = '%s-%s' % (etag, encoding)
+				self.set_header('Etag', '"%s"' % etag)
+		if encoding is not None:
+			self.set_header('Content-Encoding', encoding)
 		self.set_header('Last-Modified', format_datetime(header.timestamp))
 		self.set_header('Cache-Control', 'Public')
-		content_header = processors.Processor.read_header(entry)
+		stale_since = getattr(entry, 'stale_since', None)
+		if stale_since is not None:
+			age = (filestuff.time_ns() - stale_since) // 1000000000
+			self.set_header('Age', max(age, 0))
+			self.set_header('Warning', '110 - "Response is Stale"')
+		content_header = read_content_header(entry)
 		if content_header.encoding:
 			self.set_header('Content-Type', '%s; charset=%s' % (content_header.mime, content_header.encoding))
 		else:
@@ -365,7 +640,7 @@ class WikiHandler(tornado.web.RequestHandler):
 				if isinstance(entry, cache.AutoProcess):
 					# NoCache
 					reader = worker.RWAdapter(entry)
-					server.workers.schedule(reader)
+					server.workers.schedule(reader, priority = worker.INTERACTIVE)
 					try:
 						with reader:
 							self.check_fill_headers(reader, entry.header)
@@ -373,9 +648,53 @@ class WikiHandler(tornado.web.RequestHandler):
 						reader.wait()
 
 				else:
-					self.check_fill_headers(entry)
+					variant, encoding = self.open_variant(server, path, entry)
+					try:
+						if self.check_fill_headers(entry, encoding = encoding):
+							self.set_header('Content-Length', (variant if variant is not None else entry).payload_length)
+					finally:
+						if variant is not None:
+							variant.close()
 		except KeyError:
 			raise tornado.web.HTTPError(404)
+	@tornado.gen.coroutine
+	def send_payload(self, entry):
+		"""
+			Sends the rest of a cached entry straight out of a memory map, so
+			the payload is not copied into Python objects on its way to the
+			socket.  Small payloads, and files that cannot be mapped, are
+			copied as before.
+		"""
+		if isinstance(entry, cache.MemoryEntry):
+			self.write(entry.payload)
+			return
+		offset = entry.file_position
+		end = entry.size
+		if end - offset < self.MMAP_THRESHOLD:
+			copyfileobj(entry, self)
+			return
+		try:
+			mapping = mmap.mmap(entry.fileno(), 0, access = mmap.ACCESS_READ)
+		except (mmap.error, ValueError, OSError):
+			LOGGER.debug('Could not map %s' % entry.name)
+			copyfileobj(entry, self)
+			return
+		try:
+			self.set_header('Content-Length', end - offset)
+			yield self.flush()
+			view = memoryview(mapping)
+			for start in range(offset, end, self.MMAP_CHUNK):
+				yield self.request.connection.write(view[start:min(start + self.MMAP_CHUNK, end)])
+		except tornado.iostream.StreamClosedError:
+			LOGGER.debug('Client went away while sending %s' % entry.name)
+		finally:
+			view = None
+			try:
+				mapping.close()
+			except BufferError:
+				# The stream still holds a slice; the mapping goes with it.
+				pass
+	@tornado.gen.coroutine
 	def get(self, path):
 		LOGGER.debug('GET %s' % path)
 		try:
@@ -385,7 +704,7 @@ class WikiHandler(tornado.web.RequestHandler):
 				if isinstance(entry, cache.AutoProcess):
 					# NoCache
 					reader = worker.RWAdapter(entry)
-					server.workers.schedule(reader)
+					server.workers.schedule(reader, priority = worker.INTERACTIVE)
 					try:
 						with reader:
 							if not self.check_fill_headers(reader, entry.header):
@@ -394,10 +713,15 @@ class WikiHandler(tornado.web.RequestHandler):
 					finally:
 						reader.wait()
 				else:
-					if not self.check_fill_headers(entry):
-						return
-					LOGGER.debug('Returning data')
-					copyfileobj(entry, self)
+					variant, encoding = self.open_variant(server, path, entry)
+					try:
+						if not self.check_fill_headers(entry, encoding = encoding):
+							return
+						LOGGER.debug('Returning data')
+						yield self.send_payload(variant if variant is not None else entry)
+					finally:
+						if variant is not None:
+							variant.close()
 		except KeyError:
 			raise tornado.web.HTTPError(404)
 
@@ -472,13 +796,94 @@ if __name__ == '__main__':
 		return s
 
 	parser = ArgumentParser(usage = '%(prog)s [ options ] -c config.xml ')
-	parser.add_argument('--config', '-c', required = True, metavar = 'CONFIG.XML', dest = 'configuration', help = 'XML configuration file')
+	parser.add_argument('--config', '-c', metavar = 'CONFIG.XML', dest = 'configuration', help = 'XML configuration file')
+	parser.add_argument('--test', dest = 'test', action = 'store_true', default = False, help = 'Run the unit tests instead')
 	parser.add_argument('--scrub', dest = 'scrub_only', action = 'store_true', default = False, help = 'Instead of running the server, just do a cache scrub')
+	parser.add_argument('--prebuild', dest = 'prebuild', action = 'store_true', default = False, help = 'Instead of running the server, render every document into the caches')
+	parser.add_argument('--changed-only', dest = 'changed_only', action = 'store_true', default = False, help = 'With --prebuild, only render documents whose cache entries are out of date')
+	parser.add_argument('--resume', dest = 'resume', action = 'store_true', default = False, help = 'With --prebuild, skip documents finished by an earlier, interrupted prebuild')
+	parser.add_argument('--jobs', '-j', dest = 'jobs', metavar = 'N', type = positive_int, help = 'With --prebuild, use N processes instead of one per CPU')
 	parser.add_argument('--bind-address', dest = 'bind_address', metavar = 'ADDRESS', help = 'Bind to ADDRESS instead of the address specified in configuration')
 	parser.add_argument('--bind-port', dest = 'bind_port', metavar = 'ADDRESS', type = positive_int, help = 'Bind to ADDRESS instead of the port specified in configuration')
 
 	args = parser.parse_args()
 
+	if args.test:
+		import unittest
+		from tempfile import mkdtemp
+		from shutil import rmtree
+		logging.basicConfig(level = logging.DEBUG)
+		class ServerTest(unittest.TestCase):
+			CONFIG = \
+"""<?xml version="1.0" ?>
+<configuration>
+	<bind-port>8888</bind-port>
+	<document-root>source</document-root>
+	<runtime-vars>vars</runtime-vars>
+	<cache dir="cache">
+		<checksum-function>sha1</checksum-function>
+		%s
+	</cache>
+	<search-cache>
+		<max-entries>32</max-entries>
+	</search-cache>
+	%s
+	<processors>
+		<encoding>utf8</encoding>
+		<processor mime-type="text/plain">raw</processor>
+	</processors>
+</configuration>
+"""
+			def setUp(self):
+				self.tmpdir = mkdtemp()
+				mkdir(path_join(self.tmpdir, 'source'))
+				with open(path_join(self.tmpdir, 'source', 'test.txt'), 'w', encoding = 'ascii') as f:
+					f.write('foobar')
+			def tearDown(self):
+				rmtree(self.tmpdir)
+			def configuration(self, extra = '', cache_extra = ''):
+				path = path_join(self.tmpdir, 'config.xml')
+				with open(path, 'w', encoding = 'utf8') as f:
+					f.write(self.CONFIG % (cache_extra, extra))
+				with open(path, 'rb') as f:
+					return config.Configuration(f)
+			def test_search_cache(self):
+				server = Server(self.configuration())
+				try:
+					self.assertFalse(server.watching)
+					self.assertIsNotNone(server.search)
+					self.assertIsNotNone(server.search.get_latest_mtime(True))
+				finally:
+					server.close()
+			def test_search_cache_watch(self):
+				server = Server(self.configuration('<watch poll-interval="1" />'))
+				try:
+					self.assertTrue(server.watching)
+				finally:
+					server.close()
+				self.assertFalse(server.watching)
+			def test_doc_head_fingerprint(self):
+				server = Server(self.configuration())
+				try:
+					fingerprint = server.doc_head_fingerprint('test.txt')
+					self.assertIs(server.doc_head_fingerprint('other.txt'), fingerprint)
+					server.set_preview_lines(5)
+					self.assertNotEqual(server.doc_head_fingerprint('test.txt'), fingerprint)
+				finally:
+					server.close()
+			def test_close_partial(self):
+				Server.__new__(Server).close()
+			def test_prebuild_dispatcher(self):
+				configuration = self.configuration(cache_extra = '<dispatcher-thread scrub-slice="10" />')
+				self.assertTrue(configuration.dispatcher_thread)
+				# Would hang if the workers kept dispatcher threads alive
+				failed = Prebuilder.run(configuration, path_join(self.tmpdir, 'config.xml'), 2)
+				self.assertEqual(failed, [])
+				self.assertTrue(isfile(path_join(configuration.cache_dir, 'document', 'test.txt')))
+		unittest.main(argv = sys.argv[:1])
+	elif args.configuration is None:
+		parser.error('the following arguments are required: --config/-c')
+
 	cfg = None
 	with open(args.configuration, 'rb') as f:
 		cfg = config.Configuration(f, setlog = True)
@@ -487,7 +892,12 @@ if __name__ == '__main__':
 	if args.bind_port is not None:
 		cfg.bind_port = args.bind_port
 
-	if not args.scrub_only:
+	if args.prebuild:
+		failed = Prebuilder.run(cfg, args.configuration, args.jobs, args.changed_only, args.resume)
+		for path, error in failed:
+			sys.stderr.write('Failed to prebuild %s: %s\n' % (path, error))
+		sys.exit(1 if failed else 0)
+	elif not args.scrub_only:
 		Server.set_instance(cfg)
 		try:
 			application.listen(cfg.bind_port, cfg.bind_address)
@@ -506,6 +916,7 @@ if __name__ == '__main__':
 			def __del__(self):
 				self.close()
 		cfg.auto_scrub = False
+		cfg.scrub_slice = None
 		for cache in Server.get_caches(cfg, fake_process).values():
 			cache.close()
 		if cfg.use_search_cache:
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+import sys
+if sys.version_info < (3, 3):
+	raise RuntimeError('At least Python 3.3 is required')
+
+import logging, os, struct, select, errno
+import filestuff
+from datetime import timedelta
+from os.path import join as path_join, dirname, normpath, relpath, isdir
+from threading import Thread, Event
+
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = timedelta(seconds = 2)
+
+
+class Watcher(Thread):
+	"""
+		Reports changes under root from its own thread by calling
+		callback(path, modified), where path is relative to root and modified
+		is the latest modification time involved in nanoseconds, if it could
+		be found.  Hidden files and directories are ignored, like everywhere else.
+	"""
+	def __init__(self, root, callback):
+		Thread.__init__(self, name = '%s(%s)' % (type(self).__name__, root))
+		self.daemon = True
+		self.root = root
+		self.callback = callback
+	@staticmethod
+	def hidden(path):
+		return any((part.startswith('.') for part in path.split(os.path.sep)))
+	def report(self, path):
+		if self.hidden(path):
+			return
+		modified = None
+		full_path = path_join(self.root, path)
+		for name in [full_path, dirname(full_path)]:
+			try:
+				mtime = os.stat(name).st_mtime_ns
+			except OSError:
+				continue
+			if modified is None or mtime > modified:
+				modified = mtime
+		LOGGER.debug('%s changed' % path)
+		try:
+			self.callback(path, modified)
+		except:
+			LOGGER.exception('When reporting a change to %s' % path)
+	def stop(self):
+		raise NotImplementedError
+
+
+class PollingWatcher(Watcher):
+	"""
+		Finds changes by polling.  Directories are only listed again when
+		their mtime changes, and the files that are already known are
+		stat()ed, which also catches changes made in place.
+	"""
+	def __init__(self, root, callback, interval = DEFAULT_INTERVAL):
+		Watcher.__init__(self, root, callback)
+		if not isinstance(interval, timedelta):
+			interval = timedelta(seconds = interval)
+		self.__interval = interval.total_seconds()
+		self.__stop = Event()
+		self.__dirs, self.__files = {}, {}
+		self.__scan('', None)
+	def __relative(self, path):
+		path = relpath(path, self.root)
+		return '' if path == '.' else path
+	def __scan(self, path, changed):
+		"Starts tracking a directory and everything under it."
+		for dname, dnames, fnames in os.walk(path_join(self.root, path)):
+			filtered_dnames = [d for d in dnames if not d.startswith('.')]
+			del dnames[:]
+			dnames.extend(filtered_dnames)
+			try:
+				self.__dirs[self.__relative(dname)] = os.stat(dname).st_mtime_ns
+			except OSError:
+				continue
+			if changed is not None:
+				changed.add(self.__relative(dname))
+			for fname in fnames:
+				if fname.startswith('.'):
+					continue
+				relative = self.__relative(path_join(dname, fname))
+				try:
+					self.__files[relative] = filestuff.stat_tuple(os.stat(path_join(dname, fname)))
+				except OSError:
+					continue
+				if changed is not None:
+					changed.add(relative)
+	def __forget(self, path, changed):
+		"Stops tracking a directory that has gone away."
+		prefix = path + os.path.sep
+		for dname in [d for d in self.__dirs if d == path or d.startswith(prefix)]:
+			del self.__dirs[dname]
+		for fname in [f for f in self.__files if f.startswith(prefix)]:
+			del self.__files[fname]
+			changed.add(fname)
+	def poll(self):
+		"Looks for changes once, and reports them."
+		changed = set()
+		for path in sorted(self.__dirs):
+			if path not in self.__dirs:
+				# Its parent went away.
+				continue
+			full_path = path_join(self.root, path)
+			try:
+				mtime_ns = os.stat(full_path).st_mtime_ns
+				if mtime_ns == self.__dirs[path]:
+					continue
+				names = os.listdir(full_path)
+			except OSError:
+				self.__forget(path, changed)
+				changed.add(path)
+				continue
+			self.__dirs[path] = mtime_ns
+			changed.add(path)
+			present = set()
+			for name in names:
+				if name.startswith('.'):
+					continue
+				relative = path_join(path, name)
+				if isdir(path_join(self.root, relative)):
+					if relative not in self.__dirs:
+						self.__scan(relative, changed)
+				else:
+					present.add(relative)
+			for fname in [f for f in self.__files if dirname(f) == path and f not in present]:
+				del self.__files[fname]
+				changed.add(fname)
+			for fname in present:
+				if fname not in self.__files:
+					try:
+						self.__files[fname] = filestuff.stat_tuple(os.stat(path_join(self.root, fname)))
+					except OSError:
+						continue
+					changed.add(fname)
+		for fname, known in list(self.__files.items()):
+			if fname in changed:
+				continue
+			try:
+				current = filestuff.stat_tuple(os.stat(path_join(self.root, fname)))
+			except OSError:
+				# Its directory will have changed too.
+				continue
+			if current != known:
+				self.__files[fname] = current
+				changed.add(fname)
+		for path in sorted(changed):
+			self.report(path)
+		return len(changed)
+	def run(self):
+		LOGGER.info('Polling %s for changes every %.1fs' % (self.root, self.__interval))
+		while not self.__stop.wait(self.__interval):
+			try:
+				self.poll()
+			except:
+				LOGGER.exception('When polling %s' % self.root)
+	def stop(self):
+		self.__stop.set()
+
+
+try:
+	import ctypes, ctypes.util
+	libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+	inotify_init1, inotify_add_watch, inotify_rm_watch = libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch
+	inotify_init1.argtypes, inotify_init1.restype = [ctypes.c_int], ctypes.c_int
+	inotify_add_watch.argtypes, inotify_add_watch.restype = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32], ctypes.c_int
+	inotify_rm_watch.argtypes, inotify_rm_watch.restype = [ctypes.c_int, ctypes.c_int], ctypes.c_int
+
+	class InotifyWatcher(Watcher):
+		"""
+			Finds changes with inotify(7), which has to watch every directory
+			separately.  Files are reported when they are closed after
+			writing or moved, so a render does not start halfway through a
+			write.  If the kernel's queue overflows, everything is reported.
+		"""
+		IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x4, 0x8, 0x40, 0x80
+		IN_CREATE, IN_DELETE, IN_DELETE_SELF = 0x100, 0x200, 0x400
+		IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_ISDIR = 0x4000, 0x8000, 0x1000000, 0x40000000
+		IN_NONBLOCK, IN_CLOEXEC = os.O_NONBLOCK, 0o2000000
+		MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+		FILE_EVENTS = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+		event_fmt = 'iIII'
+		event_size = struct.calcsize(event_fmt)
+		BUFFER_SIZE = 65536
+		def __init__(self, root, callback):
+			Watcher.__init__(self, root, callback)
+			self.__fd = inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+			if self.__fd < 0:
+				code = ctypes.get_errno()
+				raise OSError(code, os.strerror(code))
+			self.__wake_read, self.__wake_write = os.pipe()
+			self.__watches = {}
+			self.__add('', None)
+		def __add(self, path, changed):
+			"Watches a directory and everything under it, reporting files to changed if it is not None."
+			for dname, dnames, fnames in os.walk(path_join(self.root, path)):
+				filtered_dnames = [d for d in dnames if not d.startswith('.')]
+				del dnames[:]
+				dnames.extend(filtered_dnames)
+				relative = relpath(dname, self.root)
+				relative = '' if relative == '.' else relative
+				wd = inotify_add_watch(self.__fd, os.fsencode(dname), self.MASK)
+				if wd < 0:
+					code = ctypes.get_errno()
+					if code == errno.ENOSPC:
+						LOGGER.warning('Out of inotify watches; changes under %s will be missed' % dname)
+					continue
+				self.__watches[wd] = relative
+				if changed is not None:
+					changed.add(relative)
+					changed.update((path_join(relative, fname) for fname in fnames if not fname.startswith('.')))
+		def __remove(self, path):
+			"Stops watching a directory that was moved away, and everything under it."
+			prefix = path + os.path.sep
+			for wd, dname in list(self.__watches.items()):
+				if dname == path or dname.startswith(prefix):
+					inotify_rm_watch(self.__fd, wd)
+					del self.__watches[wd]
+		def __events(self, data):
+			offset = 0
+			while offset + self.event_size <= len(data):
+				wd, mask, cookie, length = struct.unpack_from(self.event_fmt, data, offset)
+				offset += self.event_size
+				name = data[offset:offset + length].rstrip(b'\0')
+				offset += length
+				yield wd, mask, os.fsdecode(name)
+		def __read(self):
+			try:
+				data = os.read(self.__fd, self.BUFFER_SIZE)
+			except BlockingIOError:
+				return
+			changed = set()
+			for wd, mask, name in self.__events(data):
+				if mask & self.IN_Q_OVERFLOW:
+					LOGGER.warning('Missed changes under %s; reporting everything' % self.root)
+					self.__add('', changed)
+					continue
+				directory = self.__watches.get(wd, None)
+				if directory is None:
+					continue
+				if mask & self.IN_IGNORED:
+					del self.__watches[wd]
+					continue
+				if not name or name.startswith('.'):
+					continue
+				path = path_join(directory, name)
+				if mask & self.IN_ISDIR:
+					if mask & (self.IN_CREATE | self.IN_MOVED_TO):
+						# Anything created before the watch was added has to be reported now.
+						self.__add(path, changed)
+					elif mask & self.IN_MOVED_FROM:
+						self.__remove(path)
+					changed.add(path)
+				elif mask & self.FILE_EVENTS:
+					changed.add(path)
+			for path in sorted(changed):
+				self.report(path)
+		def run(self):
+			LOGGER.info('Watching %s for changes with inotify' % self.root)
+			try:
+				while True:
+					readable, writable, errors = select.select([self.__fd, self.__wake_read], [], [])
+					if self.__wake_read in readable:
+						break
+					try:
+						self.__read()
+					except:
+						LOGGER.exception('When reading changes under %s' % self.root)
+			finally:
+				os.close(self.__fd)
+				os.close(self.__wake_read)
+				os.close(self.__wake_write)
+		def stop(self):
+			os.write(self.__wake_write, b'\0')
+except (ImportError, OSError, AttributeError):
+	LOGGER.debug('inotify is not available')
+
+
+def watch(root, callback, interval = DEFAULT_INTERVAL):
+	"Returns an unstarted watcher for root, using inotify if it is available and polling otherwise."
+	if 'InotifyWatcher' in globals():
+		try:
+			return InotifyWatcher(root, callback)
+		except OSError as e:
+			LOGGER.warning('Could not use inotify for %s (%s); polling instead' % (root, e))
+	return PollingWatcher(root, callback, interval)
+
+
+
+if __name__ == '__main__':
+	import unittest
+	from tempfile import mkdtemp
+	from shutil import rmtree
+	from threading import Lock
+	from time import time
+	logging.basicConfig(level = logging.DEBUG)
+
+	class BaseWatcherTest(unittest.TestCase):
+		def changed(self, path, modified):
+			with self.lock:
+				self.changes.append(path)
+				self.modified = modified
+		def setUp(self):
+			self.lock = Lock()
+			self.changes = []
+			self.modified = None
+			self.tmpdir = mkdtemp()
+			os.mkdir(path_join(self.tmpdir, 'a'))
+			os.mkdir(path_join(self.tmpdir, '.hidden'))
+			self.write('a/1.txt', 'one')
+			self.write('2.txt', 'two')
+		def tearDown(self):
+			rmtree(self.tmpdir)
+		def write(self, path, data, mtime = None):
+			full_path = path_join(self.tmpdir, path)
+			with open(full_path, 'w', encoding = 'ascii') as f:
+				f.write(data)
+			if mtime is not None:
+				os.utime(full_path, (mtime, mtime))
+	class PollingWatcherTest(BaseWatcherTest):
+		def setUp(self):
+			BaseWatcherTest.setUp(self)
+			self.watcher = PollingWatcher(self.tmpdir, self.changed)
+		def test_poll(self):
+			self.assertEqual(self.watcher.poll(), 0)
+			later = time() + 10
+			self.write('a/1.txt', 'ONE', later)
+			self.assertEqual(self.watcher.poll(), 1)
+			self.assertEqual(self.changes, ['a/1.txt'])
+			self.assertGreaterEqual(self.modified, int(later) * 1000000000)
+
+			del self.changes[:]
+			os.mkdir(path_join(self.tmpdir, 'b'))
+			self.write('b/3.txt', 'three')
+			self.write('.hidden/4.txt', 'four')
+			os.utime(self.tmpdir, (later + 10, later + 10))
+			self.watcher.poll()
+			self.assertEqual(self.changes, ['', 'b', 'b/3.txt'])
+
+			del self.changes[:]
+			rmtree(path_join(self.tmpdir, 'a'))
+			os.utime(self.tmpdir, (later + 20, later + 20))
+			self.watcher.poll()
+			self.assertEqual(self.changes, ['', 'a', 'a/1.txt'])
+			self.assertEqual(self.watcher.poll(), 0)
+		def test_thread(self):
+			watcher = PollingWatcher(self.tmpdir, self.changed, 0.05)
+			watcher.start()
+			try:
+				self.write('2.txt', 'TWO', time() + 10)
+				for i in range(100):
+					with self.lock:
+						if self.changes:
+							break
+					watcher.join(0.05)
+				self.assertEqual(self.changes, ['2.txt'])
+			finally:
+				watcher.stop()
+				watcher.join()
+	if 'InotifyWatcher' in globals():
+		class InotifyWatcherTest(BaseWatcherTest):
+			def setUp(self):
+				BaseWatcherTest.setUp(self)
+				self.watcher = InotifyWatcher(self.tmpdir, self.changed)
+				self.watcher.start()
+			def tearDown(self):
+				self.watcher.stop()
+				self.watcher.join()
+				BaseWatcherTest.tearDown(self)
+			def wait_for(self, path):
+				for i in range(100):
+					with self.lock:
+						if path in self.changes:
+							return
+					self.watcher.join(0.05)
+				self.fail('%s was not reported: %s' % (path, self.changes))
+			def test_changes(self):
+				self.write('a/1.txt', 'ONE')
+				self.wait_for('a/1.txt')
+				self.assertIsNotNone(self.modified)
+
+				# Files in new directories are watched too.
+				os.mkdir(path_join(self.tmpdir, 'b'))
+				self.wait_for('b')
+				self.write('b/3.txt', 'three')
+				self.wait_for('b/3.txt')
+
+				os.rename(path_join(self.tmpdir, '2.txt'), path_join(self.tmpdir, 'b', '2.txt'))
+				self.wait_for('2.txt')
+				self.wait_for('b/2.txt')
+
+				self.write('.hidden/4.txt', 'four')
+				remove_path = path_join(self.tmpdir, 'a', '1.txt')
+				os.remove(remove_path)
+				self.wait_for('a/1.txt')
+				with self.lock:
+					self.assertFalse([path for path in self.changes if self.watcher.hidden(path)])
+	unittest.main()
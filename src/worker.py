@@ -4,13 +4,14 @@ if sys.version_info < (3, 3):
 	raise RuntimeError('At least Python 3.3 is required')
 
 
-from queue import Queue
 from threading import Thread, Condition, Lock, Event
 import threading
 from traceback import print_exception, extract_stack, format_list
 import logging
 import os, uuid
-from time import sleep
+from time import sleep, monotonic
+from collections import namedtuple, deque, OrderedDict
+from concurrent.futures import Future
 
 
 LOGGER = logging.getLogger(__name__)
@@ -91,11 +92,79 @@ class Job(object):
 			else:
 				return self.__result
 
+# Priority classes, highest first
+INTERACTIVE, MAINTENANCE = 0, 1
+PRIORITIES = ('interactive', 'maintenance')
+# Jobs that stop a worker run once nothing else is waiting.
+FINISHING = len(PRIORITIES)
+
+QueueStatistics = namedtuple('QueueStatistics', ['depth', 'oldest', 'run', 'waited'])
+
+class JobQueue(object):
+	"""
+		Hands out jobs by priority class, first in first out within a class.
+		Every aging seconds a job waits counts as one class higher, so that
+		a steady stream of interactive jobs cannot starve the others.
+	"""
+	DEFAULT_AGING = 2
+	__slots__ = '__lock', '__ready', '__queues', '__aging', '__run', '__waited',
+	def __init__(self, aging = DEFAULT_AGING):
+		if aging is not None and aging <= 0:
+			raise ValueError('Invalid aging interval: %s' % aging)
+		self.__lock = Lock()
+		self.__ready = Condition(self.__lock)
+		self.__queues = [deque() for i in range(FINISHING + 1)]
+		self.__aging = aging
+		self.__run = [0] * FINISHING
+		self.__waited = [0.0] * FINISHING
+	def __len__(self):
+		with self.__lock:
+			return sum((len(queue) for queue in self.__queues))
+	def put(self, job, priority = INTERACTIVE):
+		if priority not in range(FINISHING + 1):
+			raise ValueError('Invalid priority: %s' % repr(priority))
+		with self.__lock:
+			self.__queues[priority].append((monotonic(), job))
+			self.__ready.notify()
+	def __next(self, now):
+		best = None
+		for priority, queue in enumerate(self.__queues[:FINISHING]):
+			if queue:
+				queued = queue[0][0]
+				rank = (priority - (int((now - queued) / self.__aging) if self.__aging is not None else 0), queued)
+				if best is None or rank < best[0]:
+					best = (rank, priority)
+		if best is not None:
+			return best[1]
+		return FINISHING if self.__queues[FINISHING] else None
+	def get(self):
+		with self.__lock:
+			while True:
+				now = monotonic()
+				priority = self.__next(now)
+				if priority is not None:
+					break
+				self.__ready.wait()
+			queued, job = self.__queues[priority].popleft()
+			if priority < FINISHING:
+				self.__run[priority] += 1
+				self.__waited[priority] += now - queued
+			return job
+	def statistics(self):
+		"Returns the queue depth, the oldest job's wait and the jobs run and their total wait so far, by class name."
+		now = monotonic()
+		with self.__lock:
+			return OrderedDict(((name, QueueStatistics(len(queue), (now - queue[0][0]) if queue else 0.0, run, waited)) \
+					for name, queue, run, waited in zip(PRIORITIES, self.__queues, self.__run, self.__waited)))
+	def __str__(self):
+		return ', '.join(('%s: %d queued (oldest %.3fs), %d run (%.3fs waiting)' % ((name,) + tuple(stats)) \
+				for name, stats in self.statistics().items()))
+
 class Queued(object):
 	__slots__ = '__queue',
 	def __init__(self, queue):
-		self.__queue = queue if queue is not None else Queue()
-	def schedule(self, func, *args, **kwargs):
+		self.__queue = queue if queue is not None else JobQueue()
+	def schedule(self, func, *args, priority = INTERACTIVE, **kwargs):
 		LOGGER.debug('Got %s to schedule in queue %s' % (repr(func), self.__queue))
 		if not isinstance(func, Job):
 			job = Job(func, *args, **kwargs)
@@ -104,7 +173,7 @@ class Queued(object):
 				LOGGER.warning('Cannot pass args=%s or kwargs=%s to preconstructed job' % (args, kwargs))
 			job = func
 		LOGGER.debug('Scheduling job %s in queue %s' % (repr(job), self.__queue))
-		self.__queue.put(job)
+		self.__queue.put(job, priority)
 		return job
 	def __call__(self, func, *args, **kwargs):
 		return self.schedule_sync(func, *args, **kwargs)
@@ -115,11 +184,11 @@ class Queued(object):
 	def finish(self, wait = False, timeout = None):
 		if wait:
 			if timeout is not None:
-				return self.schedule_sync(Finished.finish)
+				return self.schedule_sync(Finished.finish, priority = FINISHING)
 			else:
-				return self.schedule_sync_timeout(timeout, Finished.finish)
+				return self.schedule_sync_timeout(timeout, Finished.finish, priority = FINISHING)
 		else:
-			return self.schedule(Finished.finish)
+			return self.schedule(Finished.finish, priority = FINISHING)
 
 
 class Worker(Thread, Queued):
@@ -143,17 +212,18 @@ class Worker(Thread, Queued):
 					LOGGER.exception('Job %s in thread %s:' % (job, self))
 					print_exception(type(e), e, None, file = sys.stderr)
 					job.complete_exception(e)
-				finally:
-					self._Queued__queue.task_done()
 		finally:
 			LOGGER.debug('Thread %s has finished' % self)
 
 
 class WorkerPool(Queued):
 	__slots__ = '__workers',
-	def __init__(self, size, autostart = True):
-		Queued.__init__(self, None)
+	def __init__(self, size, autostart = True, aging = JobQueue.DEFAULT_AGING):
+		Queued.__init__(self, JobQueue(aging))
 		self.__workers = [Worker(self._Queued__queue, autostart) for i in range(size)]
+	@property
+	def queue(self):
+		return self._Queued__queue
 	def start(self):
 		for worker in self.__workers:
 			worker.start()
@@ -164,6 +234,44 @@ class WorkerPool(Queued):
 		for worker in self.__workers:
 			worker.join()
 
+class SingleFlight(object):
+	"""
+		Coalesces concurrent calls for the same key: the first caller runs the
+		function, and everyone who arrives while it is running waits on the
+		same Future and receives its result (or exception).
+	"""
+	__slots__ = '__lock', '__flights',
+	def __init__(self):
+		self.__lock = Lock()
+		self.__flights = {}
+	def __len__(self):
+		with self.__lock:
+			return len(self.__flights)
+	def __contains__(self, key):
+		with self.__lock:
+			return key in self.__flights
+	def __call__(self, key, func, *args, **kwargs):
+		with self.__lock:
+			future = self.__flights.get(key, None)
+			leader = future is None
+			if leader:
+				future = Future()
+				self.__flights[key] = future
+		if not leader:
+			LOGGER.debug('Waiting for in-flight call for %s' % repr(key))
+			return future.result()
+		try:
+			result = func(*args, **kwargs)
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		else:
+			future.set_result(result)
+			return result
+		finally:
+			with self.__lock:
+				del self.__flights[key]
+
 class RWAdapter(Job):
 	__slots__ = '__method', '__read', '__write',
 	def __init__(self, method):
@@ -289,6 +397,59 @@ if __name__ == '__main__':
 		def test_exc(self):
 			job = self.pool.schedule(self.rexc, ValueError)
 			self.assertRaises(ValueError, job.wait)
+	class PriorityPoolTest(unittest.TestCase):
+		def record(self, name):
+			self.order.append(name)
+		def setUp(self):
+			self.order = []
+			self.pool = WorkerPool(1, autostart = False)
+		def test_order(self):
+			self.pool.schedule(self.record, 'maintenance', priority = MAINTENANCE)
+			self.pool.schedule(self.record, 'interactive')
+			self.pool.finish()
+			self.pool.schedule(self.record, 'late', priority = MAINTENANCE)
+			self.assertEqual(self.pool.queue.statistics()['maintenance'].depth, 2)
+			self.pool.start()
+			self.pool.join()
+			self.assertEqual(self.order, ['interactive', 'maintenance', 'late'])
+			stats = self.pool.queue.statistics()
+			self.assertEqual(list(stats.keys()), list(PRIORITIES))
+			self.assertEqual([s.depth for s in stats.values()], [0, 0])
+			self.assertEqual([s.run for s in stats.values()], [1, 2])
+	class JobQueueTest(unittest.TestCase):
+		def test_aging(self):
+			queue = JobQueue(0.05)
+			queue.put('maintenance', MAINTENANCE)
+			sleep(0.15)
+			queue.put('interactive', INTERACTIVE)
+			self.assertEqual([queue.get(), queue.get()], ['maintenance', 'interactive'])
+		def test_no_aging(self):
+			queue = JobQueue(None)
+			queue.put('maintenance', MAINTENANCE)
+			sleep(0.15)
+			queue.put('interactive', INTERACTIVE)
+			self.assertEqual([queue.get(), queue.get()], ['interactive', 'maintenance'])
+		def test_finishing(self):
+			queue = JobQueue(0.01)
+			queue.put('finish', FINISHING)
+			sleep(0.05)
+			queue.put('maintenance', MAINTENANCE)
+			self.assertEqual([queue.get(), queue.get()], ['maintenance', 'finish'])
+		def test_statistics(self):
+			queue = JobQueue()
+			queue.put('maintenance', MAINTENANCE)
+			queue.put('maintenance', MAINTENANCE)
+			self.assertEqual(len(queue), 2)
+			stats = queue.statistics()['maintenance']
+			self.assertEqual((stats.depth, stats.run), (2, 0))
+			self.assertGreaterEqual(stats.oldest, 0)
+			queue.get()
+			stats = queue.statistics()['maintenance']
+			self.assertEqual((stats.depth, stats.run), (1, 1))
+			self.assertIn('maintenance: 1 queued', str(queue))
+		def test_invalid(self):
+			self.assertRaises(ValueError, JobQueue, 0)
+			self.assertRaises(ValueError, JobQueue().put, 'job', FINISHING + 1)
 	class RWAdapterTest(unittest.TestCase):
 		def process(self, inf, outf):
 			copyfileobj(inf, outf)
@@ -327,6 +488,47 @@ if __name__ == '__main__':
 					self.assertEqual(TEXT, text)
 				finally:
 					job.wait()
+	class SingleFlightTest(unittest.TestCase):
+		def process(self, value):
+			with self.lock:
+				self.count += 1
+			self.started.set()
+			self.release.wait(5)
+			return value
+		def setUp(self):
+			self.flights = SingleFlight()
+			self.lock = Lock()
+			self.count = 0
+			self.started = Event()
+			self.release = Event()
+		def test_coalesce(self):
+			results = []
+			def call():
+				results.append(self.flights('key', self.process, 'value'))
+			threads = [Thread(target = call) for i in range(5)]
+			threads[0].start()
+			self.assertTrue(self.started.wait(5))
+			for thread in threads[1:]:
+				thread.start()
+			# Give the followers a moment to find the flight.
+			sleep(0.2)
+			self.release.set()
+			for thread in threads:
+				thread.join()
+			self.assertEqual(results, ['value'] * 5)
+			self.assertEqual(self.count, 1)
+			self.assertEqual(len(self.flights), 0)
+		def test_sequential(self):
+			self.release.set()
+			self.assertEqual(self.flights('key', self.process, 1), 1)
+			self.assertEqual(self.flights('key', self.process, 2), 2)
+			self.assertEqual(self.count, 2)
+		def test_exception(self):
+			def fail():
+				raise ValueError
+			self.assertRaises(ValueError, self.flights, 'key', fail)
+			self.assertEqual(len(self.flights), 0)
+
 	class PipeTest(unittest.TestCase):
 		def test_pipe(self):
 			r, w = os.pipe()